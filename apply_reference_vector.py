@@ -9,58 +9,21 @@ Results are saved to:
 """
 
 import os
-import glob
-import random
 import numpy as np
 from datetime import datetime
 
 from objective_function_priority import objective_function_priority
 from objective_function import objective_function
-from utils_matlab_io import save_chromosome_mat, load_chromosome_mat
+from dataset_catalog import find_patient_folder
+from patient_split import get_validation_patients
+from patient_layers import PatientLayers
+from utils_matlab_io import load_chromosome_mat
+from artifact_writer import ArtifactWriter, raise_write_errors
+from fitness_store import get_store, DEFAULT_STORE_PATH
+import profiling
 
 
-def get_all_prefixes(image_folder):
-    # Scans the image_folder to find all unique patient prefixes.
-    prefixes = set()
-    search_path = os.path.join(image_folder, '*', '*.bmp')
-    files = glob.glob(search_path)
-    
-    for file_path in files:
-        filename = os.path.basename(file_path)
-        parts = filename.split('_')
-        if len(parts) >= 1:
-            prefixes.add(parts[0])
-            
-    return sorted(list(prefixes))
-
-
-def get_validation_patients(image_folder):
-    # Returns the 15 validation patients using the same logic as main.py.
-    all_prefixes = get_all_prefixes(image_folder)
-    total_patients = len(all_prefixes)
-    
-    if total_patients < 35:
-        print("Warning: Less than 35 patients found. Using all available as validation.")
-        return all_prefixes
-        
-    random.seed(42)  # Must match find_general_vector.py
-    random.shuffle(all_prefixes)
-    
-    # First 35 are training, last 15 are validation
-    val_prefixes = all_prefixes[35:]
-    return val_prefixes
-
-
-def find_patient_folder(base_folder, prefix):
-    """Finds the subfolder containing images for the given patient prefix."""
-    for subdir in glob.glob(os.path.join(base_folder, '*')):
-        if os.path.isdir(subdir):
-            if glob.glob(os.path.join(subdir, f'{prefix}_*.bmp')):
-                return subdir
-    return None
-
-
-def apply_reference_vector(image_folder, reference_vector_path, out_base_dir):
+def apply_reference_vector(image_folder, reference_vector_path, out_base_dir, fitness_store=None):
     print("=" * 80)
     print("APPLYING REFERENCE VECTOR (NO LOCAL SEARCH)")
     print("=" * 80)
@@ -79,8 +42,15 @@ def apply_reference_vector(image_folder, reference_vector_path, out_base_dir):
     os.makedirs(priority_dir, exist_ok=True)
     os.makedirs(average_dir, exist_ok=True)
     
+    # The composites are always fused (they are written as PNG); their fitness
+    # is added to the fitness store for the other scripts
+    store = get_store(fitness_store)
+    
     results = []
     
+    # .mat and PNG files are written in the background while the next patient runs
+    writer = ArtifactWriter()
+    
     for i, patient in enumerate(val_patients, 1):
         print(f"\n{'=' * 80}")
         print(f"[{i}/{len(val_patients)}] Processing patient: {patient}")
@@ -93,40 +63,40 @@ def apply_reference_vector(image_folder, reference_vector_path, out_base_dir):
             
         print(f"Located in: {patient_folder}")
         
+        # Layers decoded once for both methods
+        patient_layers = PatientLayers(patient_folder, patient, preload=False)
+        
         # PRIORITY FUSION 
         print(f"\n--- Applying with PRIORITY fusion ---")
         
-        fitness_priority, img_priority = objective_function_priority(
-            reference_chrom, 
-            image_folder=patient_folder, 
-            prefix=patient
-        )
+        result_priority = objective_function_priority(reference_chrom, patient=patient_layers)
+        fitness_priority = result_priority.fitness
+        store_key = store.patient_key(patient_folder, patient) if store is not None else None
+        if store_key is not None:
+            store.put(store_key, 'priority', reference_chrom, fitness_priority)
         
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         chrom_path_p = os.path.join(priority_dir, f'ref_chrom_{patient}_{timestamp}.mat')
         img_path_p = os.path.join(priority_dir, f'ref_img_{patient}_{timestamp}.png')
         
-        save_chromosome_mat(reference_chrom, chrom_path_p)
-        _, _ = objective_function_priority(reference_chrom, image_folder=patient_folder, 
-                                          prefix=patient, save_path=img_path_p)
+        writer.save_mat(reference_chrom, chrom_path_p)
+        writer.save_png(result_priority, img_path_p)
         
         print(f"Priority - Fitness: {fitness_priority:.6f}")
         
         # AVERAGE FUSION 
         print(f"\n--- Applying with AVERAGE fusion ---")
         
-        fitness_average, img_average = objective_function(
-            reference_chrom, 
-            image_folder=patient_folder, 
-            prefix=patient
-        )
+        result_average = objective_function(reference_chrom, patient=patient_layers)
+        fitness_average = result_average.fitness
+        if store_key is not None:
+            store.put(store_key, 'average', reference_chrom, fitness_average)
         
         chrom_path_a = os.path.join(average_dir, f'ref_chrom_{patient}_{timestamp}.mat')
         img_path_a = os.path.join(average_dir, f'ref_img_{patient}_{timestamp}.png')
         
-        save_chromosome_mat(reference_chrom, chrom_path_a)
-        _, _ = objective_function(reference_chrom, image_folder=patient_folder, 
-                                 prefix=patient, save_path=img_path_a)
+        writer.save_mat(reference_chrom, chrom_path_a)
+        writer.save_png(result_average, img_path_a)
         
         print(f"Average - Fitness: {fitness_average:.6f}")
         
@@ -141,6 +111,8 @@ def apply_reference_vector(image_folder, reference_vector_path, out_base_dir):
             'winner': winner
         })
     
+    raise_write_errors(writer.close())
+    
     print(f"\n{'=' * 80}")
     print("SUMMARY")
     print(f"{'=' * 80}\n")
@@ -210,9 +182,20 @@ def main():
                        help='Path to .mat file containing the reference chromosome')
     parser.add_argument('--out_dir', type=str, default='results_reference_vector',
                        help='Output directory for results')
+    parser.add_argument('--fitness_store', type=str, default=DEFAULT_STORE_PATH,
+                       help="Persistent fitness store shared with other runs ('' to disable)")
+    parser.add_argument('--profile', action='store_true',
+                       help='Save a PROFILE_*.json report of the run in out_dir')
     args = parser.parse_args()
     
-    apply_reference_vector(args.image_folder, args.reference_vector, args.out_dir)
+    if args.profile:
+        profiling.enable()
+    
+    apply_reference_vector(args.image_folder, args.reference_vector, args.out_dir, args.fitness_store)
+    
+    if args.profile:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        profiling.write_report(os.path.join(args.out_dir, f'PROFILE_REFERENCE_VECTOR_{timestamp}.json'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Background writer for the result files (.mat chromosomes, PNG composites and
+text reports).
+
+The search drivers hand each artifact to an `ArtifactWriter` and go on with the
+next patient while a small thread pool writes it (OpenCV releases the GIL while
+encoding PNGs). At most `max_pending` artifacts wait at a time: when the queue
+is full, `submit` blocks until one is written.
+
+`flush` waits for everything submitted so far and reports the files that could
+not be written; `close` (also called at exit and when used as a context
+manager) flushes and stops the threads. The drivers pass those reports to
+`raise_write_errors` before marking a task as finished, so a task whose files
+were not written is not checkpointed.
+
+Usage:
+    with ArtifactWriter() as writer:
+        writer.save_mat(best, chrom_path)
+        writer.save_png(result, img_path)
+        raise_write_errors(writer.flush())
+"""
+
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+from utils_matlab_io import save_chromosome_mat
+import profiling
+
+
+class ArtifactWriter:
+    """
+    Thread pool with a bounded queue of pending writes.
+
+    workers: writing threads
+    max_pending: artifacts queued or being written before submit blocks
+    """
+
+    def __init__(self, workers=2, max_pending=16):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='artifact_writer')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.closed = False
+        atexit.register(self.close)
+
+    def submit(self, label, func, *args, **kwargs):
+        """Queues func(*args, **kwargs); label names the artifact in error messages."""
+        if self.closed:
+            raise RuntimeError('ArtifactWriter cerrado')
+        with profiling.span('write/queue_wait'):
+            self.slots.acquire()
+        future = self.executor.submit(func, *args, **kwargs)
+        with self.lock:
+            self.pending[future] = label
+        future.add_done_callback(lambda f: self._done(label, f))
+        return future
+
+    def _done(self, label, future):
+        self.slots.release()
+        error = future.exception()
+        if error is not None:
+            print(f'ERROR writing {label}: {error}')
+
+    def save_mat(self, chromosome, path):
+        # Copy, the caller may keep modifying its chromosome
+        return self.submit(path, save_chromosome_mat, np.array(chromosome), path)
+
+    def save_png(self, result, path):
+        """Writes the composite of a FusionResult."""
+        return self.submit(path, result.save_png, path)
+
+    def write_text(self, path, text):
+        return self.submit(path, _write_text, path, text)
+
+    def flush(self):
+        """
+        Waits until every submitted artifact is written.
+        Returns the (label, exception) pairs of the writes that failed since the last flush.
+        """
+        with self.lock:
+            pending = dict(self.pending)
+        with profiling.span('write/flush'):
+            wait(pending)
+
+        errors = []
+        with self.lock:
+            for future, label in pending.items():
+                del self.pending[future]
+                if future.exception() is not None:
+                    errors.append((label, future.exception()))
+        if errors:
+            print(f'Warning: {len(errors)} files could not be written')
+        return errors
+
+    def close(self):
+        if self.closed:
+            return []
+        errors = self.flush()
+        self.executor.shutdown(wait=True)
+        self.closed = True
+        atexit.unregister(self.close)
+        return errors
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def raise_write_errors(errors):
+    """Raises an OSError naming the files of a flush/close report that could not be written."""
+    if errors:
+        labels = ', '.join(str(label) for label, _ in errors)
+        raise OSError(f'No se pudieron escribir {len(errors)} archivos: {labels}') from errors[0][1]
+
+
+def _write_text(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
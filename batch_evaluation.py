@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+Batched evaluation of the 127 chromosomes of a patient.
+
+Instead of fusing the layers once per chromosome, the 7 layers (7,H,W,3) and
+their red masks (7,H,W) are stacked and the fusion of every chromosome is
+accumulated at the same time, one layer per step. Only the pixels detected in
+at least one layer are processed, since the rest never enter the score.
+
+The results are identical to calling `objective_function` and
+`objective_function_priority` for each chromosome: layers are accumulated in
+the same order (N1 to N7) and with the same float32 arithmetic.
+
+Two engines are available:
+- 'float': RGB float32 [0,1] layers, the arithmetic of the objective functions.
+- 'uint8': BGR uint8 layers, integer sums and counts and the score thresholds
+  mapped to integer comparisons. The overlapping pixels where the float
+  comparisons can round differently (exact ties r == g, r == b, r == 60)
+  are re-checked in float32, so both engines give identical fitness values.
+  Priority fusion is scored from per-pixel 7-bit layer signatures: the owner of
+  a pixel is the lowest selected bit of its signature (LOWEST_LAYER lookup).
+
+Chromosomes are returned in the order of `itertools.product([0, 1], repeat=7)`
+without the null vector, the order used by find_general_vector.py.
+
+The count functions also take the chromosomes of patients with more than 7
+layers (PatientLayers n_layers), but their tables grow with the 2^n - 1
+chromosomes (and 2^n signatures). All the subsets of such patients are only
+evaluated with the 'gray' sweep engine (gray_sweep.py), one layer update at a
+time.
+"""
+
+import itertools
+from functools import lru_cache
+import numpy as np
+
+from patient_layers import N_LAYERS
+import profiling
+
+
+def all_chromosomes(n_layers=N_LAYERS):
+    """(2^n - 1, n) matrix with all non-null chromosomes, in itertools.product order."""
+    return np.array(list(itertools.product([0, 1], repeat=n_layers)), dtype=int)[1:]
+
+
+# (127, 7) matrix with all non-null chromosomes
+ALL_CHROMOSOMES = all_chromosomes(N_LAYERS)
+
+# Pixels processed at once, bounds the (127, chunk, 3) accumulators
+CHUNK_SIZE = 8192
+
+
+def valid_color(pixels):
+    # Valid pixels: red between 60/255 and 1, and red > green and red > blue
+    red = pixels[..., 0]
+    green = pixels[..., 1]
+    blue = pixels[..., 2]
+    return (red >= 60/255) & (red > green) & (red > blue)
+
+
+def fitness_from_counts(valid_count, total_detected):
+    """
+    Vectorized version of the score used by the objective functions.
+    Chromosomes without detected pixels get fitness 0.
+    """
+    valid_count = np.asarray(valid_count, dtype=np.int64)
+    total_detected = np.asarray(total_detected, dtype=np.int64)
+
+    fitness = np.zeros(valid_count.shape, dtype=np.float64)
+    detected = total_detected > 0
+    valid = valid_count[detected]
+
+    # Quality score
+    quality = valid / total_detected[detected]
+
+    # Presence score
+    presence = valid / (valid + 50)
+
+    # Weighted fitness
+    fitness[detected] = 0.8 * quality + 0.2 * presence
+    return fitness
+
+
+def valid_color_uint8(pixels):
+    # Same as valid_color for BGR uint8 pixels: 60/255 <= red <=> red >= 60
+    blue = pixels[..., 0]
+    green = pixels[..., 1]
+    red = pixels[..., 2]
+    return (red >= 60) & (red > green) & (red > blue)
+
+
+def _detected_pixels(patient, layers, engine='float'):
+    # Layers and masks restricted to the pixels detected by any of them: (k,n,3), (k,n)
+    masks = patient.mask_stack(layers)
+    if engine == 'uint8':
+        images = patient.raw_stack(layers)
+    else:
+        images = patient.image_stack(layers)
+    union = masks.any(axis=0)
+    return images[:, union], masks[:, union]
+
+
+def _selected_layers(chromosomes):
+    # Selection matrix restricted to the layers used by at least one chromosome
+    selected = np.asarray(chromosomes, dtype=int).astype(bool)
+    layers = np.flatnonzero(selected.any(axis=0))
+    return selected[:, layers], layers
+
+
+def average_counts(patient, chromosomes=ALL_CHROMOSOMES):
+    """
+    Returns (valid_count, total_detected) of AVERAGE fusion for each chromosome.
+    """
+    selected, layers = _selected_layers(chromosomes)
+    pixels, masks = _detected_pixels(patient, layers)
+
+    valid_count = np.zeros(len(selected), dtype=np.int64)
+    total_detected = np.zeros(len(selected), dtype=np.int64)
+
+    for start in range(0, masks.shape[1], CHUNK_SIZE):
+        px = pixels[:, start:start + CHUNK_SIZE]
+        m = masks[:, start:start + CHUNK_SIZE]
+
+        fusion_color = np.zeros((len(selected),) + px.shape[1:], dtype=np.float32)
+        count = np.zeros((len(selected), m.shape[1]), dtype=int)
+
+        # Accumulate N1 to N7 into every chromosome that selects the layer
+        for i in range(len(layers)):
+            rows = selected[:, i]
+            fusion_color[rows] += px[i] * m[i][:, np.newaxis]
+            count[rows] += m[i]
+
+        # Average colors where there is overlap
+        detected = count > 0
+        fusion_color[detected] /= count[detected][:, np.newaxis]
+
+        valid_count += (valid_color(fusion_color) & detected).sum(axis=1)
+        total_detected += detected.sum(axis=1)
+
+    return valid_count, total_detected
+
+
+def priority_counts(patient, chromosomes=ALL_CHROMOSOMES):
+    """
+    Returns (valid_count, total_detected) of PRIORITY fusion for each chromosome.
+    """
+    selected, layers = _selected_layers(chromosomes)
+    pixels, masks = _detected_pixels(patient, layers)
+
+    # Per layer: the pixel would be valid / visible in the composite if the layer owns it
+    layer_valid = valid_color(pixels) & masks
+    layer_visible = np.any(pixels > 0, axis=2) & masks
+
+    n = masks.shape[1]
+    ocupado = np.zeros((len(selected), n), dtype=bool)
+    valid = np.zeros((len(selected), n), dtype=bool)
+    visible = np.zeros((len(selected), n), dtype=bool)
+
+    # Layers with lower index claim the pixels first
+    for i in range(len(layers)):
+        rows = selected[:, i]
+        new_pixels = masks[i] & ~ocupado[rows]
+        valid[rows] |= new_pixels & layer_valid[i]
+        visible[rows] |= new_pixels & layer_visible[i]
+        ocupado[rows] |= masks[i]
+
+    return valid.sum(axis=1), visible.sum(axis=1)
+
+
+def average_counts_uint8(patient, chromosomes=ALL_CHROMOSOMES):
+    """
+    Integer version of average_counts: colors are summed as integers and the
+    average is never formed (red/count >= 60 <=> red >= 60*count, and the
+    channel comparisons are done on the sums).
+    """
+    selected, layers = _selected_layers(chromosomes)
+    pixels, masks = _detected_pixels(patient, layers, engine='uint8')
+
+    valid_count = np.zeros(len(selected), dtype=np.int64)
+    total_detected = np.zeros(len(selected), dtype=np.int64)
+
+    for start in range(0, masks.shape[1], CHUNK_SIZE):
+        px = pixels[:, start:start + CHUNK_SIZE]
+        m = masks[:, start:start + CHUNK_SIZE]
+
+        # 7 * 255 (and up to 257 layers) fits in uint16
+        sums = np.zeros((len(selected),) + px.shape[1:], dtype=np.uint16)
+        count = np.zeros((len(selected), m.shape[1]), dtype=np.uint16)
+
+        for i in range(len(layers)):
+            rows = selected[:, i]
+            sums[rows] += px[i] * m[i][:, np.newaxis]
+            count[rows] += m[i]
+
+        detected = count > 0
+        blue = sums[..., 0]
+        green = sums[..., 1]
+        red = sums[..., 2]
+        min_red = 60 * count
+
+        valid = (red >= min_red) & (red > green) & (red > blue) & detected
+
+        # Exact ties between overlapping layers: the float average may round
+        # either way, re-check them as the float engine (a single layer is exact)
+        ties = (count > 1) & ((red == green) | (red == blue) | (red == min_red))
+        if ties.any():
+            valid[ties] = _average_valid_float(px, m, selected, ties)
+
+        valid_count += valid.sum(axis=1)
+        total_detected += detected.sum(axis=1)
+
+    return valid_count, total_detected
+
+
+def _average_valid_float(px, m, selected, entries):
+    # valid_color of the float32 average for the (chromosome, pixel) entries given
+    rows, cols = np.nonzero(entries)
+    fusion_color = np.zeros((len(rows), 3), dtype=np.float32)
+    count = np.zeros(len(rows), dtype=int)
+    for i in range(px.shape[0]):
+        sel = selected[rows, i] & m[i, cols]
+        img = px[i, cols[sel]][:, ::-1].astype(np.float32) / 255.0
+        fusion_color[sel] += img
+        count[sel] += 1
+    fusion_color /= count[:, np.newaxis]
+    return valid_color(fusion_color)
+
+
+@lru_cache(maxsize=None)
+def lowest_layer_table(n_layers):
+    """
+    Lowest set bit of each n-bit layer signature: the layer that owns a pixel
+    in priority fusion (-1 if no layer detects it).
+    """
+    signatures = np.arange(2 ** n_layers, dtype=np.int64)
+    lowest = signatures & -signatures
+    table = np.full(len(signatures), -1, dtype=np.int8)
+    table[1:] = np.log2(lowest[1:]).astype(np.int8)
+    return table
+
+
+# Lowest set bit of each 7-bit layer signature
+LOWEST_LAYER = lowest_layer_table(N_LAYERS)
+
+
+def chromosome_codes(chromosomes):
+    """Chromosomes as integers (7 bits), bit i set if layer N{i+1} is selected."""
+    chromosomes = np.atleast_2d(np.asarray(chromosomes, dtype=np.int64))
+    return (chromosomes << np.arange(chromosomes.shape[1])).sum(axis=1)
+
+
+def priority_counts_uint8(patient, chromosomes=ALL_CHROMOSOMES):
+    """
+    Integer version of priority_counts using per-pixel layer signatures.
+
+    The owner of a pixel for chromosome c is LOWEST_LAYER[signature & c], and
+    its color is copied unchanged, so the valid and visible pixels only depend
+    on (signature, owner). Both are counted once per pixel into 128x7 tables,
+    and each chromosome is scored with a reduction over the 128 signatures
+    (2^n x n tables and 2^n signatures for n layers).
+    """
+    selected, layers = _selected_layers(chromosomes)
+    signature = patient.signature_map(layers)
+    detected = signature > 0
+    signature = signature[detected]
+    pixels = patient.raw_stack(layers)[:, detected]
+
+    # Pixels of each signature that are valid / visible if layer i owns them
+    layer_valid = valid_color_uint8(pixels)
+    layer_visible = np.any(pixels > 0, axis=2)
+    lowest_layer = lowest_layer_table(patient.n_layers)
+    n_signatures = len(lowest_layer)
+    valid_table = np.zeros((n_signatures, patient.n_layers), dtype=np.int64)
+    visible_table = np.zeros((n_signatures, patient.n_layers), dtype=np.int64)
+    for k, i in enumerate(layers):
+        # Only the pixels where layer i detects red can be owned by it
+        owned = (signature >> i) & 1 == 1
+        valid_table[:, i] = np.bincount(signature[owned & layer_valid[k]], minlength=n_signatures)
+        visible_table[:, i] = np.bincount(signature[owned & layer_visible[k]], minlength=n_signatures)
+
+    codes = chromosome_codes(np.asarray(chromosomes, dtype=int))
+    owner = lowest_layer[codes[:, np.newaxis] & np.arange(n_signatures)]
+    owned = owner >= 0
+    rows = np.arange(n_signatures)
+    valid_count = np.where(owned, valid_table[rows, owner], 0).sum(axis=1)
+    total_detected = np.where(owned, visible_table[rows, owner], 0).sum(axis=1)
+    return valid_count, total_detected
+
+
+ENGINES = ('float', 'uint8')
+
+COUNT_FUNCTIONS = {
+    ('average', 'float'): average_counts,
+    ('priority', 'float'): priority_counts,
+    ('average', 'uint8'): average_counts_uint8,
+    ('priority', 'uint8'): priority_counts_uint8,
+}
+
+
+# Fusion methods with exhaustive counts (count_function)
+SWEEP_METHODS = ('average', 'priority', 'red_weighted')
+
+
+def count_function(method, engine='float'):
+    """Returns the (valid_count, total_detected) function of a fusion method and engine."""
+    if method == 'red_weighted' and engine in ENGINES:
+        # Exact sums, a single function for every engine. Its module imports this one
+        from objective_function_red_weighted import red_weighted_counts
+        return red_weighted_counts
+    if (method, engine) not in COUNT_FUNCTIONS:
+        raise ValueError(f'Metodo de fusion o motor desconocido: {method}, {engine}')
+    return COUNT_FUNCTIONS[(method, engine)]
+
+
+# Engines of the exhaustive sweeps: the batch engines and the Gray-code walk
+SWEEP_ENGINES = ENGINES + ('gray',)
+
+
+def count_all_chromosomes(patient, methods=('average', 'priority'), engine='float'):
+    """
+    (valid_count, total_detected) of the 127 chromosomes (ALL_CHROMOSOMES order)
+    of a PatientLayers, or of the 2^n - 1 of all_chromosomes(n) for a patient
+    with n layers. `engine` is one of SWEEP_ENGINES; patients with more than
+    7 layers need the 'gray' engine (the batch engines would build 2^n-sized
+    tables per pixel or signature).
+    Returns a dict {method: (valid_count, total_detected)}.
+    """
+    if patient.n_layers == N_LAYERS:
+        chromosomes = ALL_CHROMOSOMES
+    elif patient.n_layers > N_LAYERS and engine != 'gray':
+        raise ValueError(f'El motor {engine} no admite {patient.n_layers} capas, use el motor gray')
+    else:
+        chromosomes = all_chromosomes(patient.n_layers)
+
+    results = {}
+    for method in methods:
+        with profiling.span(f'batch/{method}'):
+            if engine == 'gray':
+                # gray_sweep builds on incremental_evaluation, which imports this module
+                from gray_sweep import gray_counts
+                results[method] = gray_counts(patient, method, chromosomes)
+            else:
+                results[method] = count_function(method, engine)(patient, chromosomes)
+        profiling.count('evaluations', len(chromosomes))
+    return results
+
+
+def evaluate_all_chromosomes(patient, methods=('average', 'priority'), engine='float'):
+    """
+    Scores the 127 chromosomes (ALL_CHROMOSOMES order) of a PatientLayers
+    (see count_all_chromosomes). Returns a dict {method: fitness vector}.
+    """
+    counts = count_all_chromosomes(patient, methods, engine)
+    return {method: fitness_from_counts(*counts[method]) for method in methods}
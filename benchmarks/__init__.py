@@ -0,0 +1,13 @@
+"""
+Benchmarks of the fusion and scoring code.
+
+ - synthetic_cohort.py: writes synthetic N1..N7 mask BMPs for any number of
+   patients and any resolution.
+ - run_benchmarks.py: micro benchmarks (decoding, red detection, objective
+   functions, batched evaluation) and a macro benchmark (general-vector sweep),
+   reported as JSON.
+
+Run from the repository root:
+    python3 -m benchmarks.synthetic_cohort --out bench_data --patients 100
+    python3 -m benchmarks.run_benchmarks --data bench_data --out bench.json
+"""
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Micro and macro benchmarks of the fusion and scoring code.
+
+Micro benchmarks (on a sample of patients):
+ - decode:            cv2.imread of the layer BMPs
+ - red_detection:     float and uint8 versions
+ - objective:         objective_function / objective_function_priority reading
+                      from disk, and from a PatientLayers cache (fitness_only)
+                      with each engine
+ - batch:             evaluate_all_chromosomes with each engine (and the Gray-code sweep)
+ - gray:              Gray-code sweep of all the subsets of synthetic patients
+                      with --gray_layers layers
+Macro benchmark:
+ - sweep:             find_general_vector fitness rows over the whole cohort
+
+Each benchmark runs in a fresh process, so its peak RSS is its own and not the
+high-water mark of the benchmarks run before. Results are written as JSON:
+evaluations per second, MB/s decoded, seconds, the peak RSS of the benchmark
+process and, for the sweep with --workers > 1, the peak RSS of its workers.
+
+Usage (from the repository root):
+    python3 -m benchmarks.run_benchmarks --data bench_data --out bench.json
+    python3 -m benchmarks.run_benchmarks --patients 20 --size 512
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import cv2
+
+from patient_layers import PatientLayers, red_detection, red_detection_uint8, to_float_rgb
+from objective_function import objective_function
+from objective_function_priority import objective_function_priority
+from batch_evaluation import ALL_CHROMOSOMES, ENGINES, SWEEP_ENGINES, evaluate_all_chromosomes
+from gray_sweep import gray_sweep
+from dataset_catalog import get_catalog
+from find_general_vector import patient_fitness_row
+from benchmarks.synthetic_cohort import generate_cohort
+
+OBJECTIVES = {
+    'average': objective_function,
+    'priority': objective_function_priority,
+}
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in KB on Linux and in bytes on macOS. With RUSAGE_CHILDREN,
+    # the largest peak of the finished child processes
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def result(name, seconds, evals=None, decoded_bytes=None, **extra):
+    entry = {'name': name, 'seconds': seconds}
+    if evals is not None:
+        entry['evals'] = evals
+        entry['evals_per_sec'] = evals / seconds if seconds > 0 else None
+    if decoded_bytes is not None:
+        entry['mb_per_sec'] = decoded_bytes / (1024 * 1024) / seconds if seconds > 0 else None
+    entry.update(extra)
+    entry['peak_rss_mb'] = peak_rss_mb()
+    worker_rss = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    if worker_rss > 0:
+        entry['peak_worker_rss_mb'] = worker_rss
+    return entry
+
+
+def isolated(benchmark, *args):
+    """Runs a benchmark function in a fresh (spawned) process and returns its results."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(benchmark, *args).result()
+
+
+def layer_files(catalog, prefixes):
+    files = []
+    for prefix in prefixes:
+        folder = catalog.folder(prefix)
+        files += [os.path.join(folder, f'{prefix}_N{i}_mask.bmp') for i in catalog.layers(prefix, folder)]
+    return files
+
+
+def bench_decode(files):
+    start = time.perf_counter()
+    decoded = 0
+    for filepath in files:
+        decoded += cv2.imread(filepath).nbytes
+    return [result('decode', time.perf_counter() - start, evals=len(files), decoded_bytes=decoded)]
+
+
+def bench_red_detection(files, version):
+    raw = [cv2.imread(filepath) for filepath in files]
+    if version == 'float':
+        images = [to_float_rgb(img) for img in raw]
+        detect = red_detection
+    else:
+        images = raw
+        detect = red_detection_uint8
+
+    start = time.perf_counter()
+    for img in images:
+        detect(img)
+    return [result(f'red_detection/{version}', time.perf_counter() - start, evals=len(images),
+                   decoded_bytes=sum(img.nbytes for img in images))]
+
+
+def bench_objective(image_folder, prefixes, chromosomes, method, engine=None):
+    # engine None: from disk, every call decodes its layers.
+    # Otherwise from a decoded cache, score only
+    catalog = get_catalog(image_folder)
+    objective = OBJECTIVES[method]
+    if engine is None:
+        start = time.perf_counter()
+        for prefix in prefixes:
+            folder = catalog.folder(prefix)
+            for chrom in chromosomes:
+                objective(chrom.copy(), image_folder=folder, prefix=prefix)
+        return [result(f'objective/{method}/disk', time.perf_counter() - start,
+                       evals=len(prefixes) * len(chromosomes))]
+
+    patients = [PatientLayers(catalog.folder(prefix), prefix) for prefix in prefixes]
+    start = time.perf_counter()
+    for patient in patients:
+        for chrom in chromosomes:
+            objective(chrom.copy(), patient=patient, fitness_only=True, engine=engine)
+    return [result(f'objective/{method}/cached/{engine}', time.perf_counter() - start,
+                   evals=len(prefixes) * len(chromosomes))]
+
+
+def bench_batch(image_folder, prefixes, method, engine):
+    catalog = get_catalog(image_folder)
+    patients = [PatientLayers(catalog.folder(prefix), prefix) for prefix in prefixes]
+    start = time.perf_counter()
+    for patient in patients:
+        evaluate_all_chromosomes(patient, methods=(method,), engine=engine)
+    return [result(f'batch/{method}/{engine}', time.perf_counter() - start,
+                   evals=len(patients) * len(ALL_CHROMOSOMES))]
+
+
+def bench_gray(image_folder, prefixes, n_layers, method):
+    # Synthetic patients with n_layers layers, all 2^n - 1 subsets of each
+    catalog = get_catalog(image_folder)
+    patients = [PatientLayers(catalog.folder(prefix), prefix, n_layers=n_layers) for prefix in prefixes]
+    start = time.perf_counter()
+    for patient in patients:
+        gray_sweep(patient, method)
+    return [result(f'gray/{method}/{n_layers}layers', time.perf_counter() - start,
+                   evals=len(patients) * (2 ** n_layers - 1))]
+
+
+def bench_sweep(image_folder, prefixes, workers, engine):
+    start = time.perf_counter()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            rows = list(executor.map(patient_fitness_row, [image_folder] * len(prefixes), prefixes,
+                                     [engine] * len(prefixes)))
+    else:
+        rows = [patient_fitness_row(image_folder, prefix, engine) for prefix in prefixes]
+    seconds = time.perf_counter() - start
+
+    # Every layer file of the cohort is decoded once
+    catalog = get_catalog(image_folder)
+    h, w = PatientLayers(catalog.folder(prefixes[0]), prefixes[0], preload=False).shape
+    decoded = len(layer_files(catalog, prefixes)) * h * w * 3
+    return [result(f'sweep/{engine}/workers{workers}', seconds,
+                   evals=sum(len(row) for row in rows if row is not None),
+                   decoded_bytes=decoded, patients=len(prefixes))]
+
+
+def run(image_folder, sample, n_chromosomes, workers, seed, gray_folder=None, gray_layers=0, size=286):
+    catalog = get_catalog(image_folder)
+    prefixes = catalog.prefixes()
+    rng = np.random.default_rng(seed)
+    sample_prefixes = prefixes[:sample]
+    chromosomes = ALL_CHROMOSOMES[rng.choice(len(ALL_CHROMOSOMES), size=n_chromosomes, replace=False)]
+    files = layer_files(catalog, sample_prefixes)
+
+    benchmarks = [(bench_decode, files)]
+    benchmarks += [(bench_red_detection, files, version) for version in ('float', 'uint8')]
+    for method in OBJECTIVES:
+        benchmarks += [(bench_objective, image_folder, sample_prefixes, chromosomes, method, engine)
+                       for engine in (None,) + ENGINES]
+    benchmarks += [(bench_batch, image_folder, sample_prefixes, method, engine)
+                   for engine in SWEEP_ENGINES for method in OBJECTIVES]
+    if gray_layers:
+        gray_prefixes = generate_cohort(gray_folder, sample, size, seed=seed, n_layers=gray_layers)
+        benchmarks += [(bench_gray, gray_folder, gray_prefixes, gray_layers, method) for method in OBJECTIVES]
+    benchmarks += [(bench_sweep, image_folder, prefixes, workers, engine) for engine in ENGINES]
+
+    results = []
+    for benchmark in benchmarks:
+        results += isolated(*benchmark)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the fusion and scoring code')
+    parser.add_argument('--data', type=str, default=None,
+                        help='Image folder to benchmark (a synthetic cohort is generated if omitted)')
+    parser.add_argument('--patients', type=int, default=20, help='Synthetic patients to generate')
+    parser.add_argument('--size', type=int, default=286, help='Synthetic image side in pixels')
+    parser.add_argument('--sample', type=int, default=5, help='Patients used by the micro benchmarks')
+    parser.add_argument('--chromosomes', type=int, default=20, help='Chromosomes per patient in the objective benchmark')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes for the sweep benchmark')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--gray_layers', type=int, default=12,
+                        help='Layers of the synthetic patients of the Gray-code benchmark (0 to skip it)')
+    parser.add_argument('--out', type=str, default=None, help='JSON output file (stdout if omitted)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_folder = args.data
+        if image_folder is None:
+            image_folder = os.path.join(tmp_dir, 'synthetic')
+            generate_cohort(image_folder, args.patients, args.size, seed=args.seed)
+
+        report = {
+            'machine': {
+                'platform': platform.platform(),
+                'processor': platform.processor(),
+                'cpu_count': os.cpu_count(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'opencv': cv2.__version__,
+            },
+            'config': {
+                'data': args.data or f'synthetic ({args.patients} patients, {args.size}x{args.size})',
+                'sample': args.sample,
+                'chromosomes': args.chromosomes,
+                'workers': args.workers,
+                'seed': args.seed,
+            },
+            'results': run(image_folder, args.sample, args.chromosomes, args.workers, args.seed,
+                           os.path.join(tmp_dir, 'synthetic_gray'), args.gray_layers, args.size),
+        }
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+        print(f'Benchmark report saved: {args.out}')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Synthetic patient generator for the benchmarks.
+
+Each patient gets 7 layers ({prefix}_N1_mask.bmp ... {prefix}_N7_mask.bmp, or
+as many as --layers) that look like the EIM masks: a JET color map of a smooth
+conductivity field inside a disk, over a black background. A few
+high-conductivity blobs (red in the color map) are shared by all layers with a
+depth-dependent intensity, so the layers overlap partially like the real ones.
+
+Patients are written in folders of `per_folder` patients (SYN_B1, SYN_B2, ...),
+the same image_folder/*/*.bmp layout as Images/.
+
+Usage:
+    python3 -m benchmarks.synthetic_cohort --out bench_data --patients 100 --size 286
+"""
+
+import os
+import argparse
+import numpy as np
+import cv2
+
+N_LAYERS = 7
+
+
+def synthetic_layers(rng, size, n_layers=N_LAYERS):
+    """Returns the n_layers BGR uint8 layers of one synthetic patient."""
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    disk = (xx - 0.5) ** 2 + (yy - 0.5) ** 2 <= 0.45 ** 2
+
+    # Background field and blobs shared by every layer
+    n_blobs = rng.integers(1, 5)
+    centers = rng.uniform(0.25, 0.75, size=(n_blobs, 2))
+    widths = rng.uniform(0.03, 0.12, size=n_blobs)
+    background = rng.uniform(0.2, 0.5, size=3)
+
+    layers = []
+    for depth in range(n_layers):
+        field = background[0] + background[1] * xx + background[2] * yy
+        for (cx, cy), width in zip(centers, widths):
+            # Each blob peaks at a random depth
+            strength = np.exp(-((depth - rng.uniform(0, n_layers)) / 3.0) ** 2)
+            field += strength * np.exp(-((xx - cx) ** 2 + (yy - cy) ** 2) / (2 * width ** 2))
+        field += rng.normal(0, 0.02, size=field.shape).astype(np.float32)
+
+        field = np.clip(field / max(field.max(), 1e-6), 0, 1)
+        img = cv2.applyColorMap((field * 255).astype(np.uint8), cv2.COLORMAP_JET)
+        img[~disk] = 0
+        layers.append(img)
+    return layers
+
+
+def generate_cohort(out_dir, n_patients, size=286, per_folder=1000, seed=0, n_layers=N_LAYERS):
+    """
+    Writes n_patients synthetic patients of size x size pixels into out_dir.
+    Returns the list of prefixes.
+    """
+    rng = np.random.default_rng(seed)
+    prefixes = []
+    for p in range(n_patients):
+        folder = os.path.join(out_dir, f'SYN_B{p // per_folder + 1}')
+        os.makedirs(folder, exist_ok=True)
+
+        prefix = f'S{p:06d}{"di"[p % 2]}'
+        for i, img in enumerate(synthetic_layers(rng, size, n_layers)):
+            cv2.imwrite(os.path.join(folder, f'{prefix}_N{i+1}_mask.bmp'), img)
+        prefixes.append(prefix)
+    return prefixes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic cohort of EIM layer masks')
+    parser.add_argument('--out', type=str, required=True, help='Output image folder')
+    parser.add_argument('--patients', type=int, default=50, help='Number of patients')
+    parser.add_argument('--size', type=int, default=286, help='Image side in pixels')
+    parser.add_argument('--per_folder', type=int, default=1000, help='Patients per subfolder')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--layers', type=int, default=N_LAYERS, help='Layers per patient')
+    args = parser.parse_args()
+
+    prefixes = generate_cohort(args.out, args.patients, args.size, args.per_folder, args.seed, args.layers)
+    print(f'Generated {len(prefixes)} patients ({args.size}x{args.size}) in {args.out}')
+
+
+if __name__ == '__main__':
+    main()
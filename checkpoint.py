@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Checkpoints of the long driver runs (main.py, compare_fusion_*.py).
+
+A checkpoint is a folder with:
+ - state.json:        configuration of the run and the results of the
+                      finished tasks (patients), written after each one.
+ - search_{key}.json: best chromosome, fitness and elapsed time of a local
+                      search in progress, written at each improvement and
+                      every SAVE_INTERVAL seconds between them (one file per
+                      search, so worker processes never share one).
+
+With --resume the drivers skip the finished patients and restart interrupted
+searches from their best chromosome with the remaining time. Files are
+replaced atomically, so a crash while saving leaves the previous version.
+
+find_general_vector.py resumes from its results table instead (results_store.py).
+"""
+
+import os
+import json
+import time
+import numpy as np
+
+CHECKPOINT_VERSION = 1
+
+# Seconds between two saves of a search state without improvements, so an
+# interrupted search resumes with little time lost
+SAVE_INTERVAL = 60
+
+
+def _jsonable(value):
+    # numpy values -> JSON types
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _write_json(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(_jsonable(data), f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def search_state_path(directory, key):
+    return os.path.join(directory, f'search_{key.replace(os.sep, "_")}.json')
+
+
+def load_search_state(directory, key):
+    """Saved state of an interrupted search, or None."""
+    if directory is None:
+        return None
+    return _read_json(search_state_path(directory, key))
+
+
+def search_tracker(directory, key, chromosome, time_limit):
+    """
+    Prepares the local search `key`. Returns (chromosome, time_limit, on_improvement):
+    the best chromosome and the remaining time if the search was interrupted
+    (the given ones otherwise), and the callback that saves its state, to be
+    called by the search with (x_best, f_best) at each improvement and with
+    (x_best, f_best, improved=False) after the other evaluations; those calls
+    only save the elapsed time every SAVE_INTERVAL seconds.
+    Without a checkpoint directory nothing is saved.
+    """
+    state = load_search_state(directory, key)
+    elapsed = 0.0
+    if state is not None:
+        chromosome = np.array(state['chromosome'], dtype=int)
+        elapsed = state['elapsed']
+        time_limit = max(time_limit - elapsed, 0)
+        print(f'Resuming search {key} from {chromosome} (fitness {state["fitness"]:.6f}, '
+              f'{elapsed:.0f}s done)')
+
+    start = time.time()
+    last_save = [start]
+
+    def on_improvement(x_best, f_best, improved=True):
+        if directory is None:
+            return
+        now = time.time()
+        if improved or now - last_save[0] >= SAVE_INTERVAL:
+            _write_json(search_state_path(directory, key),
+                        {'chromosome': x_best, 'fitness': f_best, 'elapsed': elapsed + now - start})
+            last_save[0] = now
+
+    return chromosome, time_limit, on_improvement
+
+
+def clear_search_state(directory, key):
+    if directory is not None and os.path.exists(search_state_path(directory, key)):
+        os.remove(search_state_path(directory, key))
+
+
+class Checkpoint:
+    """
+    Finished tasks of a driver run.
+
+    directory: checkpoint folder
+    config: parameters of the run; resuming with different ones is an error
+    resume: load the saved state instead of starting over
+    """
+
+    def __init__(self, directory, config, resume=False):
+        self.directory = directory
+        self.path = os.path.join(directory, 'state.json')
+        config = _jsonable(config)
+        os.makedirs(directory, exist_ok=True)
+
+        saved = _read_json(self.path) if resume else None
+        if saved is not None:
+            if saved.get('version') != CHECKPOINT_VERSION or saved['config'] != config:
+                raise ValueError(f'El checkpoint {self.path} es de otra configuracion: {saved["config"]}')
+            self.completed = saved['completed']
+            print(f'Resuming from {self.path}: {len(self.completed)} tasks already completed')
+        else:
+            if resume:
+                print(f'No checkpoint found in {directory}, starting from scratch')
+            else:
+                # A new run: forget the searches of a previous one
+                for name in os.listdir(directory):
+                    if name.startswith('search_'):
+                        os.remove(os.path.join(directory, name))
+            self.completed = {}
+        self.config = config
+        self._save()
+
+    def _save(self):
+        _write_json(self.path, {'version': CHECKPOINT_VERSION, 'config': self.config, 'completed': self.completed})
+
+    def is_done(self, key):
+        return key in self.completed
+
+    def result(self, key):
+        return self.completed[key]
+
+    def complete(self, key, result, searches=()):
+        """Saves the result of a finished task and drops the states of its searches."""
+        self.completed[key] = _jsonable(result)
+        self._save()
+        for search_key in searches:
+            clear_search_state(self.directory, search_key)
+
+    def search(self, key, chromosome, time_limit):
+        """search_tracker for a search of this run."""
+        return search_tracker(self.directory, key, chromosome, time_limit)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Packed cohort format: all the layers of an image folder in one memory-mapped file.
+
+`pack` converts image_folder/*/{prefix}_N#_mask.bmp into a folder with:
+ - layers.npy:     (patients, 7, H, W, 3) uint8, BGR as decoded by OpenCV
+                   (missing layers are zeros)
+ - signatures.npy: (patients, H, W) uint8 red-mask bitplanes, bit i set if
+                   layer N{i+1} detects red at the pixel
+ - present.npy:    (patients, 7) bool, which layer files exist
+ - index.json:     prefix table (prefix -> row) and source folders
+
+`PackedCohort` opens the arrays with np.memmap, and `PackedCohort.patient(prefix)`
+returns a PatientLayers that the objective functions accept as `patient=`,
+reading the layers without copies.
+
+Usage:
+    python3 cohort_pack.py pack --image_folder Images --out Images.pack
+    python3 cohort_pack.py info --pack Images.pack
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+import cv2
+
+from patient_layers import N_LAYERS, PatientLayers, red_detection_uint8
+from dataset_catalog import get_catalog
+
+PACK_VERSION = 1
+
+
+def pack_cohort(image_folder, out_dir):
+    """
+    Packs every patient of image_folder (with an N7 layer) into out_dir.
+    Returns the number of packed patients.
+    """
+    catalog = get_catalog(image_folder)
+
+    # Patients with a reference layer N7, in prefix order
+    patients = []
+    for prefix in catalog.prefixes():
+        folder = catalog.folder(prefix)
+        if N_LAYERS not in catalog.layers(prefix, folder):
+            print(f'Imagen base N7 no encontrada para {prefix}, se omite')
+            continue
+        patients.append((prefix, folder))
+
+    if not patients:
+        raise ValueError(f'No hay pacientes para empaquetar en {image_folder}')
+
+    first_prefix, first_folder = patients[0]
+    h, w = cv2.imread(os.path.join(first_folder, f'{first_prefix}_N{N_LAYERS}_mask.bmp')).shape[:2]
+
+    os.makedirs(out_dir, exist_ok=True)
+    layers = np.lib.format.open_memmap(os.path.join(out_dir, 'layers.npy'), mode='w+',
+                                       dtype=np.uint8, shape=(len(patients), N_LAYERS, h, w, 3))
+    signatures = np.lib.format.open_memmap(os.path.join(out_dir, 'signatures.npy'), mode='w+',
+                                           dtype=np.uint8, shape=(len(patients), h, w))
+    present = np.zeros((len(patients), N_LAYERS), dtype=bool)
+
+    for p, (prefix, folder) in enumerate(patients):
+        signature = np.zeros((h, w), dtype=np.uint8)
+        for i in range(N_LAYERS):
+            filepath = os.path.join(folder, f'{prefix}_N{i+1}_mask.bmp')
+            if not os.path.exists(filepath):
+                continue
+            img = cv2.imread(filepath)
+            if img.shape[:2] != (h, w):
+                raise ValueError(f'{filepath} mide {img.shape[:2]}, se esperaba {(h, w)}')
+            layers[p, i] = img
+            signature |= red_detection_uint8(img).astype(np.uint8) << i
+            present[p, i] = True
+        signatures[p] = signature
+
+    layers.flush()
+    signatures.flush()
+    np.save(os.path.join(out_dir, 'present.npy'), present)
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump({'version': PACK_VERSION,
+                   'image_folder': image_folder,
+                   'prefixes': [prefix for prefix, _ in patients],
+                   'folders': [folder for _, folder in patients]}, f, indent=1)
+
+    return len(patients)
+
+
+class PackedCohort:
+    """
+    Read-only, memory-mapped view of a packed cohort.
+    """
+
+    def __init__(self, pack_dir):
+        self.pack_dir = pack_dir
+        with open(os.path.join(pack_dir, 'index.json')) as f:
+            index = json.load(f)
+        if index.get('version') != PACK_VERSION:
+            raise ValueError(f'Version de paquete no soportada en {pack_dir}')
+
+        self.prefixes = index['prefixes']
+        self.folders = index['folders']
+        self.rows = {prefix: row for row, prefix in enumerate(self.prefixes)}
+
+        self.layers = np.load(os.path.join(pack_dir, 'layers.npy'), mmap_mode='r')
+        self.signatures = np.load(os.path.join(pack_dir, 'signatures.npy'), mmap_mode='r')
+        self.present = np.load(os.path.join(pack_dir, 'present.npy'))
+
+    def __contains__(self, prefix):
+        return prefix in self.rows
+
+    def patient(self, prefix):
+        """PatientLayers of one patient backed by the memory-mapped arrays."""
+        if prefix not in self.rows:
+            raise FileNotFoundError(f'Paciente {prefix} no encontrado en {self.pack_dir}')
+        return PackedPatientLayers(self, self.rows[prefix])
+
+
+class PackedPatientLayers(PatientLayers):
+    """
+    PatientLayers whose layers are views of a PackedCohort (no decoding) and
+    whose red masks come from the precomputed bitplanes.
+    """
+
+    def __init__(self, cohort, row):
+        self.cohort = cohort
+        self.row = row
+        self.prefix = cohort.prefixes[row]
+        self.image_folder = cohort.folders[row]
+        self._init_cache()
+
+    def layer_path(self, i):
+        return f'{self.cohort.pack_dir}[{self.prefix}_N{i+1}]'
+
+    def _load(self, i):
+        if self._loaded[i]:
+            return
+        if self.cohort.present[self.row, i]:
+            self._raw[i] = self.cohort.layers[self.row, i]
+            self._masks[i] = (self.cohort.signatures[self.row] >> i) & 1 == 1
+        self._loaded[i] = True
+
+    def raw_stack(self, layers=None):
+        # Missing layers are already zeros in the pack
+        if layers is None or list(layers) == list(range(N_LAYERS)):
+            return self.cohort.layers[self.row]
+        return self.cohort.layers[self.row, list(layers)]
+
+    def mask_stack(self, layers=None):
+        if layers is None:
+            layers = range(N_LAYERS)
+        bits = np.asarray(list(layers), dtype=np.uint8)[:, np.newaxis, np.newaxis]
+        return (self.cohort.signatures[self.row] >> bits) & 1 == 1
+
+    def signature_map(self, layers=None):
+        # The bitplanes are already the signatures
+        signature = np.asarray(self.cohort.signatures[self.row])
+        if layers is None or set(layers) == set(range(N_LAYERS)):
+            return signature
+        return signature & np.uint8(sum(1 << i for i in set(layers)))
+
+
+# PackedCohort of each pack folder, opened once per process
+_COHORTS = {}
+
+
+def get_cohort(pack_dir):
+    """PackedCohort of pack_dir, opened once per process (index and arrays are reused)."""
+    key = (os.path.abspath(pack_dir), os.getpid())
+    if key not in _COHORTS:
+        _COHORTS[key] = PackedCohort(pack_dir)
+    return _COHORTS[key]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack a cohort of layer images into memory-mapped arrays')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    pack_parser = subparsers.add_parser('pack', help='Pack image_folder/*/*.bmp')
+    pack_parser.add_argument('--image_folder', type=str, default='Images', help='Base folder containing patient images')
+    pack_parser.add_argument('--out', type=str, default='Images.pack', help='Output folder of the packed cohort')
+
+    info_parser = subparsers.add_parser('info', help='Describe a packed cohort')
+    info_parser.add_argument('--pack', type=str, default='Images.pack', help='Folder of the packed cohort')
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        n = pack_cohort(args.image_folder, args.out)
+        print(f'Packed {n} patients into {args.out}')
+    else:
+        cohort = PackedCohort(args.pack)
+        print(f'Patients: {len(cohort.prefixes)}')
+        print(f'Layers: {cohort.layers.shape} {cohort.layers.dtype}')
+        print(f'Missing layers: {int((~cohort.present).sum())}')
+
+
+if __name__ == '__main__':
+    main()
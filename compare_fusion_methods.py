@@ -9,7 +9,6 @@ Results are saved to:
 """
 
 import os
-import glob
 import random
 import numpy as np
 import time
@@ -17,51 +16,19 @@ from datetime import datetime
 
 from objective_function_priority import objective_function_priority
 from objective_function import objective_function
-from utils_matlab_io import save_chromosome_mat, load_chromosome_mat
+from dataset_catalog import find_patient_folder
+from patient_split import get_validation_patients
+from patient_layers import PatientLayers
+from fitness_memo import FitnessMemo
+from utils_matlab_io import load_chromosome_mat
+from artifact_writer import ArtifactWriter, raise_write_errors
+from checkpoint import Checkpoint
+from fitness_store import get_store, DEFAULT_STORE_PATH
+import profiling
 
 
-def get_all_prefixes(image_folder):
-    # Scans the image_folder to find all unique patient prefixes
-    prefixes = set()
-    search_path = os.path.join(image_folder, '*', '*.bmp')
-    files = glob.glob(search_path)
-    
-    for file_path in files:
-        filename = os.path.basename(file_path)
-        parts = filename.split('_')
-        if len(parts) >= 1:
-            prefixes.add(parts[0])
-            
-    return sorted(list(prefixes))
-
-
-def get_validation_patients(image_folder):
-    # Returns the 15 validation patients using the same logic as main.py
-    all_prefixes = get_all_prefixes(image_folder)
-    total_patients = len(all_prefixes)
-    
-    if total_patients < 35:
-        print("Warning: Less than 35 patients found. Using all available as validation.")
-        return all_prefixes
-        
-    random.seed(42)  # Must match find_general_vector.py
-    random.shuffle(all_prefixes)
-    
-    # First 35 are training, last 15 are validation
-    val_prefixes = all_prefixes[35:]
-    return val_prefixes
-
-
-def find_patient_folder(base_folder, prefix):
-    """Finds the subfolder containing images for the given patient prefix."""
-    for subdir in glob.glob(os.path.join(base_folder, '*')):
-        if os.path.isdir(subdir):
-            if glob.glob(os.path.join(subdir, f'{prefix}_*.bmp')):
-                return subdir
-    return None
-
-
-def single_swap_custom(chromosome, image_folder, prefix, objective_func, time_limit=1800):
+def single_swap_custom(chromosome, image_folder, prefix, objective_func, time_limit=1800, memo=None,
+                       on_improvement=None):
     """
     Local search
     Args:
@@ -70,12 +37,20 @@ def single_swap_custom(chromosome, image_folder, prefix, objective_func, time_li
         prefix: Patient prefix
         objective_func: Objective function to use (priority or average)
         time_limit: Time limit in seconds
+        memo: FitnessMemo of the patient for objective_func (created if not given)
+        on_improvement: called with (x_best, f_best) at the start and after each improvement,
+            and with improved=False after the other evaluations
     """
     start_ls = time.time()
+
+    if memo is None:
+        memo = FitnessMemo(objective_func, PatientLayers(image_folder, prefix, preload=False))
     
     # Best so far
     x_best = chromosome.copy()
-    f_best, _ = objective_func(x_best, image_folder=image_folder, prefix=prefix)
+    f_best = memo(x_best)
+    if on_improvement is not None:
+        on_improvement(x_best, f_best)
 
     mejora = True
     n = len(chromosome)
@@ -92,20 +67,25 @@ def single_swap_custom(chromosome, image_folder, prefix, objective_func, time_li
                 if time.time() - start_ls > time_limit:
                     break
 
-                f_temp, _ = objective_func(x_temp, image_folder=image_folder, prefix=prefix)
+                f_temp = memo(x_temp)
                 
                 if f_temp > f_best:
                     x_best = x_temp.copy()
                     f_best = f_temp
                     mejora = True
+                    if on_improvement is not None:
+                        on_improvement(x_best, f_best)
 
                     indices = random.sample(list(range(i + 1, n)) + list(range(0, i)), n - 1)
                     break
+                elif on_improvement is not None:
+                    on_improvement(x_best, f_best, improved=False)
 
     return x_best, f_best
 
 
-def run_comparison(image_folder, initial_vector_path, time_limit, out_base_dir):
+def run_comparison(image_folder, initial_vector_path, time_limit, out_base_dir, resume=False,
+                   fitness_store=None):
    
     print("=" * 80)
     print("FUSION METHOD COMPARISON: Priority vs Average")
@@ -126,8 +106,20 @@ def run_comparison(image_folder, initial_vector_path, time_limit, out_base_dir):
     os.makedirs(priority_dir, exist_ok=True)
     os.makedirs(average_dir, exist_ok=True)
     
+    # Finished patients and interrupted searches, to continue with --resume
+    checkpoint = Checkpoint(os.path.join(out_base_dir, 'checkpoint'),
+                            {'image_folder': image_folder, 'initial_vector': initial_vector_path,
+                             'time_limit': time_limit, 'patients': val_patients},
+                            resume)
+    
+    # Fitness values shared with previous runs and the other scripts
+    store = get_store(fitness_store)
+    
     results = []
     
+    # .mat and PNG files are written in the background while the next patient runs
+    writer = ArtifactWriter()
+    
     for i, patient in enumerate(val_patients, 1):
         print(f"\n{'=' * 80}")
         print(f"[{i}/{len(val_patients)}] Processing patient: {patient}")
@@ -140,17 +132,34 @@ def run_comparison(image_folder, initial_vector_path, time_limit, out_base_dir):
             
         print(f"Located in: {patient_folder}")
         
+        if checkpoint.is_done(patient):
+            print("Already completed (checkpoint), skipped")
+            result = checkpoint.result(patient)
+            result['chrom_priority'] = np.array(result['chrom_priority'])
+            result['chrom_average'] = np.array(result['chrom_average'])
+            results.append(result)
+            continue
+        
+        # Layers decoded once for both methods, one memo table per method
+        patient_layers = PatientLayers(patient_folder, patient, preload=False)
+        memo_priority = FitnessMemo(objective_function_priority, patient_layers, store=store)
+        memo_average = FitnessMemo(objective_function, patient_layers, store=store)
+        
         # PRIORITY FUSION
         print(f"\n--- Running with PRIORITY fusion ---")
         start_time = time.time()
         
-        best_priority, fitness_priority = single_swap_custom(
-            initial_chrom.copy(), 
-            patient_folder, 
-            patient, 
-            objective_function_priority,
-            time_limit
-        )
+        start_chrom, remaining_time, on_improvement = checkpoint.search(f'{patient}_priority', initial_chrom.copy(), time_limit)
+        with profiling.span('search/priority'):
+            best_priority, fitness_priority = single_swap_custom(
+                start_chrom, 
+                patient_folder, 
+                patient, 
+                objective_function_priority,
+                remaining_time,
+                memo=memo_priority,
+                on_improvement=on_improvement
+            )
         
         priority_time = time.time() - start_time
         
@@ -158,36 +167,40 @@ def run_comparison(image_folder, initial_vector_path, time_limit, out_base_dir):
         chrom_path_p = os.path.join(priority_dir, f'best_chrom_{patient}_{timestamp}.mat')
         img_path_p = os.path.join(priority_dir, f'best_img_{patient}_{timestamp}.png')
         
-        save_chromosome_mat(best_priority, chrom_path_p)
-        _, _ = objective_function_priority(best_priority, image_folder=patient_folder, 
-                                          prefix=patient, save_path=img_path_p)
+        writer.save_mat(best_priority, chrom_path_p)
+        writer.save_png(objective_function_priority(best_priority, patient=patient_layers), img_path_p)
         
         print(f"Priority - Fitness: {fitness_priority:.6f}, Time: {priority_time:.2f}s")
         print(f"Priority - Chromosome: {best_priority}")
+        print(f"Priority - Fitness cache: {memo_priority.report()}")
         
         # AVERAGE FUSION
         print(f"\n--- Running with AVERAGE fusion ---")
         start_time = time.time()
         
-        best_average, fitness_average = single_swap_custom(
-            initial_chrom.copy(), 
-            patient_folder, 
-            patient, 
-            objective_function,
-            time_limit
-        )
+        start_chrom, remaining_time, on_improvement = checkpoint.search(f'{patient}_average', initial_chrom.copy(), time_limit)
+        with profiling.span('search/average'):
+            best_average, fitness_average = single_swap_custom(
+                start_chrom, 
+                patient_folder, 
+                patient, 
+                objective_function,
+                remaining_time,
+                memo=memo_average,
+                on_improvement=on_improvement
+            )
         
         average_time = time.time() - start_time
         
         chrom_path_a = os.path.join(average_dir, f'best_chrom_{patient}_{timestamp}.mat')
         img_path_a = os.path.join(average_dir, f'best_img_{patient}_{timestamp}.png')
         
-        save_chromosome_mat(best_average, chrom_path_a)
-        _, _ = objective_function(best_average, image_folder=patient_folder, 
-                                 prefix=patient, save_path=img_path_a)
+        writer.save_mat(best_average, chrom_path_a)
+        writer.save_png(objective_function(best_average, patient=patient_layers), img_path_a)
         
         print(f"Average - Fitness: {fitness_average:.6f}, Time: {average_time:.2f}s")
         print(f"Average - Chromosome: {best_average}")
+        print(f"Average - Fitness cache: {memo_average.report()}")
         
         diff = fitness_priority - fitness_average
         winner = "PRIORITY" if diff > 0 else ("AVERAGE" if diff < 0 else "TIE")
@@ -201,8 +214,15 @@ def run_comparison(image_folder, initial_vector_path, time_limit, out_base_dir):
             'chrom_average': best_average,
             'time_priority': priority_time,
             'time_average': average_time,
+            'cache_priority': memo_priority.report(),
+            'cache_average': memo_average.report(),
             'winner': winner
         })
+        # The patient is checkpointed once its files are written
+        raise_write_errors(writer.flush())
+        checkpoint.complete(patient, results[-1], searches=(f'{patient}_priority', f'{patient}_average'))
+    
+    raise_write_errors(writer.close())
     
     print(f"\n{'=' * 80}")
     print("COMPARISON SUMMARY")
@@ -231,7 +251,8 @@ def run_comparison(image_folder, initial_vector_path, time_limit, out_base_dir):
             f.write(f"  Priority: {r['fitness_priority']:.6f} | {r['chrom_priority']}\n")
             f.write(f"  Average:  {r['fitness_average']:.6f} | {r['chrom_average']}\n")
             f.write(f"  Winner:   {r['winner']} (Δ = {r['fitness_priority'] - r['fitness_average']:+.6f})\n")
-            f.write(f"  Time:     Priority {r['time_priority']:.2f}s, Average {r['time_average']:.2f}s\n\n")
+            f.write(f"  Time:     Priority {r['time_priority']:.2f}s, Average {r['time_average']:.2f}s\n")
+            f.write(f"  Cache:    Priority {r['cache_priority']}, Average {r['cache_average']}\n\n")
             
             if r['winner'] == 'PRIORITY':
                 priority_wins += 1
@@ -277,9 +298,23 @@ def main():
                        help='Time limit in seconds per patient per method')
     parser.add_argument('--out_dir', type=str, default='results_comparison',
                        help='Output directory for comparison results')
+    parser.add_argument('--resume', action='store_true',
+                       help='Continue an interrupted run from the checkpoint in out_dir')
+    parser.add_argument('--fitness_store', type=str, default=DEFAULT_STORE_PATH,
+                       help="Persistent fitness store shared with other runs ('' to disable)")
+    parser.add_argument('--profile', action='store_true',
+                       help='Save a PROFILE_*.json report of the run in out_dir')
     args = parser.parse_args()
     
-    run_comparison(args.image_folder, args.initial_vector, args.time_limit, args.out_dir)
+    if args.profile:
+        profiling.enable()
+    
+    run_comparison(args.image_folder, args.initial_vector, args.time_limit, args.out_dir, args.resume,
+                   args.fitness_store)
+    
+    if args.profile:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        profiling.write_report(os.path.join(args.out_dir, f'PROFILE_COMPARISON_{timestamp}.json'))
 
 
 if __name__ == '__main__':
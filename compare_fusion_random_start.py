@@ -7,62 +7,36 @@ Difference with compare_fusion_methods.py:
 - compare_fusion_methods.py: Uses the general vector as the starting point
 - compare_fusion_random_start.py: Uses random vectors as the starting point
 
+With --starts K, each patient and method is searched from K random vectors
+(multi-start), all the searches of the run spread over --workers processes.
+The starts of a patient and method share one table of evaluated chromosomes
+(fitness_memo.SharedFitnessTable), so no chromosome is scored twice, and they
+stop when the --time_budget of the run is spent or when all the 127
+chromosomes of their table have been scored. The result of a patient and
+method is the best of its starts.
+
 Results are saved to:
 - results_comparison_random/priority/
 - results_comparison_random/average/
 """
 
 import os
-import glob
 import random
 import numpy as np
 import time
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 from objective_function_priority import objective_function_priority
 from objective_function import objective_function
-from utils_matlab_io import save_chromosome_mat
-
-
-def get_all_prefixes(image_folder):
-    # 
-    prefixes = set()
-    search_path = os.path.join(image_folder, '*', '*.bmp')
-    files = glob.glob(search_path)
-    
-    for file_path in files:
-        filename = os.path.basename(file_path)
-        parts = filename.split('_')
-        if len(parts) >= 1:
-            prefixes.add(parts[0])
-            
-    return sorted(list(prefixes))
-
-
-def get_validation_patients(image_folder):
-    # Returns the 15 validation patients using the same logic as main.py
-    all_prefixes = get_all_prefixes(image_folder)
-    total_patients = len(all_prefixes)
-    
-    if total_patients < 35:
-        print("Warning: Less than 35 patients found. Using all available as validation.")
-        return all_prefixes
-        
-    random.seed(42)  # Must match find_general_vector.py
-    random.shuffle(all_prefixes)
-    
-    # First 35 are training, last 15 are validation
-    val_prefixes = all_prefixes[35:]
-    return val_prefixes
-
-
-def find_patient_folder(base_folder, prefix):
-    """Finds the subfolder containing images for the given patient prefix."""
-    for subdir in glob.glob(os.path.join(base_folder, '*')):
-        if os.path.isdir(subdir):
-            if glob.glob(os.path.join(subdir, f'{prefix}_*.bmp')):
-                return subdir
-    return None
+from dataset_catalog import find_patient_folder
+from patient_split import get_validation_patients
+from patient_layers import PatientLayers
+from fitness_memo import FitnessMemo, SharedFitnessTable
+from artifact_writer import ArtifactWriter, raise_write_errors
+from checkpoint import Checkpoint
+from fitness_store import get_store, DEFAULT_STORE_PATH
+import profiling
 
 
 def random_initial_chromosome():
@@ -74,7 +48,12 @@ def random_initial_chromosome():
     return chrom
 
 
-def single_swap_custom(chromosome, image_folder, prefix, objective_func, time_limit=1800):
+# Objective function of each compared method
+METHODS = {'priority': objective_function_priority, 'average': objective_function}
+
+
+def single_swap_custom(chromosome, image_folder, prefix, objective_func, time_limit=1800, memo=None,
+                       on_improvement=None, stop=None):
     """
     Local search
     Args:
@@ -83,12 +62,21 @@ def single_swap_custom(chromosome, image_folder, prefix, objective_func, time_li
         prefix: Patient prefix
         objective_func: Objective function to use (priority or average)
         time_limit: Time limit in seconds
+        memo: FitnessMemo of the patient for objective_func (created if not given)
+        on_improvement: called with (x_best, f_best) at the start and after each improvement,
+            and with improved=False after the other evaluations
+        stop: called before each evaluation, the search ends when it returns True
     """
     start_ls = time.time()
+
+    if memo is None:
+        memo = FitnessMemo(objective_func, PatientLayers(image_folder, prefix, preload=False))
     
     # Best so far
     x_best = chromosome.copy()
-    f_best, _ = objective_func(x_best, image_folder=image_folder, prefix=prefix)
+    f_best = memo(x_best)
+    if on_improvement is not None:
+        on_improvement(x_best, f_best)
 
     mejora = True
     n = len(chromosome)
@@ -102,23 +90,135 @@ def single_swap_custom(chromosome, image_folder, prefix, objective_func, time_li
             x_temp[i] = 1 - x_best[i]
 
             if np.sum(x_temp) > 0:
-                if time.time() - start_ls > time_limit:
+                if time.time() - start_ls > time_limit or (stop is not None and stop()):
                     break
 
-                f_temp, _ = objective_func(x_temp, image_folder=image_folder, prefix=prefix)
+                f_temp = memo(x_temp)
                 
                 if f_temp > f_best:
                     x_best = x_temp.copy()
                     f_best = f_temp
                     mejora = True
+                    if on_improvement is not None:
+                        on_improvement(x_best, f_best)
 
                     indices = random.sample(list(range(i + 1, n)) + list(range(0, i)), n - 1)
                     break
+                elif on_improvement is not None:
+                    on_improvement(x_best, f_best, improved=False)
 
     return x_best, f_best
 
 
-def run_comparison_random(image_folder, time_limit, out_base_dir, random_seed=None):
+# Shared fitness tables of a multi-start run, and the patients and memo
+# tables of this process (set in each worker by _init_worker)
+_SHARED = None
+_PATIENTS = {}
+_MEMOS = {}
+
+
+def _init_worker(shared):
+    global _SHARED
+    _SHARED = shared
+
+
+def run_start(table, patient_folder, patient, method, initial_chrom, time_limit, deadline=None, seed=None,
+              fitness_store=None):
+    """
+    One start of a multi-start run: local search of `method` from initial_chrom,
+    with the chromosomes of table `table` of the shared fitness tables. The
+    search stops at time_limit, at the global deadline (time.time() value) or
+    when every chromosome of the table has been scored.
+    Runs in the worker processes when --workers > 1; `seed` reseeds the random
+    module (the order of the flips) of the search.
+    Returns (best chromosome, fitness, elapsed seconds).
+    """
+    if seed is not None:
+        random.seed(seed)
+    if (patient_folder, patient) not in _PATIENTS:
+        _PATIENTS[(patient_folder, patient)] = PatientLayers(patient_folder, patient, preload=False)
+    if (patient_folder, patient, method) not in _MEMOS:
+        _MEMOS[(patient_folder, patient, method)] = FitnessMemo(METHODS[method], _PATIENTS[(patient_folder, patient)],
+                                                                store=get_store(fitness_store))
+
+    def stop():
+        return _SHARED.covered(table) or (deadline is not None and time.time() > deadline)
+
+    start_time = time.time()
+    with profiling.span(f'search/{method}'):
+        best, fitness = single_swap_custom(initial_chrom, patient_folder, patient, METHODS[method], time_limit,
+                                           memo=_SHARED.memo(table, _MEMOS[(patient_folder, patient, method)]),
+                                           stop=stop)
+    return best, fitness, time.time() - start_time
+
+
+def write_summary(results, out_base_dir, random_seed, time_limit, val_patients, starts=1):
+    """Writes COMPARISON_SUMMARY_RANDOM_*.txt and prints the number of wins of each method."""
+    print(f"\n{'=' * 80}")
+    print("COMPARISON SUMMARY")
+    print(f"{'=' * 80}\n")
+    
+    summary_path = os.path.join(out_base_dir, f'COMPARISON_SUMMARY_RANDOM_{datetime.now().strftime("%Y%m%d_%H%M%S")}.txt')
+    
+    with open(summary_path, 'w') as f:
+        f.write("=" * 80 + "\n")
+        f.write("FUSION METHOD COMPARISON RESULTS (RANDOM START)\n")
+        f.write("=" * 80 + "\n\n")
+        f.write(f"Random Seed: {random_seed if random_seed is not None else 'None (system time)'}\n")
+        f.write(f"Time Limit: {time_limit}s per patient\n")
+        if starts > 1:
+            f.write(f"Random Starts: {starts} per patient and method\n")
+        f.write(f"Validation Patients: {val_patients}\n\n")
+        
+        f.write("=" * 80 + "\n")
+        f.write("DETAILED RESULTS\n")
+        f.write("=" * 80 + "\n\n")
+        
+        priority_wins = 0
+        average_wins = 0
+        ties = 0
+        
+        for r in results:
+            f.write(f"Patient: {r['patient']}\n")
+            f.write(f"  Initial:  {r['initial_chrom']}\n")
+            f.write(f"  Priority: {r['fitness_priority']:.6f} | {r['chrom_priority']}\n")
+            f.write(f"  Average:  {r['fitness_average']:.6f} | {r['chrom_average']}\n")
+            f.write(f"  Winner:   {r['winner']} (Δ = {r['fitness_priority'] - r['fitness_average']:+.6f})\n")
+            f.write(f"  Time:     Priority {r['time_priority']:.2f}s, Average {r['time_average']:.2f}s\n")
+            f.write(f"  Cache:    Priority {r['cache_priority']}, Average {r['cache_average']}\n\n")
+            
+            if r['winner'] == 'PRIORITY':
+                priority_wins += 1
+            elif r['winner'] == 'AVERAGE':
+                average_wins += 1
+            else:
+                ties += 1
+        
+        # Statistics
+        fitness_p = [r['fitness_priority'] for r in results]
+        fitness_a = [r['fitness_average'] for r in results]
+        
+        f.write("=" * 80 + "\n")
+        f.write("STATISTICAL SUMMARY\n")
+        f.write("=" * 80 + "\n\n")
+        f.write(f"Total Patients: {len(results)}\n\n")
+        f.write(f"Wins:\n")
+        f.write(f"  Priority: {priority_wins} ({priority_wins/len(results)*100:.1f}%)\n")
+        f.write(f"  Average:  {average_wins} ({average_wins/len(results)*100:.1f}%)\n")
+        f.write(f"  Ties:     {ties} ({ties/len(results)*100:.1f}%)\n\n")
+        f.write(f"Fitness Statistics:\n")
+        f.write(f"  Priority - Mean: {np.mean(fitness_p):.6f}, Std: {np.std(fitness_p):.6f}\n")
+        f.write(f"  Average  - Mean: {np.mean(fitness_a):.6f}, Std: {np.std(fitness_a):.6f}\n")
+        f.write(f"  Difference Mean: {np.mean(fitness_p) - np.mean(fitness_a):+.6f}\n")
+    
+    print(f"Summary saved to: {summary_path}")
+    print(f"\nPriority Wins: {priority_wins}/{len(results)}")
+    print(f"Average Wins:  {average_wins}/{len(results)}")
+    print(f"Ties:          {ties}/{len(results)}")
+
+
+def run_comparison_random(image_folder, time_limit, out_base_dir, random_seed=None, resume=False,
+                          fitness_store=None):
     
     print("=" * 80)
     print("FUSION METHOD COMPARISON: Priority vs Average (RANDOM START)")
@@ -142,8 +242,20 @@ def run_comparison_random(image_folder, time_limit, out_base_dir, random_seed=No
     os.makedirs(priority_dir, exist_ok=True)
     os.makedirs(average_dir, exist_ok=True)
     
+    # Finished patients and interrupted searches, to continue with --resume
+    checkpoint = Checkpoint(os.path.join(out_base_dir, 'checkpoint'),
+                            {'image_folder': image_folder, 'time_limit': time_limit,
+                             'random_seed': random_seed, 'patients': val_patients},
+                            resume)
+    
+    # Fitness values shared with previous runs and the other scripts
+    store = get_store(fitness_store)
+    
     results = []
     
+    # .mat and PNG files are written in the background while the next patient runs
+    writer = ArtifactWriter()
+    
     for i, patient in enumerate(val_patients, 1):
         print(f"\n{'=' * 80}")
         print(f"[{i}/{len(val_patients)}] Processing patient: {patient}")
@@ -156,21 +268,39 @@ def run_comparison_random(image_folder, time_limit, out_base_dir, random_seed=No
             
         print(f"Located in: {patient_folder}")
         
+        if checkpoint.is_done(patient):
+            print("Already completed (checkpoint), skipped")
+            result = checkpoint.result(patient)
+            result['initial_chrom'] = np.array(result['initial_chrom'])
+            result['chrom_priority'] = np.array(result['chrom_priority'])
+            result['chrom_average'] = np.array(result['chrom_average'])
+            results.append(result)
+            continue
+        
         # Generate random initial vector (SAME for both methods)
         initial_chrom = random_initial_chromosome()
         print(f"\nRandom Initial Vector: {initial_chrom}")
         
+        # Layers decoded once for both methods, one memo table per method
+        patient_layers = PatientLayers(patient_folder, patient, preload=False)
+        memo_priority = FitnessMemo(objective_function_priority, patient_layers, store=store)
+        memo_average = FitnessMemo(objective_function, patient_layers, store=store)
+        
         # PRIORITY FUSION 
         print(f"\n--- Running with PRIORITY fusion ---")
         start_time = time.time()
         
-        best_priority, fitness_priority = single_swap_custom(
-            initial_chrom.copy(), 
-            patient_folder, 
-            patient, 
-            objective_function_priority,
-            time_limit
-        )
+        start_chrom, remaining_time, on_improvement = checkpoint.search(f'{patient}_priority', initial_chrom.copy(), time_limit)
+        with profiling.span('search/priority'):
+            best_priority, fitness_priority = single_swap_custom(
+                start_chrom, 
+                patient_folder, 
+                patient, 
+                objective_function_priority,
+                remaining_time,
+                memo=memo_priority,
+                on_improvement=on_improvement
+            )
         
         priority_time = time.time() - start_time
         
@@ -178,36 +308,40 @@ def run_comparison_random(image_folder, time_limit, out_base_dir, random_seed=No
         chrom_path_p = os.path.join(priority_dir, f'best_chrom_{patient}_{timestamp}.mat')
         img_path_p = os.path.join(priority_dir, f'best_img_{patient}_{timestamp}.png')
         
-        save_chromosome_mat(best_priority, chrom_path_p)
-        _, _ = objective_function_priority(best_priority, image_folder=patient_folder, 
-                                          prefix=patient, save_path=img_path_p)
+        writer.save_mat(best_priority, chrom_path_p)
+        writer.save_png(objective_function_priority(best_priority, patient=patient_layers), img_path_p)
         
         print(f"Priority - Fitness: {fitness_priority:.6f}, Time: {priority_time:.2f}s")
         print(f"Priority - Chromosome: {best_priority}")
+        print(f"Priority - Fitness cache: {memo_priority.report()}")
         
         # AVERAGE FUSION
         print(f"\n--- Running with AVERAGE fusion ---")
         start_time = time.time()
         
-        best_average, fitness_average = single_swap_custom(
-            initial_chrom.copy(), 
-            patient_folder, 
-            patient, 
-            objective_function,
-            time_limit
-        )
+        start_chrom, remaining_time, on_improvement = checkpoint.search(f'{patient}_average', initial_chrom.copy(), time_limit)
+        with profiling.span('search/average'):
+            best_average, fitness_average = single_swap_custom(
+                start_chrom, 
+                patient_folder, 
+                patient, 
+                objective_function,
+                remaining_time,
+                memo=memo_average,
+                on_improvement=on_improvement
+            )
         
         average_time = time.time() - start_time
         
         chrom_path_a = os.path.join(average_dir, f'best_chrom_{patient}_{timestamp}.mat')
         img_path_a = os.path.join(average_dir, f'best_img_{patient}_{timestamp}.png')
         
-        save_chromosome_mat(best_average, chrom_path_a)
-        _, _ = objective_function(best_average, image_folder=patient_folder, 
-                                 prefix=patient, save_path=img_path_a)
+        writer.save_mat(best_average, chrom_path_a)
+        writer.save_png(objective_function(best_average, patient=patient_layers), img_path_a)
         
         print(f"Average - Fitness: {fitness_average:.6f}, Time: {average_time:.2f}s")
         print(f"Average - Chromosome: {best_average}")
+        print(f"Average - Fitness cache: {memo_average.report()}")
 
         diff = fitness_priority - fitness_average
         winner = "PRIORITY" if diff > 0 else ("AVERAGE" if diff < 0 else "TIE")
@@ -222,68 +356,150 @@ def run_comparison_random(image_folder, time_limit, out_base_dir, random_seed=No
             'chrom_average': best_average,
             'time_priority': priority_time,
             'time_average': average_time,
+            'cache_priority': memo_priority.report(),
+            'cache_average': memo_average.report(),
             'winner': winner
         })
+        # The patient is checkpointed once its files are written
+        raise_write_errors(writer.flush())
+        checkpoint.complete(patient, results[-1], searches=(f'{patient}_priority', f'{patient}_average'))
     
-    print(f"\n{'=' * 80}")
-    print("COMPARISON SUMMARY")
-    print(f"{'=' * 80}\n")
+    raise_write_errors(writer.close())
     
-    summary_path = os.path.join(out_base_dir, f'COMPARISON_SUMMARY_RANDOM_{datetime.now().strftime("%Y%m%d_%H%M%S")}.txt')
+    write_summary(results, out_base_dir, random_seed, time_limit, val_patients)
     
-    with open(summary_path, 'w') as f:
-        f.write("=" * 80 + "\n")
-        f.write("FUSION METHOD COMPARISON RESULTS (RANDOM START)\n")
-        f.write("=" * 80 + "\n\n")
-        f.write(f"Random Seed: {random_seed if random_seed is not None else 'None (system time)'}\n")
-        f.write(f"Time Limit: {time_limit}s per patient\n")
-        f.write(f"Validation Patients: {val_patients}\n\n")
-        
-        f.write("=" * 80 + "\n")
-        f.write("DETAILED RESULTS\n")
-        f.write("=" * 80 + "\n\n")
-        
-        priority_wins = 0
-        average_wins = 0
-        ties = 0
-        
-        for r in results:
-            f.write(f"Patient: {r['patient']}\n")
-            f.write(f"  Initial:  {r['initial_chrom']}\n")
-            f.write(f"  Priority: {r['fitness_priority']:.6f} | {r['chrom_priority']}\n")
-            f.write(f"  Average:  {r['fitness_average']:.6f} | {r['chrom_average']}\n")
-            f.write(f"  Winner:   {r['winner']} (Δ = {r['fitness_priority'] - r['fitness_average']:+.6f})\n")
-            f.write(f"  Time:     Priority {r['time_priority']:.2f}s, Average {r['time_average']:.2f}s\n\n")
-            
-            if r['winner'] == 'PRIORITY':
-                priority_wins += 1
-            elif r['winner'] == 'AVERAGE':
-                average_wins += 1
+    return results
+
+
+def distinct_initial_chromosomes(k):
+    """k random initial chromosomes, all different while k < 127."""
+    chromosomes = []
+    while len(chromosomes) < k:
+        chrom = random_initial_chromosome()
+        if len(chromosomes) >= 2**7 - 1 or not any(np.array_equal(chrom, c) for c in chromosomes):
+            chromosomes.append(chrom)
+    return chromosomes
+
+
+def run_multi_start(image_folder, time_limit, out_base_dir, starts, workers=1, time_budget=None, random_seed=None,
+                    resume=False, fitness_store=None, profile=False):
+    """
+    Multi-start version of run_comparison_random: `starts` random initial
+    vectors per patient (the same for both methods), every (patient, start,
+    method) search submitted to a pool of `workers` processes.
+    """
+    print("=" * 80)
+    print(f"FUSION METHOD COMPARISON: Priority vs Average ({starts} RANDOM STARTS)")
+    print("=" * 80)
+
+    if random_seed is not None:
+        np.random.seed(random_seed)
+        random.seed(random_seed)
+        print(f"\nRandom Seed: {random_seed}")
+
+    print(f"Time Limit per Search: {time_limit}s")
+    if time_budget is not None:
+        print(f"Time Budget of the Run: {time_budget}s")
+
+    val_patients = get_validation_patients(image_folder)
+    print(f"\nValidation Patients ({len(val_patients)}): {val_patients}\n")
+
+    method_dirs = {method: os.path.join(out_base_dir, method) for method in METHODS}
+    for method_dir in method_dirs.values():
+        os.makedirs(method_dir, exist_ok=True)
+
+    checkpoint = Checkpoint(os.path.join(out_base_dir, 'checkpoint'),
+                            {'image_folder': image_folder, 'time_limit': time_limit,
+                             'random_seed': random_seed, 'patients': val_patients,
+                             'starts': starts, 'time_budget': time_budget},
+                            resume)
+
+    start_run = time.time()
+    deadline = None if time_budget is None else start_run + time_budget
+
+    # One task per (patient, start, method); the starts of a patient and
+    # method share table 2 * patient index + method index
+    results = {}
+    tasks = []
+    groups = []
+    # Without --random_seed each search still gets its own seed (from OS
+    # entropy): forked workers would otherwise share the random state
+    entropy = random.SystemRandom()
+    for i, patient in enumerate(val_patients):
+        if checkpoint.is_done(patient):
+            print(f"Patient {patient} already completed (checkpoint), skipped")
+            result = checkpoint.result(patient)
+            for key in ('initial_chrom', 'chrom_priority', 'chrom_average'):
+                result[key] = np.array(result[key])
+            results[patient] = result
+            continue
+        patient_folder = find_patient_folder(image_folder, patient)
+        if patient_folder is None:
+            print(f"ERROR: Could not find folder for patient {patient}")
+            continue
+
+        initial_chroms = distinct_initial_chromosomes(starts)
+        groups.append((i, patient, patient_folder, initial_chroms))
+        for k, initial_chrom in enumerate(initial_chroms):
+            for m, method in enumerate(METHODS):
+                seed = entropy.randrange(2 ** 32) if random_seed is None else random_seed + len(tasks)
+                tasks.append((2 * i + m, patient_folder, patient, method, initial_chrom, time_limit, deadline, seed,
+                              fitness_store))
+    shared = SharedFitnessTable(2 * len(val_patients))
+
+    def run_all():
+        if workers <= 1:
+            _init_worker(shared)
+            for task in tasks:
+                yield run_start(*task)
+            return
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(shared,)) as executor:
+            task_args = list(zip(*tasks))
+            if profile:
+                # Workers return their own spans and counters with each search
+                for output, worker_profile in executor.map(profiling.profiled_call, [run_start] * len(tasks),
+                                                           *task_args):
+                    profiling.merge(worker_profile)
+                    yield output
             else:
-                ties += 1
-        
-        # Statistics
-        fitness_p = [r['fitness_priority'] for r in results]
-        fitness_a = [r['fitness_average'] for r in results]
-        
-        f.write("=" * 80 + "\n")
-        f.write("STATISTICAL SUMMARY\n")
-        f.write("=" * 80 + "\n\n")
-        f.write(f"Total Patients: {len(results)}\n\n")
-        f.write(f"Wins:\n")
-        f.write(f"  Priority: {priority_wins} ({priority_wins/len(results)*100:.1f}%)\n")
-        f.write(f"  Average:  {average_wins} ({average_wins/len(results)*100:.1f}%)\n")
-        f.write(f"  Ties:     {ties} ({ties/len(results)*100:.1f}%)\n\n")
-        f.write(f"Fitness Statistics:\n")
-        f.write(f"  Priority - Mean: {np.mean(fitness_p):.6f}, Std: {np.std(fitness_p):.6f}\n")
-        f.write(f"  Average  - Mean: {np.mean(fitness_a):.6f}, Std: {np.std(fitness_a):.6f}\n")
-        f.write(f"  Difference Mean: {np.mean(fitness_p) - np.mean(fitness_a):+.6f}\n")
-    
-    print(f"Summary saved to: {summary_path}")
-    print(f"\nPriority Wins: {priority_wins}/{len(results)}")
-    print(f"Average Wins:  {average_wins}/{len(results)}")
-    print(f"Ties:          {ties}/{len(results)}")
-    
+                yield from executor.map(run_start, *task_args)
+
+    writer = ArtifactWriter()
+    outputs = run_all()
+    for i, patient, patient_folder, initial_chroms in groups:
+        # Results arrive in task order: the starts of this patient, both methods each
+        searches = {method: [] for method in METHODS}
+        for _ in initial_chroms:
+            for method in METHODS:
+                searches[method].append(next(outputs))
+
+        patient_layers = PatientLayers(patient_folder, patient, preload=False)
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        result = {'patient': patient, 'initial_chrom': initial_chroms[0],
+                  'initial_chroms': initial_chroms}
+        for m, (method, objective_func) in enumerate(METHODS.items()):
+            # Best of the starts (the first one on ties)
+            best, fitness, _ = max(searches[method], key=lambda search: search[1])
+            writer.save_mat(best, os.path.join(method_dirs[method], f'best_chrom_{patient}_{timestamp}.mat'))
+            writer.save_png(objective_func(best, patient=patient_layers),
+                            os.path.join(method_dirs[method], f'best_img_{patient}_{timestamp}.png'))
+            result[f'fitness_{method}'] = fitness
+            result[f'chrom_{method}'] = best
+            result[f'time_{method}'] = sum(search[2] for search in searches[method])
+            result[f'cache_{method}'] = shared.report(2 * i + m)
+            print(f"{patient} {method.capitalize()} - Fitness: {fitness:.6f}, Chromosome: {best}, "
+                  f"{len(initial_chroms)} starts, {shared.report(2 * i + m)}")
+
+        diff = result['fitness_priority'] - result['fitness_average']
+        result['winner'] = "PRIORITY" if diff > 0 else ("AVERAGE" if diff < 0 else "TIE")
+        results[patient] = result
+        raise_write_errors(writer.flush())
+        checkpoint.complete(patient, result)
+    raise_write_errors(writer.close())
+
+    print(f"\nMulti-start searches completed in {time.time() - start_run:.2f} seconds")
+    results = [results[patient] for patient in val_patients if patient in results]
+    write_summary(results, out_base_dir, random_seed, time_limit, val_patients, starts)
     return results
 
 
@@ -299,9 +515,33 @@ def main():
                        help='Output directory for comparison results')
     parser.add_argument('--random_seed', type=int, default=None,
                        help='Random seed for reproducibility (optional)')
+    parser.add_argument('--resume', action='store_true',
+                       help='Continue an interrupted run from the checkpoint in out_dir')
+    parser.add_argument('--fitness_store', type=str, default=DEFAULT_STORE_PATH,
+                       help="Persistent fitness store shared with other runs ('' to disable)")
+    parser.add_argument('--starts', type=int, default=1,
+                       help='Random initial vectors per patient and method (multi-start with more than 1)')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='Worker processes of the multi-start searches')
+    parser.add_argument('--time_budget', type=float, default=None,
+                       help='Time limit in seconds of the whole multi-start run (optional)')
+    parser.add_argument('--profile', action='store_true',
+                       help='Save a PROFILE_*.json report of the run in out_dir')
     args = parser.parse_args()
     
-    run_comparison_random(args.image_folder, args.time_limit, args.out_dir, args.random_seed)
+    if args.profile:
+        profiling.enable()
+    
+    if args.starts > 1 or args.workers > 1 or args.time_budget is not None:
+        run_multi_start(args.image_folder, args.time_limit, args.out_dir, args.starts, args.workers,
+                        args.time_budget, args.random_seed, args.resume, args.fitness_store, args.profile)
+    else:
+        run_comparison_random(args.image_folder, args.time_limit, args.out_dir, args.random_seed, args.resume,
+                              args.fitness_store)
+    
+    if args.profile:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        profiling.write_report(os.path.join(args.out_dir, f'PROFILE_COMPARISON_RANDOM_{timestamp}.json'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Cross-validation of the general vector.
+
+find_general_vector.py selects the general vector on a single split (35
+training patients, seed 42). This script measures how well that selection
+generalizes: the fitness of the 127 chromosomes is computed once for all the
+patients (or loaded from the results table) and the selection, with the same
+epsilon parsimony rule, is repeated on many splits of that P x 127 matrix:
+ - k-fold (--folds K --repeats R): each fold is the validation set once, for R shuffles
+ - random splits (--splits S): 35 training patients, the rest for validation
+
+Every split is a row of a membership matrix, so the training and validation
+averages of all splits are two matrix products and thousands of splits take
+well under a second.
+
+--method selects the fusion method of the rows (find_general_vector.py --method
+writes the runs of every method to the same table).
+
+Runs of cohorts with more layers (find_general_vector.py --n_layers, or
+--sweep --n_layers here) use their 2^n - 1 chromosomes instead of the 127.
+
+Outputs in results_data_analysis/:
+1. SUMMARY_CROSS_VALIDATION_...txt: chromosomes selected over the splits and
+   the validation fitness they reach.
+2. CROSS_VALIDATION_splits_...csv: one row per split.
+
+Usage:
+    python3 cross_validation.py --sweep --workers 4
+    python3 cross_validation.py --folds 5 --repeats 200
+    python3 cross_validation.py --splits 5000 --seed 0
+"""
+
+import os
+import csv
+import time
+import argparse
+import numpy as np
+
+from dataset_catalog import get_all_prefixes
+from patient_split import split_patients, TRAIN_SIZE
+from patient_layers import N_LAYERS
+from batch_evaluation import ALL_CHROMOSOMES, SWEEP_ENGINES, SWEEP_METHODS, fitness_from_counts
+from results_store import ResultsWriter, ResultsTable, chromosome_mask
+from find_general_vector import sweep_count_rows, sweep_chromosomes, select_general_vector, EPSILON
+from fitness_store import DEFAULT_STORE_PATH
+import profiling
+
+
+def sweep_all_patients(image_folder, results_path, engine='uint8', pack=None, workers=1, profile=False,
+                       fitness_store=None, n_layers=N_LAYERS, method='average'):
+    """
+    Evaluates the 127 chromosomes (sweep_chromosomes(n_layers)) on every
+    patient of image_folder with `method` fusion and appends them to the
+    results table as a new run. Returns its run id.
+    """
+    prefixes = get_all_prefixes(image_folder)
+    chromosomes = sweep_chromosomes(n_layers)
+    run_id = time.strftime('%Y%m%d_%H%M%S')
+    with ResultsWriter(results_path, run_id, patients=prefixes, method=method, n_layers=n_layers) as results, \
+            profiling.span('sweep'):
+        rows = sweep_count_rows(image_folder, prefixes, engine, pack, workers, profile, fitness_store,
+                                method, n_layers)
+        for prefix, counts in zip(prefixes, rows):
+            if counts is None:
+                print(f'Images not found for {prefix}, skipped')
+                continue
+            results.write_rows(prefix, method, chromosomes, fitness_from_counts(*counts), *counts)
+    return run_id
+
+
+def load_fitness_matrix(results_path, run_id=None, method='average'):
+    """
+    Loads a run of the results table as (run_id, patients, chromosomes, F), F
+    being the (P,127) fitness matrix with the chromosomes in ALL_CHROMOSOMES
+    order (the 2^n - 1 of sweep_chromosomes(n) for a run with n_layers n).
+    Patients without all the chromosomes are left out.
+    """
+    table = ResultsTable.load(results_path, run_id)
+    if method not in table.methods():
+        raise ValueError(f'El run {table.run_id} no tiene resultados del metodo {method} '
+                         f'(metodos del run: {table.methods()})')
+    chromosomes = sweep_chromosomes(table.n_layers)
+    patients, masks, matrix = table.fitness_matrix(method)
+    col_of = {mask: k for k, mask in enumerate(masks)}
+    columns = [col_of.get(chromosome_mask(chrom)) for chrom in chromosomes]
+    if None in columns:
+        raise ValueError(f'El run {table.run_id} no tiene los {len(chromosomes)} cromosomas')
+    matrix = matrix[:, columns]
+
+    complete = ~np.isnan(matrix).any(axis=1)
+    for patient in np.array(patients)[~complete]:
+        print(f'Incomplete results for {patient}, skipped')
+    return table.run_id, [p for p, ok in zip(patients, complete) if ok], chromosomes, matrix[complete]
+
+
+def kfold_splits(n_patients, folds=5, repeats=1, seed=0):
+    """
+    Validation membership of repeated k-fold: (repeats*folds, P) bool, the
+    folds of each repeat being a partition of a random shuffle of the patients.
+    """
+    rng = np.random.default_rng(seed)
+    order = np.argsort(rng.random((repeats, n_patients)), axis=1)
+    fold_of = np.empty((repeats, n_patients), dtype=int)
+    np.put_along_axis(fold_of, order, np.arange(n_patients) * folds // n_patients, axis=1)
+    validation = fold_of[:, np.newaxis, :] == np.arange(folds)[np.newaxis, :, np.newaxis]
+    return validation.reshape(repeats * folds, n_patients)
+
+
+def random_splits(n_patients, splits=1000, train_size=TRAIN_SIZE, seed=0):
+    """Validation membership of random splits with train_size training patients: (splits, P) bool."""
+    rng = np.random.default_rng(seed)
+    rank = np.argsort(np.argsort(rng.random((splits, n_patients)), axis=1), axis=1)
+    return rank >= train_size
+
+
+def evaluate_splits(fitness, validation, epsilon=EPSILON, chromosomes=ALL_CHROMOSOMES):
+    """
+    Selects the general vector on the training patients of every split and
+    scores it on the validation ones.
+
+    fitness: (P,127) fitness matrix (columns in the order of `chromosomes`)
+    validation: (S,P) bool, validation patients of each split
+    Returns a dict of (S,) arrays: selected chromosome index, its training and
+    validation average, and the best validation average of any chromosome.
+    """
+    with profiling.span('cross_validation'):
+        validation = np.asarray(validation, dtype=bool)
+        training = ~validation
+        n_train = training.sum(axis=1)
+        n_val = validation.sum(axis=1)
+        if (n_train == 0).any() or (n_val == 0).any():
+            raise ValueError('Cada split necesita pacientes de entrenamiento y de validacion')
+
+        train_mean = (training @ fitness) / n_train[:, np.newaxis]
+        val_mean = (validation @ fitness) / n_val[:, np.newaxis]
+        selected, train_fitness = select_general_vector(train_mean, epsilon, chromosomes)
+        rows = np.arange(len(validation))
+        return {
+            'selected': selected,
+            'train_fitness': train_fitness,
+            'val_fitness': val_mean[rows, selected],
+            'oracle_fitness': val_mean.max(axis=1),
+            'n_train': n_train,
+            'n_val': n_val,
+        }
+
+
+def summary_report(results, patients, description, fixed=None, full=None, chromosomes=ALL_CHROMOSOMES,
+                   method='average'):
+    """Text of SUMMARY_CROSS_VALIDATION: selection frequency and validation fitness."""
+    selected = results['selected']
+    val_fitness = results['val_fitness']
+    regret = results['oracle_fitness'] - val_fitness
+    n_splits = len(selected)
+
+    lines = [f'Cross-validation of the general vector over {len(patients)} patients',
+             f'Fusion method: {method}',
+             f'Splits: {description} ({n_splits} splits)',
+             f'Patients: {patients}',
+             '']
+    if full is not None:
+        index, avg_fitness = full
+        lines.append(f'Vector selected on all patients: {chromosomes[index].tolist()} '
+                     f'(average fitness {avg_fitness:.6f})')
+    if fixed is not None:
+        index, train_fitness, val_fitness_fixed = fixed
+        lines.append(f'Fixed split (seed 42): {chromosomes[index].tolist()} '
+                     f'(training {train_fitness:.6f}, validation {val_fitness_fixed:.6f})')
+    if full is not None or fixed is not None:
+        lines.append('')
+
+    p5, p50, p95 = np.percentile(val_fitness, [5, 50, 95])
+    lines += ['Validation fitness of the selected vector:',
+              f'  Mean: {val_fitness.mean():.6f} (std {val_fitness.std():.6f})',
+              f'  Percentiles 5/50/95: {p5:.6f} / {p50:.6f} / {p95:.6f}',
+              f'  Gap to the best vector of each validation set: {regret.mean():.6f} (mean), {regret.max():.6f} (max)',
+              f'  Training - validation: {(results["train_fitness"] - val_fitness).mean():+.6f} (mean)',
+              '',
+              'Selected chromosomes (most frequent first):']
+    counts = np.bincount(selected, minlength=len(chromosomes))
+    for rank, index in enumerate(np.argsort(-counts, kind='stable')[:np.count_nonzero(counts)], 1):
+        chosen = selected == index
+        lines.append(f'{rank}. Chromosome: {chromosomes[index].tolist()}, Selected: {counts[index]} '
+                     f'({100 * counts[index] / n_splits:.1f}%), Validation fitness: {val_fitness[chosen].mean():.6f}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_splits_csv(path, results, validation, patients, chromosomes=ALL_CHROMOSOMES):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['split', 'chromosome', 'train_fitness', 'val_fitness', 'oracle_fitness', 'validation_patients'])
+        for s in range(len(validation)):
+            writer.writerow([s, chromosome_mask(chromosomes[results['selected'][s]]),
+                             repr(float(results['train_fitness'][s])), repr(float(results['val_fitness'][s])),
+                             repr(float(results['oracle_fitness'][s])),
+                             ' '.join(p for p, v in zip(patients, validation[s]) if v)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cross-validation of the general vector from the fitness matrix')
+    parser.add_argument('--results', type=str, default=os.path.join('results_data_analysis', 'fitness_results.csv'),
+                        help='Results table with the fitness of the patients (see results_store.py)')
+    parser.add_argument('--run_id', type=str, default=None, help='Run of the results table (default: the last one)')
+    parser.add_argument('--method', type=str, default='average', choices=SWEEP_METHODS,
+                        help='Fusion method of the rows to cross-validate (and of the sweep)')
+    parser.add_argument('--sweep', action='store_true',
+                        help='Evaluate all the patients first and store them as a new run of the results table')
+    parser.add_argument('--image_folder', type=str, default='Images', help='Base folder containing patient images')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes of the sweep')
+    parser.add_argument('--engine', type=str, default=None, choices=SWEEP_ENGINES,
+                        help='Scoring engine of the sweep (default: uint8, gray for more than 7 layers)')
+    parser.add_argument('--n_layers', type=int, default=N_LAYERS,
+                        help='Layers of each patient in the sweep (N1..N{n_layers})')
+    parser.add_argument('--pack', type=str, default=None, help='Packed cohort to read the layers from (7 layers only)')
+    parser.add_argument('--fitness_store', type=str, default=DEFAULT_STORE_PATH,
+                        help="Persistent fitness store of the sweep ('' to disable)")
+    parser.add_argument('--folds', type=int, default=5, help='Folds of the k-fold cross-validation')
+    parser.add_argument('--repeats', type=int, default=1, help='Shuffles of the k-fold cross-validation')
+    parser.add_argument('--splits', type=int, default=None,
+                        help='Use this many random splits of 35 training patients instead of k-fold')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the shuffles')
+    parser.add_argument('--epsilon', type=float, default=EPSILON, help='Fitness margin of the parsimony rule')
+    parser.add_argument('--out_dir', type=str, default='results_data_analysis', help='Output directory')
+    parser.add_argument('--profile', action='store_true', help='Save a PROFILE_*.json report of the run in out_dir')
+    args = parser.parse_args()
+    if args.engine is None:
+        args.engine = 'gray' if args.n_layers > N_LAYERS else 'uint8'
+    if args.n_layers > N_LAYERS and args.engine != 'gray':
+        parser.error(f'--n_layers {args.n_layers} needs --engine gray')
+    if args.pack is not None and args.n_layers != N_LAYERS:
+        parser.error(f'--pack only holds {N_LAYERS} layers')
+
+    if args.profile:
+        profiling.enable()
+
+    run_id = args.run_id
+    if args.sweep:
+        run_id = sweep_all_patients(args.image_folder, args.results, args.engine, args.pack,
+                                    args.workers, args.profile, args.fitness_store, args.n_layers, args.method)
+    run_id, patients, chromosomes, fitness = load_fitness_matrix(args.results, run_id, args.method)
+    print(f'Fitness matrix of run {run_id}: {len(patients)} patients x {fitness.shape[1]} chromosomes')
+
+    if args.splits is not None:
+        validation = random_splits(len(patients), args.splits, min(TRAIN_SIZE, len(patients) - 1), args.seed)
+        description = f'{args.splits} random splits of {min(TRAIN_SIZE, len(patients) - 1)} training patients'
+    else:
+        validation = kfold_splits(len(patients), args.folds, args.repeats, args.seed)
+        description = f'{args.folds}-fold x {args.repeats} repeats'
+
+    start_time = time.time()
+    results = evaluate_splits(fitness, validation, args.epsilon, chromosomes)
+    print(f'{len(validation)} splits evaluated in {time.time() - start_time:.3f} seconds')
+
+    full = select_general_vector(fitness.mean(axis=0), args.epsilon, chromosomes)
+
+    # The split of find_general_vector.py, if all its patients are in the matrix
+    fixed = None
+    train_prefixes, val_prefixes = split_patients(args.image_folder)
+    if val_prefixes and set(train_prefixes + val_prefixes) <= set(patients):
+        fixed_validation = np.array([[p in val_prefixes for p in patients]])
+        fixed_results = evaluate_splits(fitness, fixed_validation, args.epsilon, chromosomes)
+        fixed = (fixed_results['selected'][0], fixed_results['train_fitness'][0], fixed_results['val_fitness'][0])
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    timestamp = time.strftime('%Y%m%d_%H%M%S')
+    summary_path = os.path.join(args.out_dir, f'SUMMARY_CROSS_VALIDATION_{len(patients)}patients_{timestamp}.txt')
+    summary = summary_report(results, patients, description, fixed, full, chromosomes, args.method)
+    with profiling.span('write/summary'):
+        with open(summary_path, 'w') as f:
+            f.write(summary)
+        splits_path = os.path.join(args.out_dir, f'CROSS_VALIDATION_splits_{len(patients)}patients_{timestamp}.csv')
+        write_splits_csv(splits_path, results, validation, patients, chromosomes)
+    print(summary)
+    print(f'Summary saved to: {summary_path}')
+    print(f'Splits saved to: {splits_path}')
+
+    if args.profile:
+        profiling.write_report(os.path.join(args.out_dir, f'PROFILE_CROSS_VALIDATION_{timestamp}.json'))
+
+
+if __name__ == '__main__':
+    main()
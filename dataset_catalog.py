@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Index of the patients available in an image folder.
+
+Images are stored as image_folder/*/{prefix}_N#_mask.bmp. The catalog maps each
+patient prefix to the subfolders that contain it and to the layers (N1..N7)
+present there. It is saved as JSON next to the image folder
+(Images -> Images.catalog.json) and revalidated with the modification times of
+the folders: only the subfolders that changed since the last run are listed
+again.
+
+Usage:
+    from dataset_catalog import get_all_prefixes, find_patient_folder
+"""
+
+import os
+import re
+import json
+
+CATALOG_VERSION = 1
+
+# {prefix}_N{layer}_mask.bmp
+LAYER_PATTERN = re.compile(r'^(?P<prefix>[^_]+)_N(?P<layer>\d+)_mask\.bmp$')
+
+
+def catalog_path(image_folder):
+    # Images -> Images.catalog.json, in the parent folder of Images
+    folder = os.path.normpath(os.path.abspath(image_folder))
+    return os.path.join(os.path.dirname(folder), os.path.basename(folder) + '.catalog.json')
+
+
+def scan_folder(folder):
+    """
+    Lists the .bmp files of one folder.
+    Returns ({prefix: sorted list of layer numbers}, number of .bmp files).
+    """
+    patients = {}
+    n_files = 0
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.startswith('.') or not name.endswith('.bmp'):
+                continue
+            n_files += 1
+            prefix = name.split('_')[0]
+            layers = patients.setdefault(prefix, [])
+            match = LAYER_PATTERN.match(name)
+            if match:
+                layers.append(int(match.group('layer')))
+    return {prefix: sorted(layers) for prefix, layers in patients.items()}, n_files
+
+
+class DatasetCatalog:
+    """
+    Cached index prefix -> folder -> available layers of an image folder.
+    """
+
+    def __init__(self, image_folder, index_path=None):
+        self.image_folder = image_folder
+        self.index_path = index_path or catalog_path(image_folder)
+        self.dirs = {}
+        self.refresh()
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('version') != CATALOG_VERSION:
+            return None
+        return data
+
+    def _write_index(self, root_mtime):
+        data = {'version': CATALOG_VERSION, 'root_mtime': root_mtime, 'dirs': self.dirs}
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f'Warning: could not save catalog {self.index_path}: {e}')
+
+    def refresh(self):
+        """
+        Loads the saved index and rescans only the subfolders whose modification
+        time changed. Saves the index again if anything was rescanned.
+        """
+        root_mtime = os.stat(self.image_folder).st_mtime_ns
+        saved = self._read_index()
+        saved_dirs = saved['dirs'] if saved else {}
+
+        # The list of subfolders only changes if the root folder changed
+        if saved and saved['root_mtime'] == root_mtime:
+            names = list(saved_dirs)
+        else:
+            names = sorted(entry.name for entry in os.scandir(self.image_folder)
+                           if entry.is_dir() and not entry.name.startswith('.'))
+
+        changed = saved is None or saved['root_mtime'] != root_mtime
+        dirs = {}
+        for name in names:
+            mtime = os.stat(os.path.join(self.image_folder, name)).st_mtime_ns
+            entry = saved_dirs.get(name)
+            if entry is None or entry['mtime'] != mtime:
+                patients, n_files = scan_folder(os.path.join(self.image_folder, name))
+                entry = {'mtime': mtime, 'n_files': n_files, 'patients': patients}
+                changed = True
+            dirs[name] = entry
+        self.dirs = dirs
+
+        if changed:
+            self._write_index(root_mtime)
+
+    def n_files(self):
+        return sum(entry['n_files'] for entry in self.dirs.values())
+
+    def prefixes(self):
+        """Sorted list of all patient prefixes."""
+        prefixes = set()
+        for entry in self.dirs.values():
+            prefixes.update(entry['patients'])
+        return sorted(prefixes)
+
+    def folders(self, prefix):
+        """Subfolders (sorted) that contain images of the patient."""
+        return [os.path.join(self.image_folder, name)
+                for name, entry in sorted(self.dirs.items()) if prefix in entry['patients']]
+
+    def folder(self, prefix):
+        """First subfolder containing the patient, or None."""
+        folders = self.folders(prefix)
+        return folders[0] if folders else None
+
+    def layers(self, prefix, folder=None):
+        """Layer numbers (1..7) of the patient available in folder (first folder by default)."""
+        folder = folder or self.folder(prefix)
+        if folder is None:
+            return []
+        entry = self.dirs.get(os.path.basename(os.path.normpath(folder)), {'patients': {}})
+        return entry['patients'].get(prefix, [])
+
+
+_CATALOGS = {}
+
+
+def get_catalog(image_folder):
+    """Catalog of image_folder, validated once per process."""
+    key = os.path.abspath(image_folder)
+    if key not in _CATALOGS:
+        _CATALOGS[key] = DatasetCatalog(image_folder)
+    return _CATALOGS[key]
+
+
+def get_all_prefixes(image_folder):
+    """
+    Returns all unique patient prefixes found in image_folder/*/*.bmp.
+    """
+    return get_catalog(image_folder).prefixes()
+
+
+def find_patient_folder(base_folder, prefix):
+    """
+    Finds the subfolder containing images for the given patient prefix.
+    """
+    return get_catalog(base_folder).folder(prefix)
@@ -1,61 +1,195 @@
 #!/usr/bin/env python3
 """
 Perform an exhaustive search (brute force) on the 127 possible combinations.
+The fusion method is chosen with --method (average fusion by default, or one
+of the other methods with exhaustive counts, batch_evaluation.SWEEP_METHODS).
+With --n_layers N the patients have layers N1..N{N} and the 2^N - 1
+combinations are evaluated (with the 'gray' engine when N > 7).
 Outputs in ‘results_data_analysis/’:
-1. SUMMARY_AVERAGES_...txt: Average fitness of all vectors (sorted).
-2. DETAILS_{patient}_...txt: 10 files with the performance of all vectors for each patient.
-3. BEST_GLOBAL_...: .mat and .png files of the global winning vector (using parsimony criteria).
+1. fitness_results.csv: one row per (run, patient, chromosome) with the fitness and
+   the pixel counts, appended as each patient finishes (see results_store.py).
+2. BEST_GLOBAL_...: .mat and .png files of the global winning vector (using parsimony criteria).
+3. With --text_reports, generated from the results table:
+   SUMMARY_AVERAGES_...txt: Average fitness of all vectors (sorted).
+   DETAILS_{patient}_...txt: the performance of all vectors for each patient.
 """
 
 import os
 import numpy as np
-import itertools
-from objective_function import objective_function as evaluate_individual
-from utils_matlab_io import save_chromosome_mat
+from patient_layers import PatientLayers, N_LAYERS
+from dataset_catalog import find_patient_folder
+from patient_split import split_patients
+from cohort_pack import get_cohort
+from batch_evaluation import (ALL_CHROMOSOMES, SWEEP_ENGINES, SWEEP_METHODS, all_chromosomes, count_all_chromosomes,
+                              fitness_from_counts)
+from results_store import ResultsWriter, ResultsTable
+from artifact_writer import ArtifactWriter, raise_write_errors
+from fitness_store import get_store, DEFAULT_STORE_PATH
+from fitness_memo import OBJECTIVE_FUNCTIONS
+import profiling
 import time
-import glob
-import random
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 
-def get_all_prefixes(image_folder):
+EPSILON = 0.002  # Fitness margin of the parsimony rule
+
+def sweep_chromosomes(n_layers=N_LAYERS):
+    """Chromosomes of the exhaustive search: ALL_CHROMOSOMES, or all_chromosomes(n_layers)."""
+    return ALL_CHROMOSOMES if n_layers == N_LAYERS else all_chromosomes(n_layers)
+
+def load_patient_layers(image_folder, prefix, n_layers=N_LAYERS):
     """
-    Scans the image_folder to find all unique patient prefixes.
-    Assumes structure: image_folder/Prefix_N#_mask.bmp or image_folder/*/Prefix_N#_mask.bmp
+    Decodes the layers of a patient once, from its folder in the dataset catalog.
+    Returns None if the patient's images are not found.
     """
-    prefixes = set()
-    # Search in subdirectories (e.g., Images/Prueba/*.bmp)
-    search_path = os.path.join(image_folder, '*', '*.bmp')
-    files = glob.glob(search_path)
-    
-    for file_path in files:
-        filename = os.path.basename(file_path)
-        # Split by underscore to get the prefix
-        parts = filename.split('_')
-        if len(parts) >= 1:
-            prefixes.add(parts[0])
-            
-    return sorted(list(prefixes))
+    patient_folder = find_patient_folder(image_folder, prefix)
+    if patient_folder is None:
+        return None
+    try:
+        return PatientLayers(patient_folder, prefix, n_layers=n_layers)
+    except FileNotFoundError:
+        return None
+
+def patient_count_row(image_folder, prefix, engine='uint8', pack=None, fitness_store=None, method='average',
+                      n_layers=N_LAYERS):
+    """
+    Decodes one patient and returns the (valid_count, total_detected) of `method`
+    fusion of the 127 chromosomes (ALL_CHROMOSOMES order), or of the
+    sweep_chromosomes(n_layers) of patients with n_layers layers, or None if
+    its images are not found.
+    With `pack` the layers are read from that packed cohort (cohort_pack.py, 7 layers).
+    With `fitness_store` (path of a fitness_store.py database) a patient whose
+    images were already evaluated is not decoded, and new counts are stored.
+    Runs in the worker processes when --workers > 1.
+    """
+    cohort = get_cohort(pack) if pack is not None else None
+    if cohort is not None:
+        folder = cohort.folders[cohort.rows[prefix]] if prefix in cohort else None
+    else:
+        folder = find_patient_folder(image_folder, prefix)
+    if folder is None:
+        return None
+
+    chromosomes = sweep_chromosomes(n_layers)
+    store = get_store(fitness_store)
+    store_key = store.patient_key(folder, prefix, n_layers) if store is not None else None
+    if store_key is not None:
+        counts = store.get_counts(store_key, method, chromosomes)
+        if counts is not None:
+            return counts
+
+    if cohort is not None:
+        patient = cohort.patient(prefix)
+    else:
+        patient = load_patient_layers(image_folder, prefix, n_layers)
+    if patient is None:
+        return None
+    counts = count_all_chromosomes(patient, methods=(method,), engine=engine)[method]
+    if store_key is not None:
+        store.put_many(store_key, method, chromosomes, fitness_from_counts(*counts), *counts)
+    return counts
+
+def patient_fitness_row(image_folder, prefix, engine='uint8', pack=None, fitness_store=None, method='average',
+                        n_layers=N_LAYERS):
+    """
+    Fitness (`method` fusion) of the 127 chromosomes (sweep_chromosomes(n_layers))
+    of one patient, or None if its images are not found.
+    """
+    counts = patient_count_row(image_folder, prefix, engine, pack, fitness_store, method, n_layers)
+    return None if counts is None else fitness_from_counts(*counts)
+
+def sweep_count_rows(image_folder, prefixes, engine='uint8', pack=None, workers=1, profile=False,
+                     fitness_store=None, method='average', n_layers=N_LAYERS):
+    """
+    Yields the patient_count_row of each prefix, in order, as soon as it is ready.
+    With workers > 1 the patients are split among worker processes; with
+    profile=True their profiling data is merged into this process.
+    """
+    if workers <= 1:
+        for prefix in prefixes:
+            yield patient_count_row(image_folder, prefix, engine, pack, fitness_store, method, n_layers)
+        return
+
+    n = len(prefixes)
+    task_args = ([image_folder] * n, prefixes, [engine] * n, [pack] * n, [fitness_store] * n, [method] * n,
+                 [n_layers] * n)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if profile:
+            # Workers return their own spans and counters with each row
+            for row, worker_profile in executor.map(profiling.profiled_call, [patient_count_row] * n, *task_args):
+                profiling.merge(worker_profile)
+                yield row
+        else:
+            yield from executor.map(patient_count_row, *task_args)
+
+def select_general_vector(mean_fitness, epsilon=EPSILON, chromosomes=ALL_CHROMOSOMES):
+    """
+    Parsimony rule of the general vector. Chromosomes are scanned in
+    ALL_CHROMOSOMES order (or the order of `chromosomes`): one replaces the
+    best if its average fitness is higher by more than epsilon, or within
+    epsilon with fewer layers.
+
+    mean_fitness: (127,) average fitness of each chromosome, or (S,127) for S
+    training sets at once (NaN = not evaluated, skipped)
+    Returns (index of the selected chromosome, its average fitness), arrays of S
+    values for a 2-D input.
+    """
+    mean_fitness = np.asarray(mean_fitness, dtype=np.float64)
+    averages = np.atleast_2d(mean_fitness)
+    sizes = np.asarray(chromosomes).sum(axis=1)
+
+    best_index = np.zeros(len(averages), dtype=int)
+    best_fitness = np.full(len(averages), -np.inf)
+    for k in range(averages.shape[1]):
+        avg_fitness = averages[:, k]
+        better = avg_fitness > best_fitness + epsilon
+        smaller = (np.abs(avg_fitness - best_fitness) <= epsilon) & (sizes[k] < sizes[best_index])
+        update = better | smaller
+        best_index[update] = k
+        best_fitness[update] = avg_fitness[update]
+
+    if mean_fitness.ndim == 1:
+        return int(best_index[0]), float(best_fitness[0])
+    return best_index, best_fitness
 
 def main():
+    parser = argparse.ArgumentParser(description='Exhaustive search of the general vector over the training patients')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes (patients are split among them)')
+    parser.add_argument('--method', type=str, default='average', choices=SWEEP_METHODS,
+                        help='Fusion method')
+    parser.add_argument('--engine', type=str, default=None, choices=SWEEP_ENGINES,
+                        help='Scoring engine, all give the same fitness (default: uint8, gray for more than 7 layers)')
+    parser.add_argument('--n_layers', type=int, default=N_LAYERS,
+                        help='Layers of each patient (N1..N{n_layers}, the last one is the reference)')
+    parser.add_argument('--pack', type=str, default=None,
+                        help='Packed cohort to read the layers from (see cohort_pack.py, 7 layers only)')
+    parser.add_argument('--fitness_store', type=str, default=DEFAULT_STORE_PATH,
+                        help="Persistent fitness store shared with other runs ('' to disable)")
+    parser.add_argument('--resume', type=str, nargs='?', const='last', default=None,
+                        help='Continue an interrupted run (the last one of the results table, or the given run id)')
+    parser.add_argument('--text_reports', action='store_true',
+                        help='Also write the SUMMARY_AVERAGES and DETAILS text reports')
+    parser.add_argument('--profile', action='store_true',
+                        help='Save a PROFILE_*.json report of the run in results_data_analysis')
+    args = parser.parse_args()
+    if args.engine is None:
+        args.engine = 'gray' if args.n_layers > N_LAYERS else 'uint8'
+    if args.n_layers > N_LAYERS and args.engine != 'gray':
+        parser.error(f'--n_layers {args.n_layers} needs --engine gray')
+    if args.pack is not None and args.n_layers != N_LAYERS:
+        parser.error(f'--pack only holds {N_LAYERS} layers')
+
+    if args.profile:
+        profiling.enable()
+
     image_folder = 'Images'
-    epsilon = 0.002
-    
-    # 1. Get all available patients
-    all_prefixes = get_all_prefixes(image_folder)
-    total_patients = len(all_prefixes)
-    print(f"Total unique patients found: {total_patients}")
-    
-    if total_patients < 35:
+
+    # 1. Split the patients: 35 for training (seed 42), the rest for validation
+    train_prefixes, val_prefixes = split_patients(image_folder)
+    print(f"Total unique patients found: {len(train_prefixes) + len(val_prefixes)}")
+    if not val_prefixes:
         print("Warning: Less than 35 patients found. Using all available.")
-        train_size = total_patients
-    else:
-        train_size = 35
-        
-    # 2. Randomly select 35 for training
-    random.seed(42) # Fixed seed for reproducibility
-    random.shuffle(all_prefixes)
-    
-    train_prefixes = all_prefixes[:train_size]
-    val_prefixes = all_prefixes[train_size:]
     
     print(f"\nSelected {len(train_prefixes)} patients for TRAINING (General Vector Search):")
     print(train_prefixes)
@@ -66,74 +200,86 @@ def main():
 
     best_avg_fitness = float('-inf')
     best_chromosome = None
-    all_chromosomes = []  
+    chromosomes = sweep_chromosomes(args.n_layers)
+    averages = np.full(len(chromosomes), np.nan)
 
-    total_combinations = 2**7 - 1  
+    total_combinations = 2**args.n_layers - 1
     count = 0
 
+    # Create results folder
+    out_dir = 'results_data_analysis'
+    os.makedirs(out_dir, exist_ok=True)
+    timestamp = time.strftime('%Y%m%d_%H%M%S')
+    results_path = os.path.join(out_dir, 'fitness_results.csv')
+
+    # Patients already in the results table of the resumed run are not evaluated again
+    done_counts = {}
+    if args.resume:
+        table = ResultsTable.load(results_path, None if args.resume == 'last' else args.resume)
+        if table.metadata.get('training', train_prefixes) != train_prefixes:
+            raise ValueError(f'El run {table.run_id} tiene otros pacientes de entrenamiento')
+        if table.metadata.get('method', 'average') != args.method:
+            raise ValueError(f'El run {table.run_id} usa otro metodo de fusion')
+        if table.n_layers != args.n_layers:
+            raise ValueError(f'El run {table.run_id} tiene {table.n_layers} capas')
+        timestamp = table.run_id
+        for prefix in train_prefixes:
+            counts = table.counts(prefix, chromosomes, args.method)
+            if counts is not None:
+                done_counts[prefix] = counts
+        print(f'Resuming run {timestamp}: {len(done_counts)}/{len(train_prefixes)} patients already evaluated')
+    pending = [prefix for prefix in train_prefixes if prefix not in done_counts]
+
     start_time = time.time()
 
-    for chrom_tuple in itertools.product([0, 1], repeat=7):
-        chrom = np.array(chrom_tuple, dtype=int)
-        if chrom.sum() == 0:
-            continue
+    # Fitness of the 127 chromosomes for each training patient, one row per patient.
+    # Rows arrive in train_prefixes order, so the results do not depend on --workers,
+    # and are appended to the results table as each patient finishes
+    fitness_rows = []
+    with ResultsWriter(results_path, timestamp, training=train_prefixes, validation=val_prefixes,
+                       method=args.method, n_layers=args.n_layers) as results, \
+            profiling.span('sweep'):
+        rows = sweep_count_rows(image_folder, pending, args.engine, args.pack, args.workers, args.profile,
+                                args.fitness_store, args.method, args.n_layers)
+        for prefix in train_prefixes:
+            if prefix in done_counts:
+                fitness_rows.append(fitness_from_counts(*done_counts[prefix]))
+                continue
+            counts = next(rows)
+            if counts is None:
+                print(f'Images not found for {prefix}, skipped')
+                continue
+            fitness = fitness_from_counts(*counts)
+            results.write_rows(prefix, args.method, chromosomes, fitness, *counts)
+            fitness_rows.append(fitness)
 
+    for k, chrom in enumerate(chromosomes):
         count += 1
         print(f'Evaluating chromosome {count}/{total_combinations}: {chrom}')
 
-        fitnesses = []
-        for prefix in train_prefixes:
-            try:
-                
-                f, _ = evaluate_individual(chrom, image_folder=image_folder, prefix=prefix)
-                fitnesses.append(f)
-            except Exception as e:
-                # Fallback: try to find the specific subfolder for this prefix if the generic call fails
-                # This is a bit of a hack without seeing objective_function, but let's try to be robust
-                found = False
-                for subdir in glob.glob(os.path.join(image_folder, '*')):
-                    if os.path.isdir(subdir):
-                         try:
-                            f, _ = evaluate_individual(chrom, image_folder=subdir, prefix=prefix)
-                            fitnesses.append(f)
-                            found = True
-                            break
-                         except:
-                             continue
-                if not found:
-                    pass
-                continue
+        fitnesses = [row[k] for row in fitness_rows]
 
         if fitnesses:
             avg_fitness = sum(fitnesses) / len(fitnesses)
             print(f'  Average fitness: {avg_fitness:.6f} (over {len(fitnesses)} patients)')
-            if avg_fitness > best_avg_fitness + epsilon:
-                best_avg_fitness = avg_fitness
-                best_chromosome = chrom.copy()
-            elif abs(avg_fitness - best_avg_fitness) <= epsilon:
-                if chrom.sum() < best_chromosome.sum():
-                    best_avg_fitness = avg_fitness
-                    best_chromosome = chrom.copy()
-
-            all_chromosomes.append((avg_fitness, chrom.copy(), fitnesses.copy()))
+            averages[k] = avg_fitness
         else:
             print('  No valid fitnesses')
 
+    if fitness_rows:
+        best_index, best_avg_fitness = select_general_vector(averages, chromosomes=chromosomes)
+        best_chromosome = chromosomes[best_index].copy()
+
     end_time = time.time()
     print(f'\nBúsqueda completada en {end_time - start_time:.2f} segundos')
+    print(f'Results table: {results_path} (run {timestamp})')
 
-    # Sort all chromosomes by average fitness descending
-    all_chromosomes.sort(key=lambda x: -x[0])
-
-    # Create results folder
-    out_dir = 'results_data_analysis'
-    os.makedirs(out_dir, exist_ok=True)
-    timestamp = time.strftime('%Y%m%d_%H%M%S')
+    # Result files are written in the background by a pool of threads
+    writer = ArtifactWriter()
 
     # Save BEST_GLOBAL_chrom_FECHA.mat
     chrom_path = os.path.join(out_dir, f'BEST_GLOBAL_chrom_{len(train_prefixes)}patients_{timestamp}.mat')
-    save_chromosome_mat(best_chromosome, chrom_path)
-    print(f'Chromosome saved: {chrom_path}')
+    writer.save_mat(best_chromosome, chrom_path)
 
     # Save BEST_GLOBAL_img_FECHA.png
     # Try to find a valid folder for the first prefix to save the image
@@ -141,53 +287,28 @@ def main():
     img_path = os.path.join(out_dir, f'BEST_GLOBAL_img_{len(train_prefixes)}patients_{timestamp}.png')
     
     saved_img = False
-    # Try base folder
-    try:
-        _, _ = evaluate_individual(best_chromosome, image_folder=image_folder, prefix=first_prefix, save_path=img_path)
+    first_patient = load_patient_layers(image_folder, first_prefix, args.n_layers)
+    if first_patient is not None:
+        evaluate_individual = OBJECTIVE_FUNCTIONS[args.method]
+        writer.save_png(evaluate_individual(best_chromosome, patient=first_patient), img_path)
         saved_img = True
-    except:
-        # Try subfolders
-        for subdir in glob.glob(os.path.join(image_folder, '*')):
-            if os.path.isdir(subdir):
-                try:
-                    _, _ = evaluate_individual(best_chromosome, image_folder=subdir, prefix=first_prefix, save_path=img_path)
-                    saved_img = True
-                    break
-                except:
-                    continue
-    
+
+    # Save SUMMARY_AVERAGES_FECHA.txt and DETAILS_{patient}_FECHA.txt
+    if args.text_reports:
+        with profiling.span('write/summary'):
+            table = ResultsTable.load(results_path, timestamp)
+            for path, text in table.text_reports(out_dir, args.method).items():
+                writer.write_text(path, text)
+
+    # The files are reported once they are written; a failed write fails the run
+    raise_write_errors(writer.close())
+    print(f'Chromosome saved: {chrom_path}')
     if saved_img:
         print(f'Image saved: {img_path}')
     else:
         print('Could not save image (path issue)')
-
-    # Save SUMMARY_AVERAGES_FECHA.txt
-    summary_path = os.path.join(out_dir, f'SUMMARY_AVERAGES_{len(train_prefixes)}patients_{timestamp}.txt')
-    with open(summary_path, 'w') as f:
-        f.write(f'Summary of all 127 combinations ordered by average fitness (best to worst) over {len(train_prefixes)} patients:\n\n')
-        f.write(f'Training Patients: {train_prefixes}\n')
-        f.write(f'Validation Patients: {val_prefixes}\n\n')
-        for i, (avg_f, chrom, _) in enumerate(all_chromosomes, 1):
-            f.write(f'{i}. Average Fitness: {avg_f:.6f}, Chromosome: {chrom.tolist()}\n')
-    print(f'Summary saved: {summary_path}')
-
-
-    for idx, prefix in enumerate(train_prefixes):
-        details_path = os.path.join(out_dir, f'DETAILS_{prefix}_{timestamp}.txt')
-        
-        valid_entries = []
-        for avg_f, chrom, fits in all_chromosomes:
-            if idx < len(fits):
-                valid_entries.append((avg_f, chrom, fits))
-        
-        sorted_for_prefix = sorted(valid_entries, key=lambda x: -x[2][idx])
-        
-        with open(details_path, 'w') as f:
-            f.write(f'Details for patient {prefix}, combinations ordered by fitness (best to worst):\n\n')
-            for i, (avg_f, chrom, fitnesses) in enumerate(sorted_for_prefix, 1):
-                f.write(f'{i}. Fitness: {fitnesses[idx]:.6f}, Average: {avg_f:.6f}, Chromosome: {chrom.tolist()}\n')
-        # print(f'Details for {prefix} saved: {details_path}')
-    print(f"Saved individual detail files for all {len(train_prefixes)} training patients.")
+    if args.text_reports:
+        print(f"Saved summary and individual detail files for all {len(fitness_rows)} training patients.")
 
     if best_chromosome is not None:
         print('\n=== MEJOR VECTOR GENERAL ===')
@@ -196,5 +317,8 @@ def main():
     else:
         print('No se encontró un cromosoma válido')
 
+    if args.profile:
+        profiling.write_report(os.path.join(out_dir, f'PROFILE_{len(train_prefixes)}patients_{timestamp}.json'))
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
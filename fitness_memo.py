@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Memo table of fitness values for the local searches.
+
+The search space has only 127 chromosomes, so a search that keeps every value
+it has computed never evaluates the same chromosome twice. One FitnessMemo is
+used per (patient, fusion method) and keeps hit/miss counters for the report.
+
+The values that are not in the table are computed by an IncrementalEvaluator,
+which scores the single-bit neighbors of the last evaluated chromosome with one
+layer of work (same fitness as the objective functions). The weighted smooth
+and red weighted fusions have no incremental evaluator and call their
+objective functions, which keep the per-layer terms of the patient.
+
+With a FitnessStore, values computed by earlier runs (or other scripts) for
+the same patient images are read from it before evaluating, and new values
+are added to it. The patient images are only decoded on the first real
+evaluation.
+
+SharedFitnessTable extends the memo to searches running in several worker
+processes (multi-start runs of compare_fusion_random_start.py): the fitness
+of every chromosome of each (patient, method) table lives in shared memory,
+and a chromosome being scored by one search is waited for by the others.
+"""
+
+import time
+import multiprocessing
+import numpy as np
+
+from objective_function import objective_function
+from objective_function_priority import objective_function_priority
+from objective_function_smooth import objective_function_smooth
+from objective_function_red_weighted import objective_function_red_weighted
+from incremental_evaluation import IncrementalEvaluator, METHODS
+from patient_layers import N_LAYERS
+from results_store import chromosome_mask
+import profiling
+
+# Fusion method of each objective function, for the incremental evaluator
+# and the fitness store
+FUSION_METHODS = {
+    objective_function: 'average',
+    objective_function_priority: 'priority',
+    objective_function_smooth: 'smooth',
+    objective_function_red_weighted: 'red_weighted',
+}
+
+# Objective function of each fusion method (--method of the drivers)
+OBJECTIVE_FUNCTIONS = {method: func for func, method in FUSION_METHODS.items()}
+
+
+class FitnessMemo:
+    """
+    Evaluates chromosomes of one patient with one objective function, storing
+    each fitness the first time it is computed.
+
+    objective_func: one of the objective functions of FUSION_METHODS
+    patient: PatientLayers of the patient
+    engine: scoring engine of the objective function ('float' or 'uint8')
+    incremental: use an IncrementalEvaluator instead of calling objective_func
+                 (only for the average and priority fusions)
+    store: persistent FitnessStore shared with other runs (only for the
+           objective functions of FUSION_METHODS)
+    """
+
+    def __init__(self, objective_func, patient, engine='uint8', incremental=True, store=None):
+        self.objective_func = objective_func
+        self.patient = patient
+        self.engine = engine
+        self.incremental = incremental and FUSION_METHODS.get(objective_func) in METHODS
+        self.evaluator = None
+        self.table = {}
+        self.hits = 0
+        self.misses = 0
+        self.store = store if objective_func in FUSION_METHODS else None
+        self.store_hits = 0
+        self._store_key = None
+
+    def __call__(self, chromosome):
+        key = tuple(int(b) for b in chromosome)
+        if key in self.table:
+            self.hits += 1
+            profiling.count('cache_hits')
+            return self.table[key]
+
+        if self.store is not None:
+            if self._store_key is None:
+                self._store_key = self.store.patient_key(self.patient.image_folder, self.patient.prefix,
+                                                         self.patient.n_layers)
+            if self._store_key is not None:
+                fitness = self.store.get(self._store_key, FUSION_METHODS[self.objective_func], key)
+                if fitness is not None:
+                    self.store_hits += 1
+                    self.table[key] = fitness
+                    return fitness
+
+        self.misses += 1
+        profiling.count('cache_misses')
+        if self.incremental:
+            if self.evaluator is None:
+                self.evaluator = IncrementalEvaluator(self.patient, FUSION_METHODS[self.objective_func])
+            fitness = self.evaluator(key)
+        else:
+            fitness, _ = self.objective_func(np.array(key, dtype=int), patient=self.patient,
+                                             fitness_only=True, engine=self.engine)
+        self.table[key] = fitness
+        if self.store is not None and self._store_key is not None:
+            self.store.put(self._store_key, FUSION_METHODS[self.objective_func], key, fitness)
+        return fitness
+
+    def report(self):
+        if self.store is not None:
+            return f'{self.misses} evaluations, {self.hits} cache hits, {self.store_hits} store hits'
+        return f'{self.misses} evaluations, {self.hits} cache hits'
+
+
+class SharedFitnessTable:
+    """
+    Fitness of the chromosomes of n_tables search spaces (one per patient
+    and method), shared by the processes that inherit it (ProcessPoolExecutor
+    initargs). Each chromosome is scored once: the first search that asks
+    for it evaluates it, the others wait for the value.
+
+    n_layers: chromosome length; every table has 2^n_layers - 1 states.
+    """
+
+    PENDING, RUNNING, DONE = 0, 1, 2
+
+    def __init__(self, n_tables, n_layers=N_LAYERS):
+        self.n_states = 2 ** n_layers
+        self.lock = multiprocessing.Lock()
+        self.status = multiprocessing.Array('b', n_tables * self.n_states, lock=False)
+        self.fitness = multiprocessing.Array('d', n_tables * self.n_states, lock=False)
+        self.evaluated = multiprocessing.Array('i', n_tables, lock=False)
+        self.hits = multiprocessing.Array('i', n_tables, lock=False)
+
+    def get(self, table, chromosome, evaluate):
+        """
+        Fitness of a chromosome in a table, computed with evaluate(chromosome)
+        (e.g. the FitnessMemo of this process) if no search has scored it.
+        """
+        index = table * self.n_states + chromosome_mask(chromosome)
+        while True:
+            with self.lock:
+                status = self.status[index]
+                if status == self.DONE:
+                    self.hits[table] += 1
+                    profiling.count('shared_hits')
+                    return self.fitness[index]
+                if status == self.PENDING:
+                    self.status[index] = self.RUNNING
+                    break
+            # Another search is scoring it
+            time.sleep(0.001)
+
+        try:
+            fitness = evaluate(chromosome)
+        except BaseException:
+            with self.lock:
+                self.status[index] = self.PENDING
+            raise
+        with self.lock:
+            self.fitness[index] = fitness
+            self.status[index] = self.DONE
+            self.evaluated[table] += 1
+        return fitness
+
+    def memo(self, table, evaluate):
+        """Callable chromosome -> fitness of one table, for the local searches."""
+        return lambda chromosome: self.get(table, chromosome, evaluate)
+
+    def covered(self, table):
+        """True when every chromosome of the table has been scored."""
+        return self.evaluated[table] == self.n_states - 1
+
+    def report(self, table):
+        return f'{self.evaluated[table]}/{self.n_states - 1} chromosomes evaluated, {self.hits[table]} shared hits'
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Persistent fitness store shared by all the scripts.
+
+Fitness values are kept in an SQLite file (fitness_store.sqlite by default)
+keyed by:
+ - the patient: SHA-256 of the contents of its 7 layer files (or n_layers),
+   so a patient moved to another folder keeps its values and a modified image
+   gets new ones
+ - the objective: fusion method and version of its objective function
+   (OBJECTIVE_VERSION of objective_function.py, objective_function_priority.py,
+   objective_function_smooth.py and objective_function_red_weighted.py)
+ - the chromosome: bit mask (bit i = layer N{i+1}, see results_store.py)
+
+The digest of each file is remembered with its size and modification time,
+so an unchanged cohort is not read again to find its keys. Every process opens
+its own connection; the database is in WAL mode, so readers never block and
+concurrent writers wait for each other.
+
+Usage:
+    store = get_store('fitness_store.sqlite')
+    key = store.patient_key(patient_folder, prefix)
+    fitness = store.get(key, 'average', chromosome)
+"""
+
+import os
+import sqlite3
+import hashlib
+import numpy as np
+
+from patient_layers import N_LAYERS
+from results_store import chromosome_mask
+import objective_function
+import objective_function_priority
+import objective_function_smooth
+import objective_function_red_weighted
+import profiling
+
+DEFAULT_STORE_PATH = 'fitness_store.sqlite'
+
+# Fusion method -> version of its objective function. Values stored with
+# another version are never returned.
+OBJECTIVE_VERSIONS = {
+    'average': objective_function.OBJECTIVE_VERSION,
+    'priority': objective_function_priority.OBJECTIVE_VERSION,
+    'smooth': objective_function_smooth.OBJECTIVE_VERSION,
+    'red_weighted': objective_function_red_weighted.OBJECTIVE_VERSION,
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS fitness (
+    patient TEXT NOT NULL,
+    objective TEXT NOT NULL,
+    chromosome INTEGER NOT NULL,
+    fitness REAL NOT NULL,
+    valid_count INTEGER,
+    total_detected INTEGER,
+    PRIMARY KEY (patient, objective, chromosome)
+);
+CREATE TABLE IF NOT EXISTS file_digests (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL
+);
+'''
+
+# Counts are filled in if a value was first stored without them
+UPSERT = '''
+INSERT INTO fitness VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (patient, objective, chromosome) DO UPDATE SET
+    valid_count = COALESCE(valid_count, excluded.valid_count),
+    total_detected = COALESCE(total_detected, excluded.total_detected)
+'''
+
+
+def objective_tag(method):
+    # 'average' -> 'average/v1'
+    if method not in OBJECTIVE_VERSIONS:
+        raise ValueError(f'Metodo de fusion desconocido: {method}')
+    return f'{method}/v{OBJECTIVE_VERSIONS[method]}'
+
+
+def _mask(chromosome):
+    return chromosome if isinstance(chromosome, int) else chromosome_mask(chromosome)
+
+
+class FitnessStore:
+    """
+    Connection of one process to a fitness store.
+    hits / misses count the lookups answered (or not) by the store.
+    """
+
+    def __init__(self, path=DEFAULT_STORE_PATH, timeout=60):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    def file_digest(self, path):
+        """SHA-256 of a file, read only if its size or modification time changed."""
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        row = self.conn.execute('SELECT size, mtime_ns, digest FROM file_digests WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            return row[2]
+
+        with profiling.span('store/hash'):
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO file_digests VALUES (?, ?, ?, ?)',
+                              (path, stat.st_size, stat.st_mtime_ns, digest.hexdigest()))
+        return digest.hexdigest()
+
+    def patient_key(self, folder, prefix, n_layers=N_LAYERS):
+        """
+        Key of a patient: digest of its n_layers layer files in folder (a
+        missing layer counts as such). None if the last layer (N7 by default)
+        is missing.
+        """
+        paths = [os.path.join(folder, f'{prefix}_N{i+1}_mask.bmp') for i in range(n_layers)]
+        if not os.path.exists(paths[-1]):
+            return None
+        digest = hashlib.sha256()
+        for path in paths:
+            digest.update((self.file_digest(path) if os.path.exists(path) else 'missing').encode())
+        return digest.hexdigest()
+
+    def get(self, key, method, chromosome):
+        """Stored fitness of a chromosome, or None."""
+        row = self.conn.execute('SELECT fitness FROM fitness WHERE patient = ? AND objective = ? AND chromosome = ?',
+                                (key, objective_tag(method), _mask(chromosome))).fetchone()
+        self._count(row is not None)
+        return None if row is None else row[0]
+
+    def get_all(self, key, method):
+        """Every stored value of a patient: {mask: (fitness, valid_count, total_detected)}."""
+        rows = self.conn.execute('SELECT chromosome, fitness, valid_count, total_detected FROM fitness '
+                                 'WHERE patient = ? AND objective = ?', (key, objective_tag(method)))
+        return {mask: (fitness, valid, total) for mask, fitness, valid, total in rows}
+
+    def get_counts(self, key, method, chromosomes):
+        """
+        (valid_count, total_detected) arrays of the given chromosomes, or None
+        if any of them is not stored with its pixel counts.
+        """
+        stored = self.get_all(key, method)
+        rows = [stored.get(_mask(chrom)) for chrom in chromosomes]
+        found = all(row is not None and row[1] is not None and row[2] is not None for row in rows)
+        self._count(found)
+        if not found:
+            return None
+        return (np.array([row[1] for row in rows], dtype=np.int64),
+                np.array([row[2] for row in rows], dtype=np.int64))
+
+    def put(self, key, method, chromosome, fitness, valid_count=None, total_detected=None):
+        self.put_many(key, method, [chromosome], [fitness],
+                      None if valid_count is None else [valid_count],
+                      None if total_detected is None else [total_detected])
+
+    def put_many(self, key, method, chromosomes, fitness, valid_count=None, total_detected=None):
+        """Stores the fitness (and optionally the pixel counts) of several chromosomes in one transaction."""
+        n = len(fitness)
+        valid_count = [None] * n if valid_count is None else [int(v) for v in valid_count]
+        total_detected = [None] * n if total_detected is None else [int(t) for t in total_detected]
+        tag = objective_tag(method)
+        rows = [(key, tag, _mask(chrom), float(fit), valid, total)
+                for chrom, fit, valid, total in zip(chromosomes, fitness, valid_count, total_detected)]
+        with self.conn:
+            self.conn.executemany(UPSERT, rows)
+
+    def _count(self, hit):
+        if hit:
+            self.hits += 1
+            profiling.count('store_hits')
+        else:
+            self.misses += 1
+            profiling.count('store_misses')
+
+    def close(self):
+        self.conn.close()
+
+
+_STORES = {}
+
+
+def get_store(path=DEFAULT_STORE_PATH):
+    """FitnessStore of path, opened once per process. None if path is empty."""
+    if not path:
+        return None
+    # A connection inherited by a forked worker must not be used
+    key = (os.path.abspath(path), os.getpid())
+    if key not in _STORES:
+        _STORES[key] = FitnessStore(path)
+    return _STORES[key]
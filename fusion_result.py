@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Result of evaluating a chromosome with one of the objective functions.
+
+`FusionResult` keeps the fitness, the composite image and the mask of fused
+pixels, so a driver can score a chromosome once and write its image later
+(`save_png`) instead of calling the objective function again with `save_path`.
+
+It still unpacks as the (fitness, composite) tuple the objective functions
+used to return:
+
+    fitness, img = objective_function(chrom, patient=patient)
+"""
+
+import numpy as np
+import cv2
+
+import profiling
+
+
+class FusionResult:
+    """
+    fitness:    score of the chromosome
+    composite:  RGB float32 [0,1] fused image (None on the fitness_only path)
+    mask:       (H,W) bool pixels taken from the fusion (None on the fitness_only path)
+    chromosome: evaluated chromosome
+    """
+
+    __slots__ = ('fitness', 'composite', 'mask', 'chromosome')
+
+    def __init__(self, fitness, composite=None, mask=None, chromosome=None):
+        self.fitness = fitness
+        self.composite = composite
+        self.mask = mask
+        self.chromosome = chromosome
+
+    def __iter__(self):
+        # (fitness, composite), as the tuple returned before
+        return iter((self.fitness, self.composite))
+
+    def __getitem__(self, index):
+        return (self.fitness, self.composite)[index]
+
+    def __len__(self):
+        return 2
+
+    def __repr__(self):
+        return f'FusionResult(fitness={self.fitness!r}, chromosome={self.chromosome!r})'
+
+    def to_bgr_uint8(self):
+        """Composite as written to the PNG files (BGR uint8)."""
+        if self.composite is None:
+            raise ValueError('El resultado no tiene imagen compuesta (fitness_only)')
+        img_bgr = cv2.cvtColor(self.composite, cv2.COLOR_RGB2BGR)
+        return (img_bgr * 255).astype(np.uint8)
+
+    def save_png(self, path):
+        """Writes the composite image to path."""
+        with profiling.span('write/png'):
+            cv2.imwrite(path, self.to_bgr_uint8())
+        return path
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Exhaustive evaluation of all the layer subsets in Gray-code order.
+
+The batch engines of batch_evaluation.py accumulate every chromosome at once,
+which needs (2^n - 1) accumulators per pixel: fine for the 127 chromosomes of
+7 layers, not for scanners with 10-16 layers. Here the subsets are visited in
+reflected Gray-code order, g(k) = k ^ (k >> 1), where consecutive subsets
+differ in one layer (the lowest set bit of k). An IncrementalEvaluator keeps
+the per-pixel state of the current subset and each step adds or removes that
+layer, so the whole sweep costs about one layer update per subset:
+ - average fusion: integer color sums and coverage counts
+ - priority fusion: index of the layer that owns each pixel
+ - red weighted fusion: exact weighted color sums of the detected pixels
+   (RedWeightedLayers of objective_function_red_weighted.py)
+
+Counts are identical to the other engines ('gray' engine of
+batch_evaluation.count_all_chromosomes).
+
+Usage:
+    python3 gray_sweep.py --image_folder Images/Folder1 --prefix C0683d --top 10
+    python3 gray_sweep.py --image_folder scans --prefix P001 --layers 12 --method priority
+"""
+
+import time
+import argparse
+import numpy as np
+
+from patient_layers import PatientLayers, N_LAYERS
+from batch_evaluation import SWEEP_METHODS, all_chromosomes, chromosome_codes, fitness_from_counts
+from incremental_evaluation import IncrementalEvaluator
+from objective_function_red_weighted import RedWeightedLayers
+import profiling
+
+
+def gray_code_walk(n_layers):
+    """
+    Returns (codes, flips) of the 2^n - 1 non-null subsets in Gray-code order:
+    codes[k] is the k-th subset (bit i = layer N{i+1}) and flips[k] the layer
+    that changes from the previous one (the walk starts at the null subset).
+    """
+    k = np.arange(1, 2 ** n_layers, dtype=np.int64)
+    codes = k ^ (k >> 1)
+    flips = np.log2(k & -k).astype(int)
+    return codes, flips
+
+
+def gray_sweep(patient, method='average'):
+    """
+    Walks all the non-null subsets of the layers of a PatientLayers.
+    Returns (codes, valid_count, total_detected) in Gray-code order.
+    """
+    codes, flips = gray_code_walk(patient.n_layers)
+    valid_count = np.zeros(len(codes), dtype=np.int64)
+    total_detected = np.zeros(len(codes), dtype=np.int64)
+
+    if method == 'red_weighted':
+        evaluator = RedWeightedLayers(patient)
+    else:
+        evaluator = IncrementalEvaluator(patient, method)
+    with profiling.span(f'gray/{method}'):
+        for k, i in enumerate(flips):
+            valid_count[k], total_detected[k] = evaluator.step(i)
+    return codes, valid_count, total_detected
+
+
+def gray_counts(patient, method='average', chromosomes=None):
+    """
+    (valid_count, total_detected) of the given chromosomes (all of them in
+    all_chromosomes order by default), from a Gray-code sweep.
+    """
+    if chromosomes is None:
+        chromosomes = all_chromosomes(patient.n_layers)
+    codes, valid_count, total_detected = gray_sweep(patient, method)
+
+    # Position of each subset in the walk
+    position = np.empty(len(codes) + 1, dtype=np.int64)
+    position[codes] = np.arange(len(codes))
+    index = position[chromosome_codes(chromosomes)]
+    return valid_count[index], total_detected[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exhaustive Gray-code sweep of the layer subsets of one patient')
+    parser.add_argument('--image_folder', type=str, required=True, help='Folder containing the patient images')
+    parser.add_argument('--prefix', type=str, required=True, help='Patient prefix (e.g., C0683d)')
+    parser.add_argument('--layers', type=int, default=N_LAYERS, help='Number of layers (N1..N{layers})')
+    parser.add_argument('--method', type=str, default='average', choices=SWEEP_METHODS,
+                        help='Fusion method')
+    parser.add_argument('--top', type=int, default=10, help='Number of best subsets to print')
+    args = parser.parse_args()
+
+    patient = PatientLayers(args.image_folder, args.prefix, n_layers=args.layers)
+    start_time = time.time()
+    codes, valid_count, total_detected = gray_sweep(patient, args.method)
+    elapsed = time.time() - start_time
+    print(f'{len(codes)} subsets of {args.layers} layers evaluated in {elapsed:.2f} seconds')
+
+    fitness = fitness_from_counts(valid_count, total_detected)
+    for rank, k in enumerate(np.argsort(-fitness, kind='stable')[:args.top], 1):
+        chromosome = (codes[k] >> np.arange(args.layers)) & 1
+        print(f'{rank}. Fitness: {fitness[k]:.6f}, Chromosome: {chromosome.tolist()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Incremental evaluation of single-bit flips for the local searches.
+
+Every neighbor visited by `single_swap` differs from the current chromosome in
+one layer. `IncrementalEvaluator` keeps the per-pixel state of the fusion of
+the current chromosome and scores a flip by adding or removing the
+contribution of that single layer:
+ - average fusion: integer color sums and coverage counts (BGR uint8 layers,
+   as the 'uint8' engine of batch_evaluation).
+ - priority fusion: index of the layer that owns each pixel.
+
+Only the pixels detected by the flipped layer can change, so a neighbor costs
+one layer of work instead of a full fusion of up to 7 layers. The fitness is
+identical to the objective functions (exact ties of the average are re-checked
+in float32, as in batch_evaluation.average_counts_uint8).
+
+`step` flips one layer and keeps the result as the current chromosome; the
+Gray-code sweep (gray_sweep.py) visits every subset of layers that way.
+"""
+
+import numpy as np
+
+from batch_evaluation import (_detected_pixels, _average_valid_float, valid_color_uint8,
+                              fitness_from_counts)
+import profiling
+
+METHODS = ('average', 'priority')
+
+
+class IncrementalEvaluator:
+    """
+    Fitness of chromosomes close to the current one, for one patient and one
+    fusion method.
+
+    Calling the evaluator with a chromosome at Hamming distance d of the
+    current one moves the current chromosome d-1 steps towards it and scores
+    the last flip, so consecutive neighbors of a local search cost one layer
+    each. The null chromosome has no fusion and is rejected.
+    """
+
+    def __init__(self, patient, method='average'):
+        if method not in METHODS:
+            raise ValueError(f'Metodo de fusion desconocido: {method}')
+        self.patient = patient
+        self.method = method
+
+        # Layers restricted to the pixels detected by any layer: (layers,n,3), (layers,n)
+        self.n_layers = patient.n_layers
+        self.pixels, self.masks = _detected_pixels(patient, range(self.n_layers), engine='uint8')
+        self.layer_pixels = [np.flatnonzero(self.masks[i]) for i in range(self.n_layers)]
+        if method == 'average':
+            self.layer_colors = [self.pixels[i, p].astype(np.uint16) for i, p in enumerate(self.layer_pixels)]
+        else:
+            self.layer_valid = valid_color_uint8(self.pixels) & self.masks
+            self.layer_visible = np.any(self.pixels > 0, axis=2) & self.masks
+
+        self.chromosome = None
+        self._last_flip = None
+
+    def __call__(self, chromosome):
+        chromosome = np.asarray(chromosome, dtype=bool)
+        if chromosome.size != self.n_layers:
+            raise ValueError(f'El cromosoma debe tener exactamente {self.n_layers} elementos')
+        if not chromosome.any():
+            raise ValueError('El cromosoma nulo no tiene fusion')
+        profiling.count('evaluations')
+
+        with profiling.span(f'incremental/{self.method}'):
+            if self.chromosome is None:
+                self.reset(chromosome)
+
+            diff = np.flatnonzero(self.chromosome != chromosome)
+            if len(diff) == 0:
+                valid_count, total_detected = self.valid_count, self.total_detected
+            else:
+                # Walk towards the chromosome through non-null intermediate steps
+                # (layers are added before any is removed), then score the last flip
+                diff = sorted(diff, key=lambda i: self.chromosome[i])
+                for i in diff[:-1]:
+                    self._apply(self._scored_flip(i))
+                self._last_flip = (diff[-1], self._flip(diff[-1]))
+                valid_count, total_detected = self._last_flip[1][:2]
+
+        return float(fitness_from_counts(valid_count, total_detected))
+
+    def reset(self, chromosome):
+        """Builds the per-pixel state of `chromosome` from scratch."""
+        chromosome = np.asarray(chromosome, dtype=bool)
+        n = self.masks.shape[1]
+        self.chromosome = np.zeros(self.n_layers, dtype=bool)
+        self.valid = np.zeros(n, dtype=bool)
+        self.valid_count = 0
+        self.total_detected = 0
+        if self.method == 'average':
+            self.sums = np.zeros((n, 3), dtype=np.uint16)
+            self.count = np.zeros(n, dtype=np.uint16)
+        else:
+            self.detected = np.zeros(n, dtype=bool)
+            self.owner = np.full(n, -1, dtype=np.int8)
+
+        for i in np.flatnonzero(chromosome):
+            self._apply(self._flip(i))
+
+    def step(self, i):
+        """
+        Flips layer i of the current chromosome and makes the result the
+        current one. Returns its (valid_count, total_detected).
+        """
+        if self.chromosome is None:
+            self.reset(np.zeros(self.n_layers, dtype=bool))
+        self._apply(self._scored_flip(i))
+        return self.valid_count, self.total_detected
+
+    def _flip(self, i):
+        """
+        Scores the current chromosome with layer i flipped.
+        Returns (valid_count, total_detected, chromosome, pixels, state) where
+        state holds the new per-pixel values of `pixels`.
+        """
+        chromosome = self.chromosome.copy()
+        chromosome[i] = not chromosome[i]
+        if self.method == 'average':
+            pixels, detected_change, state = self._flip_average(i, chromosome)
+        else:
+            pixels, detected_change, state = self._flip_priority(i, chromosome)
+
+        valid_count = self.valid_count - int(self.valid[pixels].sum()) + int(state[0].sum())
+        return valid_count, self.total_detected + detected_change, chromosome, pixels, state
+
+    def _scored_flip(self, i):
+        # The last scored flip is reused when a search accepts that neighbor
+        if self._last_flip is not None and self._last_flip[0] == i:
+            return self._last_flip[1]
+        return self._flip(i)
+
+    def _apply(self, flip):
+        # Makes a scored flip the current chromosome
+        self._last_flip = None
+        self.valid_count, self.total_detected, self.chromosome, pixels, state = flip
+        self.valid[pixels] = state[0]
+        if self.method == 'average':
+            self.sums[pixels] = state[1]
+            self.count[pixels] = state[2]
+        else:
+            self.detected[pixels] = state[1]
+            self.owner[pixels] = state[2]
+
+    # _flip_average / _flip_priority return (pixels, change of total_detected, state)
+    # with the new per-pixel state of `pixels`, valid first
+
+    def _flip_average(self, i, chromosome):
+        pixels = self.layer_pixels[i]
+        color = self.layer_colors[i]
+        old_count = self.count[pixels]
+        if chromosome[i]:
+            sums = self.sums[pixels] + color
+            count = old_count + 1
+            # Pixels that enter the fusion
+            detected_change = int(np.count_nonzero(old_count == 0))
+        else:
+            sums = self.sums[pixels] - color
+            count = old_count - 1
+            detected_change = -int(np.count_nonzero(count == 0))
+
+        blue = sums[:, 0]
+        green = sums[:, 1]
+        red = sums[:, 2]
+        min_red = 60 * count
+        valid = (red >= min_red) & (red > green) & (red > blue) & (count > 0)
+
+        # Exact ties between overlapping layers are re-checked as the float engine
+        ties = (count > 1) & ((red == green) | (red == blue) | (red == min_red))
+        if ties.any():
+            cols = pixels[ties]
+            valid[ties] = _average_valid_float(self.pixels[:, cols], self.masks[:, cols],
+                                               chromosome[np.newaxis], np.ones((1, len(cols)), dtype=bool))[0]
+
+        return pixels, detected_change, (valid, sums, count)
+
+    def _flip_priority(self, i, chromosome):
+        pixels = self.layer_pixels[i]
+        owner = self.owner[pixels]
+        if chromosome[i]:
+            # Layer i claims the free pixels and those owned by later layers
+            changed = (owner < 0) | (owner > i)
+            pixels = pixels[changed]
+            owner = np.full(len(pixels), i, dtype=np.int8)
+        else:
+            # Pixels owned by layer i go to the next selected layer that detects them
+            pixels = pixels[owner == i]
+            owner = np.full(len(pixels), -1, dtype=np.int8)
+            for j in np.flatnonzero(chromosome[i + 1:]) + i + 1:
+                claim = (owner < 0) & self.masks[j, pixels]
+                owner[claim] = j
+
+        owned = owner >= 0
+        valid = np.zeros(len(pixels), dtype=bool)
+        detected = np.zeros(len(pixels), dtype=bool)
+        valid[owned] = self.layer_valid[owner[owned], pixels[owned]]
+        detected[owned] = self.layer_visible[owner[owned], pixels[owned]]
+        detected_change = int(detected.sum()) - int(self.detected[pixels].sum())
+        return pixels, detected_change, (valid, detected, owner)
@@ -4,8 +4,9 @@ local_search.py
 
 Implementa una búsqueda local basada en single swap con orden aleatorio y reinicio
 sobre el espacio de vectores binarios de 7 bits. La evaluación se realiza usando
-`objective_function`, que procesa imágenes de impedancia eléctrica
-para calcular el fitness del individuo.
+`objective_function` (o la función objetivo del método de fusión elegido con
+--method), que procesa imágenes de impedancia eléctrica para calcular el fitness
+del individuo.
 
 Salida:
  - Guarda el mejor cromosoma en un archivo .mat para compatibilidad con MATLAB
@@ -26,21 +27,38 @@ import glob
 from datetime import datetime
 
 from objective_function import objective_function
-from utils_matlab_io import save_chromosome_mat, load_chromosome_mat
+from patient_layers import PatientLayers
+from fitness_memo import FitnessMemo, OBJECTIVE_FUNCTIONS
+from utils_matlab_io import load_chromosome_mat
+from artifact_writer import ArtifactWriter, raise_write_errors
+from checkpoint import search_tracker
+from fitness_store import get_store, DEFAULT_STORE_PATH
+import profiling
 
 
-def single_swap(chromosome: np.ndarray, image_folder: str, prefix: str, time_limit: int = 1800):
+def single_swap(chromosome: np.ndarray, image_folder: str, prefix: str, time_limit: int = 1800,
+                memo: FitnessMemo = None, on_improvement=None):
     """
     Implements a local search using single-bit flips in random order.
     Starts with the given chromosome, evaluates individual flips, accepts improvements, and resets
     the search order. Continues until no improvements are found or the time limit is reached.
+    Fitness values are taken from `memo` (created for the patient if not given), so no
+    chromosome is evaluated twice.
+    `on_improvement(x_best, f_best)` is called with the starting point and after each
+    improvement, and with improved=False after the other evaluations (used to
+    checkpoint the search and its elapsed time).
     Returns the best chromosome found and its fitness.
     """
     start_ls = time.time()
+
+    if memo is None:
+        memo = FitnessMemo(objective_function, PatientLayers(image_folder, prefix, preload=False))
     
     # Best so far
     x_best = chromosome[:]
-    f_best, _ = objective_function(x_best, image_folder=image_folder, prefix=prefix)
+    f_best = memo(x_best)
+    if on_improvement is not None:
+        on_improvement(x_best, f_best)
 
     mejora = True
     n = len(chromosome)
@@ -59,20 +77,25 @@ def single_swap(chromosome: np.ndarray, image_folder: str, prefix: str, time_lim
                 if time.time() - start_ls > time_limit:
                     break  # If time limit exceeded before calculating error, break while
 
-                f_temp, _ = objective_function(x_temp, image_folder=image_folder, prefix=prefix)
+                f_temp = memo(x_temp)
                 
                 if f_temp > f_best:
                     x_best = x_temp[:]
                     f_best = f_temp
                     mejora = True  # There was an improvement, continue iterating
+                    if on_improvement is not None:
+                        on_improvement(x_best, f_best)
 
                     # Circular random change on the new solution
                     indices = random.sample(list(range(i + 1, n)) + list(range(0, i)), n - 1)
                     break  # Restart iteration with the new best solution
+                elif on_improvement is not None:
+                    on_improvement(x_best, f_best, improved=False)
     return x_best, f_best
 
 
-def local_search(image_folder: str, prefix: str, out_dir: str, initial_vector_path: str, time_limit: int = 1800):
+def local_search(image_folder: str, prefix: str, out_dir: str, initial_vector_path: str, time_limit: int = 1800,
+                 checkpoint_dir: str = None, fitness_store: str = None, method: str = 'average', seed: int = None):
     if not os.path.exists(out_dir):
         os.makedirs(out_dir, exist_ok=True)
 
@@ -80,23 +103,43 @@ def local_search(image_folder: str, prefix: str, out_dir: str, initial_vector_pa
     """
     Runs the local search with an initial chromosome loaded from a file, saves the result
     in .mat and .png files, and prints the best chromosome and its fitness.
+    With `checkpoint_dir` the search state is saved there at each improvement, and an
+    interrupted search of the patient continues from its best chromosome.
+    With `fitness_store` (path of a fitness_store.py database) fitness values are shared
+    with previous runs.
+    `method` is the fusion method ('average', 'priority', 'smooth' or 'red_weighted',
+    see fitness_memo.OBJECTIVE_FUNCTIONS).
+    With `seed` the random module is reseeded before the search (the order of the
+    flips); otherwise the search uses the current random state.
     """
+    if seed is not None:
+        random.seed(seed)
     initial_chrom = load_chromosome_mat(initial_vector_path)
     print(f'Initial: {initial_chrom}')
+    initial_chrom, time_limit, on_improvement = search_tracker(checkpoint_dir, prefix, initial_chrom, time_limit)
 
-    best, best_score = single_swap(initial_chrom, image_folder, prefix, time_limit)
+    memo = FitnessMemo(OBJECTIVE_FUNCTIONS[method], PatientLayers(image_folder, prefix, preload=False),
+                       store=get_store(fitness_store))
+    with profiling.span('search/single_swap'):
+        best, best_score = single_swap(initial_chrom, image_folder, prefix, time_limit, memo=memo,
+                                       on_improvement=on_improvement)
 
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     chrom_path = os.path.join(out_dir, f'best_chrom_{prefix}_{timestamp}.mat')
     img_path = os.path.join(out_dir, f'best_img_{prefix}_{timestamp}.png')
 
-    save_chromosome_mat(best, chrom_path)
-    final_score, final_img = objective_function(best, image_folder=image_folder, prefix=prefix, save_path=img_path)
+    # The .mat is written while the final composite is fused. A failed write
+    # raises, so main.py does not checkpoint the patient
+    with ArtifactWriter() as writer:
+        writer.save_mat(best, chrom_path)
+        writer.save_png(memo.objective_func(best, patient=memo.patient), img_path)
+        raise_write_errors(writer.flush())
 
     print('\n=== RESULTADO FINAL ===')
     print(f'Best chromosome: {best} (fitness: {best_score:.6f})')
     print(f'Chromosome saved: {chrom_path}')
     print(f'Image saved: {img_path}')
+    print(f'Fitness cache: {memo.report()}')
 
     return best, best_score, chrom_path, img_path
 
@@ -108,9 +151,22 @@ def main():
     parser.add_argument('--out_dir', type=str, default='results_local_search')
     parser.add_argument('--initial_vector', type=str, required=True, help='Path to .mat file containing the initial chromosome')
     parser.add_argument('--time_limit', type=int, default=1800, help='Time limit in seconds')
+    parser.add_argument('--fitness_store', type=str, default=DEFAULT_STORE_PATH,
+                        help="Persistent fitness store shared with other runs ('' to disable)")
+    parser.add_argument('--method', type=str, default='average', choices=sorted(OBJECTIVE_FUNCTIONS),
+                        help='Fusion method of the objective function')
+    parser.add_argument('--profile', action='store_true', help='Save a PROFILE_*.json report of the run in out_dir')
     args = parser.parse_args()
 
-    local_search(args.image_folder, args.prefix, args.out_dir, args.initial_vector, time_limit=args.time_limit)
+    if args.profile:
+        profiling.enable()
+
+    local_search(args.image_folder, args.prefix, args.out_dir, args.initial_vector, time_limit=args.time_limit,
+                 fitness_store=args.fitness_store, method=args.method)
+
+    if args.profile:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        profiling.write_report(os.path.join(args.out_dir, f'PROFILE_{args.prefix}_{timestamp}.json'))
 
 
 if __name__ == '__main__':
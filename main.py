@@ -2,61 +2,22 @@
 """
 Orchestrates the local search on all 15 validation patients.
 Uses the same patient split logic as find_general_vector.py (seed 42).
-Calls local_search.py for each patient.
+Runs local_search.local_search for each patient in a pool of worker processes.
 """
 
 import os
-import glob
 import random
-import subprocess
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 
-
-def get_all_prefixes(image_folder):
-    """
-    Scans the image_folder to find all unique patient prefixes.
-    Assumes structure: image_folder/*/Prefix_N#_mask.bmp
-    """
-    prefixes = set()
-    search_path = os.path.join(image_folder, '*', '*.bmp')
-    files = glob.glob(search_path)
-    
-    for file_path in files:
-        filename = os.path.basename(file_path)
-        parts = filename.split('_')
-        if len(parts) >= 1:
-            prefixes.add(parts[0])
-            
-    return sorted(list(prefixes))
-
-
-def get_validation_patients(image_folder):
-    # Returns the 15 validation patients using the same logic as find_general_vector.py.
-    all_prefixes = get_all_prefixes(image_folder)
-    total_patients = len(all_prefixes)
-    
-    if total_patients < 35:
-        print("Warning: Less than 35 patients found. Using all available as validation.")
-        return all_prefixes
-        
-    random.seed(42)  # Must match find_general_vector.py
-    random.shuffle(all_prefixes)
-    
-    # First 35 are training, last 15 are validation
-    val_prefixes = all_prefixes[35:]
-    return val_prefixes
-
-
-def find_patient_folder(base_folder, prefix):
-    """
-    Finds the subfolder containing images for the given patient prefix.
-    """
-    for subdir in glob.glob(os.path.join(base_folder, '*')):
-        if os.path.isdir(subdir):
-            if glob.glob(os.path.join(subdir, f'{prefix}_*.bmp')):
-                return subdir
-    return None
+from local_search import local_search
+from dataset_catalog import find_patient_folder
+from patient_split import get_validation_patients
+from checkpoint import Checkpoint
+from fitness_store import DEFAULT_STORE_PATH
+from fitness_memo import OBJECTIVE_FUNCTIONS
+import profiling
 
 
 def main():
@@ -65,8 +26,18 @@ def main():
     parser.add_argument('--initial_vector', type=str, required=True, help='Path to .mat file containing the initial chromosome')
     parser.add_argument('--time_limit', type=int, default=1800, help='Time limit in seconds per patient')
     parser.add_argument('--out_dir', type=str, default='results_local_search', help='Output directory for results')
+    parser.add_argument('--workers', type=int, default=1, help='Number of patients searched in parallel')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted run from the checkpoint in out_dir')
+    parser.add_argument('--fitness_store', type=str, default=DEFAULT_STORE_PATH,
+                        help="Persistent fitness store shared with other runs ('' to disable)")
+    parser.add_argument('--method', type=str, default='average', choices=sorted(OBJECTIVE_FUNCTIONS),
+                        help='Fusion method of the objective function')
+    parser.add_argument('--profile', action='store_true', help='Save a PROFILE_*.json report of the run in out_dir')
     args = parser.parse_args()
 
+    if args.profile:
+        profiling.enable()
+
     print("=" * 60)
     print("VALIDATION SET LOCAL SEARCH")
     print("=" * 60)
@@ -77,60 +48,71 @@ def main():
     print(val_patients)
     print()
     
-    results = []
+    # Finished patients, and the state of the searches in progress (saved by the workers)
+    checkpoint = Checkpoint(os.path.join(args.out_dir, 'checkpoint_validation'),
+                            {'image_folder': args.image_folder, 'initial_vector': args.initial_vector,
+                             'time_limit': args.time_limit, 'method': args.method, 'patients': val_patients},
+                            args.resume)
     
-    for i, patient in enumerate(val_patients, 1):
-        print(f"\n{'=' * 60}")
-        print(f"[{i}/{len(val_patients)}] Processing patient: {patient}")
-        print(f"{'=' * 60}")
-        
-        # Find patient folder
-        patient_folder = find_patient_folder(args.image_folder, patient)
-        if patient_folder is None:
-            print(f"ERROR: Could not find folder for patient {patient}")
-            continue
+    # Locate every patient and submit its local search to the pool. The workers
+    # are forked after split_patients seeded the random module, so each search
+    # gets its own seed (from OS entropy, as the separate runs of local_search.py did)
+    entropy = random.SystemRandom()
+    futures = {}
+    seeds = {}
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for i, patient in enumerate(val_patients, 1):
+            if checkpoint.is_done(patient):
+                print(f"[{i}/{len(val_patients)}] Patient {patient} already completed (checkpoint), skipped")
+                continue
             
-        print(f"Located in: {patient_folder}")
+            patient_folder = find_patient_folder(args.image_folder, patient)
+            if patient_folder is None:
+                print(f"ERROR: Could not find folder for patient {patient}")
+                continue
+                
+            seeds[patient] = entropy.randrange(2 ** 32)
+            print(f"[{i}/{len(val_patients)}] Submitted patient: {patient} (located in: {patient_folder}, "
+                  f"seed {seeds[patient]})")
+            task = (local_search, patient_folder, patient, args.out_dir, args.initial_vector)
+            if args.profile:
+                # Workers return their own spans and counters with the result
+                task = (profiling.profiled_call,) + task
+            future = executor.submit(*task, time_limit=args.time_limit, checkpoint_dir=checkpoint.directory,
+                                     fitness_store=args.fitness_store, method=args.method, seed=seeds[patient])
+            futures[future] = patient
         
-        # Run local_search.py as subprocess
-        cmd = [
-            'python3', 'local_search.py',
-            '--image_folder', patient_folder,
-            '--prefix', patient,
-            '--initial_vector', args.initial_vector,
-            '--time_limit', str(args.time_limit),
-            '--out_dir', args.out_dir
-        ]
-        
-        try:
-            result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-            print(result.stdout)
-            
-            # Try to extract fitness from output
-            for line in result.stdout.split('\n'):
-                if 'fitness:' in line.lower():
-                    # Extract fitness value
-                    try:
-                        fitness_str = line.split('fitness:')[1].strip().rstrip(')')
-                        fitness = float(fitness_str)
-                        results.append((patient, fitness))
-                    except:
-                        pass
-                        
-        except subprocess.CalledProcessError as e:
-            print(f"ERROR processing {patient}:")
-            print(e.stderr)
+        # Checkpoint each patient as soon as its search finishes
+        for future in as_completed(futures):
+            patient = futures[future]
+            try:
+                result = future.result()
+                if args.profile:
+                    result, worker_profile = result
+                    profiling.merge(worker_profile)
+                best, fitness, chrom_path, img_path = result
+                checkpoint.complete(patient, {'chromosome': best, 'fitness': fitness, 'seed': seeds[patient],
+                                              'chrom_path': chrom_path, 'img_path': img_path},
+                                    searches=(patient,))
+            except Exception as e:
+                print(f"ERROR processing {patient}: {e}")
+
+    # Results in validation order (including the patients of a resumed run)
+    results = [(patient, checkpoint.result(patient)['fitness'])
+               for patient in val_patients if checkpoint.is_done(patient)]
     
     # Save summary
     print(f"\n{'=' * 60}")
     print("VALIDATION SEARCH COMPLETED")
     print(f"{'=' * 60}")
     
-    summary_path = os.path.join(args.out_dir, f'SUMMARY_VALIDATION_{datetime.now().strftime("%Y%m%d_%H%M%S")}.txt')
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    summary_path = os.path.join(args.out_dir, f'SUMMARY_VALIDATION_{timestamp}.txt')
     with open(summary_path, 'w') as f:
         f.write("Summary of Local Search on Validation Set\n")
         f.write(f"Initial Vector File: {args.initial_vector}\n")
-        f.write(f"Time Limit per Patient: {args.time_limit}s\n\n")
+        f.write(f"Time Limit per Patient: {args.time_limit}s\n")
+        f.write(f"Fusion Method: {args.method}\n\n")
         f.write(f"Validation Patients: {val_patients}\n\n")
         f.write("Results:\n")
         for patient, fitness in results:
@@ -139,6 +121,9 @@ def main():
     print(f"\nSummary saved to: {summary_path}")
     print(f"Processed {len(results)}/{len(val_patients)} patients successfully")
 
+    if args.profile:
+        profiling.write_report(os.path.join(args.out_dir, f'PROFILE_VALIDATION_{timestamp}.json'))
+
 
 if __name__ == '__main__':
     main()
@@ -6,47 +6,60 @@ without relying on MATLAB.
 Uses OpenCV to read images, scikit-image for region analysis, etc.
 """
 
-import os
 import numpy as np
 import cv2
 
-def red_detection(img, threshold=0.96):
-    """
-    Detects red areas in an RGB image [0,1].
-    Replicating redDetection.m
-    """
-    red_channel = img[:, :, 0]
-    blue_channel = img[:, :, 2]  # OpenCV is BGR, so blue is 2
+from patient_layers import PatientLayers, red_detection
+from batch_evaluation import count_function, fitness_from_counts
+from fusion_result import FusionResult
+import profiling
 
-    # Equalize histogram in red
-    red_uint8 = (red_channel * 255).astype(np.uint8)
-    red_eq = cv2.equalizeHist(red_uint8) / 255.0
+# Bump when the fitness of a chromosome changes, so the values of the
+# persistent fitness store (fitness_store.py) computed before are not used
+OBJECTIVE_VERSION = 1
 
-    red_areas = red_eq > threshold
 
-    # Remove black background
-    background_mask = (red_channel < 0.05) & (blue_channel < 0.05)
-    red_areas[background_mask] = False
+def objective_function(chromosome, image_folder=None, prefix=None, save_path=None, patient=None,
+                       fitness_only=False, engine='float'):
+    """
+    Evaluates a chromosome using AVERAGE fusion.
+
+    The layers are read from `image_folder`/`prefix`, or taken from `patient`
+    (a PatientLayers cache) when given.
 
-    return red_areas.astype(bool)
+    Returns a FusionResult (fitness, composite image and fused mask), which
+    unpacks as (fitness, composite) and can write the image later with save_png.
 
-def objective_function(chromosome, image_folder, prefix, save_path=None):
-  
+    With fitness_only=True (and no save_path) the score is computed directly from
+    the layers and masks, without building the composite image (the composite
+    of the result is None). `engine` ('float' or 'uint8', see batch_evaluation) selects the
+    arithmetic of this path; both give the same fitness.
+    """
     chromosome = np.asarray(chromosome, dtype=int)
-    if chromosome.size != 7:
-        raise ValueError('El cromosoma debe tener exactamente 7 elementos')
+
+    # Decoded layers (read from disk only if no cache was given). Without a
+    # cache the chromosome gives the number of layers of the patient
+    if patient is None:
+        patient = PatientLayers(image_folder, prefix, preload=False, n_layers=chromosome.size)
+    if chromosome.size != patient.n_layers:
+        raise ValueError(f'El cromosoma debe tener exactamente {patient.n_layers} elementos')
 
     # If all zeros, select one randomly
     if chromosome.sum() == 0:
-        idx = np.random.randint(0, 7)
+        idx = np.random.randint(0, patient.n_layers)
         chromosome[idx] = 1
 
-    # Load base image N7
-    base_path = os.path.join(image_folder, f'{prefix}_N7_mask.bmp')
-    if not os.path.exists(base_path):
-        raise FileNotFoundError(f'Imagen base N7 no encontrada: {base_path}')
-    img_ref = cv2.imread(base_path).astype(np.float32) / 255.0
-    img_ref = cv2.cvtColor(img_ref, cv2.COLOR_BGR2RGB)  # Convertir a RGB
+    profiling.count('evaluations')
+
+    if fitness_only and not save_path:
+        for i in np.flatnonzero(chromosome):
+            if not patient.has_layer(i):
+                print(f'Falta {patient.layer_path(i)}, se omite')
+        with profiling.span('average/scoring'):
+            valid_count, total_detected = count_function('average', engine)(patient, chromosome[np.newaxis])
+        return FusionResult(fitness_from_counts(valid_count, total_detected)[0], chromosome=chromosome)
+
+    img_ref = patient.img_ref
 
     img_size = img_ref.shape[:2]
     
@@ -57,78 +70,73 @@ def objective_function(chromosome, image_folder, prefix, save_path=None):
     hay_capas = False
     
     # Process selected layers
-    for i in range(7):
+    for i in range(patient.n_layers):
         if chromosome[i] == 0:
             continue
     
         hay_capas = True
-        filename = f'{prefix}_N{i+1}_mask.bmp'
-        filepath = os.path.join(image_folder, filename)
-        if not os.path.exists(filepath):
-            print(f'Falta {filepath}, se omite')
+        if not patient.has_layer(i):
+            print(f'Falta {patient.layer_path(i)}, se omite')
             continue
     
-        current_img = cv2.imread(filepath).astype(np.float32) / 255.0
-        current_img = cv2.cvtColor(current_img, cv2.COLOR_BGR2RGB)
-    
-        mask = red_detection(current_img)
-    
-        masks_list.append(mask)
-        images_list.append(current_img)
+        masks_list.append(patient.mask(i))
+        images_list.append(patient.image(i))
     
     if not hay_capas:
         fitness = -1.0
         img_combinada = img_ref
         if save_path:
             cv2.imwrite(save_path, (img_combinada * 255).astype(np.uint8))
-        return fitness, img_combinada
+        return FusionResult(fitness, img_combinada, chromosome=chromosome)
     
-    # Merge masks
-    final_mask = np.logical_or.reduce(masks_list)
+    with profiling.span('average/fusion'):
+        # Merge masks
+        final_mask = np.logical_or.reduce(masks_list)
     
-    fusion_color = np.zeros((img_size[0], img_size[1], 3), dtype=np.float32)
-    count = np.zeros(img_size, dtype=int)
+        fusion_color = np.zeros((img_size[0], img_size[1], 3), dtype=np.float32)
+        count = np.zeros(img_size, dtype=int)
     
-    for mask, img in zip(masks_list, images_list):
-        fusion_color += img * mask.astype(float)[:, :, np.newaxis]
-        count += mask.astype(int)
+        for mask, img in zip(masks_list, images_list):
+            fusion_color += img * mask.astype(float)[:, :, np.newaxis]
+            count += mask.astype(int)
     
-    # Average colors where there is overlap
-    valid = count > 0
-    fusion_color[valid] /= count[valid, np.newaxis]
+        # Average colors where there is overlap
+        valid = count > 0
+        fusion_color[valid] /= count[valid, np.newaxis]
     
-    # Combine with background
-    img_combinada = img_ref.copy()
-    img_combinada[final_mask] = fusion_color[final_mask]
-
-    total_detected = final_mask.sum()
-    if total_detected == 0:
-        fitness = 0.0
-    else:
-        # Extract RGB values of active pixels
-        pixels = img_combinada[final_mask]  # (n_pixels, 3)
-        red = pixels[:, 0]
-        green = pixels[:, 1]
-        blue = pixels[:, 2]
-
-        # Valid pixels: red between 60/255 and 1, and red > green and red > blue
-        valid = (red >= 60/255) & (red > green) & (red > blue)
-        valid_count = valid.sum()
-
-        # Quality score
-        quality = valid_count / total_detected
-
-        # Presence score
-        presence = valid_count / (valid_count + 50)
-
-        # Weighted fitness
-        fitness = 0.8 * quality + 0.2 * presence
-
+        # Combine with background
+        img_combinada = img_ref.copy()
+        img_combinada[final_mask] = fusion_color[final_mask]
+
+    with profiling.span('average/scoring'):
+        total_detected = final_mask.sum()
+        if total_detected == 0:
+            fitness = 0.0
+        else:
+            # Extract RGB values of active pixels
+            pixels = img_combinada[final_mask]  # (n_pixels, 3)
+            red = pixels[:, 0]
+            green = pixels[:, 1]
+            blue = pixels[:, 2]
+
+            # Valid pixels: red between 60/255 and 1, and red > green and red > blue
+            valid = (red >= 60/255) & (red > green) & (red > blue)
+            valid_count = valid.sum()
+
+            # Quality score
+            quality = valid_count / total_detected
+
+            # Presence score
+            presence = valid_count / (valid_count + 50)
+
+            # Weighted fitness
+            fitness = 0.8 * quality + 0.2 * presence
+
+    result = FusionResult(fitness, img_combinada, final_mask, chromosome)
     if save_path:
-        img_bgr = cv2.cvtColor(img_combinada, cv2.COLOR_RGB2BGR)
-        cv2.imwrite(save_path, (img_bgr * 255).astype(np.uint8))
+        result.save_png(save_path)
 
-    return fitness, img_combinada
+    return result
 
 if __name__ == '__main__':
     # Test
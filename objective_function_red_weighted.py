@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Implements the RED WEIGHTED fusion of fuseWeightedRedPriority.m in NumPy.
+
+Each selected layer contributes to a weighted average of the colors: the
+pixels of interest of the layer (brownish, red or orange in HSV, see
+objective_function_smooth.color_masks) weigh `weight_factor`, the rest 1.
+
+The contribution (w*color, w) of a layer does not depend on the other
+selected layers, so RedWeightedLayers computes it once per layer and patient
+and the fusion of any chromosome is a sum of the selected slices. Colors are
+kept as 0..255 values, so for weight factors such as 2.0 or 2.5 the sums are
+exact and do not depend on the order of the layers: the 127 chromosomes can be
+scored at once (red_weighted_counts) or one layer addition/removal at a time
+in Gray-code order (`step`, gray_sweep.py) with the same result.
+
+The fitness is the one of the other objective functions: the pixels detected
+by the red masks of the selected layers that keep a red color in the fused
+image (red >= 60/255, red > green and red > blue). The comparisons are made on
+the exact sums; the pixels with exact ties (r == g, r == b, r == 60), where
+the float64 arithmetic of the MATLAB function can round either way, are
+re-checked with that arithmetic, as the 'uint8' engine of batch_evaluation.py.
+"""
+
+import weakref
+import numpy as np
+
+from patient_layers import PatientLayers
+from batch_evaluation import ALL_CHROMOSOMES, chromosome_codes, fitness_from_counts, valid_color
+from objective_function_smooth import color_masks
+from fusion_result import FusionResult
+import profiling
+
+# Bump when the fitness of a chromosome changes, so the values of the
+# persistent fitness store (fitness_store.py) computed before are not used.
+# Stored values are those of the default weight factor
+OBJECTIVE_VERSION = 1
+
+# Default weight of the pixels of interest in fuseWeightedRedPriority.m
+WEIGHT_FACTOR = 2.0
+
+# Chromosomes scored at once, bounds the (chunk, pixels, 4) sums
+CHROMOSOME_CHUNK = 16
+
+
+def _valid_sums(sums):
+    # Valid fused colors from the (..., 4) sums of w*RGB (0..255) and w:
+    # red / w >= 60, red > green and red > blue. Also returns the exact ties
+    red = sums[..., 0]
+    min_red = 60 * sums[..., 3]
+    valid = (red >= min_red) & (red > sums[..., 1]) & (red > sums[..., 2])
+    ties = (red == min_red) | (red == sums[..., 1]) | (red == sums[..., 2])
+    return valid, ties
+
+
+class RedWeightedLayers:
+    """
+    Per-layer contributions of the red weighted fusion of one patient.
+
+    terms: (layers,H,W,4) float64 with w*R, w*G, w*B (0..255 scale) and w;
+    missing layers are zeros. The scores only use the pixels detected by some
+    layer, whose terms are also kept apart with their layer signature and
+    their w*RGB in the [0,1] scale of the MATLAB function (for the ties).
+
+    `step(i)` flips layer i of a current chromosome (starting at the null one)
+    and returns its (valid_count, total_detected), for the Gray-code sweep.
+    """
+
+    def __init__(self, patient, weight_factor=WEIGHT_FACTOR):
+        self.patient = patient
+        self.n_layers = patient.n_layers
+        self.weight_factor = weight_factor
+        self.present = np.array([patient.has_layer(i) for i in range(self.n_layers)])
+
+        self.terms = np.zeros((self.n_layers,) + tuple(patient.shape) + (4,), dtype=np.float64)
+        with profiling.span('red_weighted/weights'):
+            for i in np.flatnonzero(self.present):
+                img = patient.raw(i)[:, :, ::-1].astype(np.float64)
+                w = np.where(np.logical_or.reduce(color_masks(img / 255.0)), weight_factor, 1.0)
+                self.terms[i, :, :, :3] = img * w[:, :, np.newaxis]
+                self.terms[i, :, :, 3] = w
+
+        # Pixels detected by any layer: (layers, n, 4) terms and signatures
+        self.candidates = np.flatnonzero(patient.mask_stack().any(axis=0))
+        self.candidate_terms = self.terms.reshape(self.n_layers, -1, 4)[:, self.candidates]
+        self.signature = patient.signature_map().ravel()[self.candidates].astype(np.int64)
+        self.candidate_colors = np.zeros(self.candidate_terms.shape[:2] + (3,), dtype=np.float64)
+        for i in np.flatnonzero(self.present):
+            # img(:,:,c) .* w of the MATLAB function, img from im2double
+            img = patient.raw(i).reshape(-1, 3)[self.candidates, ::-1] / 255.0
+            self.candidate_colors[i] = img * self.candidate_terms[i, :, 3:]
+
+        self.chromosome = None
+
+    def fuse(self, chromosome):
+        """Red weighted fusion (RGB float64 [0,1]) of the selected layers."""
+        selected = (np.asarray(chromosome) != 0) & self.present
+        sums = np.tensordot(selected.astype(np.float64), self.terms, axes=1)
+        weight = sums[:, :, 3]
+        # Pixels without any weight stay black, as the MATLAB function
+        weight[weight == 0] = 1
+        return sums[:, :, :3] / weight[:, :, np.newaxis] / 255
+
+    def fused_mask(self, chromosome):
+        """Pixels detected by the red masks of the selected layers."""
+        code = int(chromosome_codes(np.asarray(chromosome)[np.newaxis])[0])
+        return (self.patient.signature_map().astype(np.int64) & code) != 0
+
+    def _float_valid(self, selected, pixels):
+        # Valid colors of some candidate pixels accumulated as the MATLAB function:
+        # float64 [0,1] colors, layers in order N1, N2, ...
+        accum_rgb = np.zeros((len(pixels), 3), dtype=np.float64)
+        accum_weight = np.zeros(len(pixels), dtype=np.float64)
+        for i in np.flatnonzero(selected):
+            accum_rgb += self.candidate_colors[i, pixels]
+            accum_weight += self.candidate_terms[i, pixels, 3]
+        return valid_color(accum_rgb / accum_weight[:, np.newaxis])
+
+    def _counts(self, sums, codes, selected):
+        detected = (self.signature & codes[:, np.newaxis]) != 0
+        valid, ties = _valid_sums(sums)
+        valid &= detected
+        ties &= detected
+        for k in np.flatnonzero(ties.any(axis=1)):
+            pixels = np.flatnonzero(ties[k])
+            valid[k, pixels] = self._float_valid(selected[k], pixels)
+        return valid.sum(axis=1), detected.sum(axis=1)
+
+    def counts(self, chromosomes=ALL_CHROMOSOMES):
+        """(valid_count, total_detected) arrays of a (k, layers) matrix of chromosomes."""
+        chromosomes = np.atleast_2d(chromosomes)
+        codes = chromosome_codes(chromosomes)
+        selected = ((chromosomes != 0) & self.present).astype(np.float64)
+        flat_terms = self.candidate_terms.reshape(self.n_layers, -1)
+
+        valid_count = np.zeros(len(chromosomes), dtype=np.int64)
+        total_detected = np.zeros(len(chromosomes), dtype=np.int64)
+        for start in range(0, len(chromosomes), CHROMOSOME_CHUNK):
+            chunk = slice(start, start + CHROMOSOME_CHUNK)
+            sums = (selected[chunk] @ flat_terms).reshape(-1, len(self.candidates), 4)
+            valid_count[chunk], total_detected[chunk] = self._counts(sums, codes[chunk], selected[chunk])
+        return valid_count, total_detected
+
+    def step(self, i):
+        """
+        Adds or removes layer i of the current chromosome and makes the result
+        the current one. Returns its (valid_count, total_detected).
+        """
+        if self.chromosome is None:
+            self.chromosome = np.zeros(self.n_layers, dtype=bool)
+            self.sums = np.zeros((len(self.candidates), 4), dtype=np.float64)
+            self.code = 0
+
+        self.chromosome[i] = not self.chromosome[i]
+        self.code ^= 1 << i
+        if self.chromosome[i]:
+            self.sums += self.candidate_terms[i]
+        else:
+            self.sums -= self.candidate_terms[i]
+        valid_count, total_detected = self._counts(self.sums[np.newaxis], np.array([self.code]),
+                                                   (self.chromosome & self.present)[np.newaxis])
+        return int(valid_count[0]), int(total_detected[0])
+
+
+# RedWeightedLayers of each PatientLayers and weight factor, dropped with the patient
+_RED_WEIGHTED_LAYERS = weakref.WeakKeyDictionary()
+
+
+def red_weighted_layers(patient, weight_factor=WEIGHT_FACTOR):
+    """RedWeightedLayers of a PatientLayers, computed on the first call with this weight factor."""
+    cache = _RED_WEIGHTED_LAYERS.setdefault(patient, {})
+    if weight_factor not in cache:
+        cache[weight_factor] = RedWeightedLayers(patient, weight_factor)
+    return cache[weight_factor]
+
+
+def red_weighted_counts(patient, chromosomes=ALL_CHROMOSOMES):
+    """
+    (valid_count, total_detected) of the red weighted fusion of every
+    chromosome, with the default weight factor. The sums are exact, so the
+    same function serves every batch engine.
+    """
+    return red_weighted_layers(patient).counts(chromosomes)
+
+
+def objective_function_red_weighted(chromosome, image_folder=None, prefix=None, save_path=None, patient=None,
+                                    fitness_only=False, engine='float', weight_factor=WEIGHT_FACTOR):
+    """
+    Evaluates a chromosome using RED WEIGHTED fusion (fuseWeightedRedPriority.m).
+
+    The layers are read from `image_folder`/`prefix`, or taken from `patient`
+    (a PatientLayers cache) when given; the layer contributions are cached
+    per patient.
+
+    Returns a FusionResult (fitness, composite image and mask of the pixels
+    detected by the selected layers), which unpacks as (fitness, composite).
+
+    With fitness_only=True (and no save_path) the composite of the result is
+    None. `engine` is accepted for compatibility with the other objective
+    functions; the sums are exact with any of them.
+    """
+    chromosome = np.asarray(chromosome, dtype=int)
+
+    if patient is None:
+        patient = PatientLayers(image_folder, prefix, preload=False, n_layers=chromosome.size)
+    if chromosome.size != patient.n_layers:
+        raise ValueError(f'El cromosoma debe tener exactamente {patient.n_layers} elementos')
+
+    # If all zeros, select one randomly
+    if chromosome.sum() == 0:
+        idx = np.random.randint(0, patient.n_layers)
+        chromosome[idx] = 1
+
+    profiling.count('evaluations')
+
+    for i in np.flatnonzero(chromosome):
+        if not patient.has_layer(i):
+            print(f'Falta {patient.layer_path(i)}, se omite')
+
+    layers = red_weighted_layers(patient, weight_factor)
+    with profiling.span('red_weighted/scoring'):
+        valid_count, total_detected = layers.counts(chromosome)
+        fitness = fitness_from_counts(valid_count, total_detected)[0]
+
+    if fitness_only and not save_path:
+        return FusionResult(fitness, chromosome=chromosome)
+
+    with profiling.span('red_weighted/fusion'):
+        img_fuse = layers.fuse(chromosome).astype(np.float32)
+    result = FusionResult(fitness, img_fuse, layers.fused_mask(chromosome), chromosome)
+    if save_path:
+        result.save_png(save_path)
+
+    return result
+
+
+if __name__ == '__main__':
+    # Test
+    chrom = np.array([1, 0, 1, 1, 0, 0, 0])
+    f, img = objective_function_red_weighted(chrom, 'Images/Prueba', 'C0683d')
+    print(f'Fitness: {f}')
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Implements the WEIGHTED SMOOTH fusion of fuseWeightedSmooth.m in NumPy/OpenCV.
+
+Every selected layer gets a weight map from the HSV classification of its
+pixels (brownish, red and orange pixels weigh more than the rest). The fused
+image blends the weighted average of the layers with their plain average,
+using the normalized and Gaussian-smoothed total weight as the blending mask.
+
+The MATLAB function converts every selected layer to HSV and reads all of
+them a second time for the plain average on each call. Here the weight map,
+the weighted layer and the layer itself are computed once per layer and
+patient (SmoothLayers), so any chromosome is fused from sums of the cached
+arrays.
+
+The fitness is the one of the other objective functions: the pixels detected
+by the red masks of the selected layers that keep a red color in the fused
+image (red >= 60/255, red > green and red > blue).
+"""
+
+import math
+import weakref
+import numpy as np
+import cv2
+
+from patient_layers import PatientLayers
+from batch_evaluation import fitness_from_counts
+from fusion_result import FusionResult
+import profiling
+
+# Bump when the fitness of a chromosome changes, so the values of the
+# persistent fitness store (fitness_store.py) computed before are not used.
+# Stored values are those of the default weights below
+OBJECTIVE_VERSION = 1
+
+# Default parameters of fuseWeightedSmooth.m
+WEIGHT_BROWN = 2.5
+WEIGHT_RED = 2.0
+WEIGHT_ORANGE = 1.5
+SIGMA_SMOOTH = 3
+
+
+def rgb_to_hsv(img):
+    """
+    (h, s, v) of an RGB [0,1] float64 image, each in [0,1], computed as
+    MATLAB's rgb2hsv (gray pixels have hue and saturation 0).
+    """
+    red = img[:, :, 0]
+    green = img[:, :, 1]
+    blue = img[:, :, 2]
+    v = np.maximum(np.maximum(red, green), blue)
+    delta = v - np.minimum(np.minimum(red, green), blue)
+    gray = delta == 0
+    delta = np.where(gray, 1.0, delta)
+
+    # As in rgb2hsv, blue wins over green and green over red when they tie
+    h = np.where(red == v, (green - blue) / delta, 0.0)
+    h = np.where(green == v, 2 + (blue - red) / delta, h)
+    h = np.where(blue == v, 4 + (red - green) / delta, h)
+    h = h / 6
+    h[h < 0] += 1
+    h[gray] = 0
+
+    s = np.zeros_like(v)
+    np.divide(delta, v, out=s, where=(v > 0) & ~gray)
+    return h, s, v
+
+
+def color_masks(img):
+    """
+    (brownish, red, orange) masks of an RGB [0,1] float64 layer, the colors of
+    interest of fuseWeightedSmooth.m and fuseWeightedRedPriority.m.
+    """
+    h, s, v = rgb_to_hsv(img)
+    mask_brownish = (h >= 0.00) & (h < 0.05) & (s > 0.4) & (v > 0.2) & (v < 0.6)
+    mask_red = ((h >= 0.95) | (h < 0.05)) & (s > 0.5) & (v > 0.3)
+    mask_orange = (h >= 0.05) & (h < 0.10) & (s > 0.4) & (v > 0.4)
+    return mask_brownish, mask_red, mask_orange
+
+
+def weight_map(img, weight_brown=WEIGHT_BROWN, weight_red=WEIGHT_RED, weight_orange=WEIGHT_ORANGE):
+    """Per-pixel weight of an RGB [0,1] float64 layer, as in fuseWeightedSmooth.m."""
+    mask_brownish, mask_red, mask_orange = color_masks(img)
+
+    w = np.where(mask_brownish, weight_brown, 1.0)
+    w = np.where(mask_red, np.maximum(w, weight_red), w)
+    w = np.where(mask_orange, np.maximum(w, weight_orange), w)
+    return w
+
+
+def gaussian_smooth(img, sigma):
+    # imgaussfilt: kernel of 2*ceil(2*sigma)+1 pixels, replicated borders
+    size = 2 * math.ceil(2 * sigma) + 1
+    return cv2.GaussianBlur(img, (size, size), sigma, borderType=cv2.BORDER_REPLICATE)
+
+
+class SmoothLayers:
+    """
+    Cached terms of the weighted smooth fusion of one patient.
+
+    The k-th layer is kept as a (H,W,7) float64 array with its weighted
+    color w*RGB, its weight w and its color RGB, so the three sums of a
+    chromosome come from a single product with the selection vector.
+    Missing layers are zeros and do not count in the average.
+    """
+
+    def __init__(self, patient, weight_brown=WEIGHT_BROWN, weight_red=WEIGHT_RED, weight_orange=WEIGHT_ORANGE,
+                 sigma_smooth=SIGMA_SMOOTH):
+        self.patient = patient
+        self.weights = (weight_brown, weight_red, weight_orange)
+        self.sigma_smooth = sigma_smooth
+        self.present = np.array([patient.has_layer(i) for i in range(patient.n_layers)])
+
+        self.terms = np.zeros((patient.n_layers,) + tuple(patient.shape) + (7,), dtype=np.float64)
+        with profiling.span('smooth/weights'):
+            for i in np.flatnonzero(self.present):
+                # Same values as im2double on the RGB image
+                img = patient.raw(i)[:, :, ::-1] / 255.0
+                w = weight_map(img, *self.weights)
+                self.terms[i, :, :, :3] = img * w[:, :, np.newaxis]
+                self.terms[i, :, :, 3] = w
+                self.terms[i, :, :, 4:] = img
+
+    def fuse(self, chromosome):
+        """
+        Weighted smooth fusion (RGB float64 [0,1]) of the selected layers
+        that exist. None if there is none.
+        """
+        selected = (np.asarray(chromosome) != 0) & self.present
+        if not selected.any():
+            return None
+
+        sums = np.tensordot(selected.astype(np.float64), self.terms, axes=1)
+        accum_weighted = sums[:, :, :3]
+        accum_weight = sums[:, :, 3]
+        img_mean = sums[:, :, 4:] / selected.sum()
+
+        # Normalized global weight mask. A constant weight (no colored pixel)
+        # leaves the weighted average equal to the plain one
+        alpha = accum_weight - accum_weight.min()
+        if alpha.max() > 0:
+            alpha /= alpha.max()
+        alpha_smooth = gaussian_smooth(alpha, self.sigma_smooth)[:, :, np.newaxis]
+
+        return alpha_smooth * (accum_weighted / accum_weight[:, :, np.newaxis]) + (1 - alpha_smooth) * img_mean
+
+
+# SmoothLayers of each PatientLayers and parameters, dropped with the patient
+_SMOOTH_LAYERS = weakref.WeakKeyDictionary()
+
+
+def smooth_layers(patient, weight_brown=WEIGHT_BROWN, weight_red=WEIGHT_RED, weight_orange=WEIGHT_ORANGE,
+                  sigma_smooth=SIGMA_SMOOTH):
+    """SmoothLayers of a PatientLayers, computed on the first call with these parameters."""
+    cache = _SMOOTH_LAYERS.setdefault(patient, {})
+    key = (weight_brown, weight_red, weight_orange, sigma_smooth)
+    if key not in cache:
+        cache[key] = SmoothLayers(patient, *key)
+    return cache[key]
+
+
+def objective_function_smooth(chromosome, image_folder=None, prefix=None, save_path=None, patient=None,
+                              fitness_only=False, engine='float', weight_brown=WEIGHT_BROWN, weight_red=WEIGHT_RED,
+                              weight_orange=WEIGHT_ORANGE, sigma_smooth=SIGMA_SMOOTH):
+    """
+    Evaluates a chromosome using WEIGHTED SMOOTH fusion (fuseWeightedSmooth.m).
+
+    The layers are read from `image_folder`/`prefix`, or taken from `patient`
+    (a PatientLayers cache) when given; the weight maps are cached per patient.
+
+    Returns a FusionResult (fitness, composite image and mask of the pixels
+    detected by the selected layers), which unpacks as (fitness, composite).
+
+    With fitness_only=True (and no save_path) the composite of the result is
+    None. `engine` is accepted for compatibility with the other objective
+    functions; this fusion has a single float64 implementation.
+    """
+    chromosome = np.asarray(chromosome, dtype=int)
+
+    if patient is None:
+        patient = PatientLayers(image_folder, prefix, preload=False, n_layers=chromosome.size)
+    if chromosome.size != patient.n_layers:
+        raise ValueError(f'El cromosoma debe tener exactamente {patient.n_layers} elementos')
+
+    # If all zeros, select one randomly
+    if chromosome.sum() == 0:
+        idx = np.random.randint(0, patient.n_layers)
+        chromosome[idx] = 1
+
+    profiling.count('evaluations')
+
+    for i in np.flatnonzero(chromosome):
+        if not patient.has_layer(i):
+            print(f'Falta {patient.layer_path(i)}, se omite')
+
+    layers = smooth_layers(patient, weight_brown, weight_red, weight_orange, sigma_smooth)
+    with profiling.span('smooth/fusion'):
+        img_fuse = layers.fuse(chromosome)
+
+    if img_fuse is None:
+        # None of the selected layers exists
+        fitness = -1.0
+        img_combinada = patient.img_ref
+        if save_path:
+            cv2.imwrite(save_path, (img_combinada * 255).astype(np.uint8))
+        return FusionResult(fitness, img_combinada, chromosome=chromosome)
+
+    with profiling.span('smooth/scoring'):
+        final_mask = np.logical_or.reduce([patient.mask(i) for i in np.flatnonzero(chromosome & layers.present)])
+        pixels = img_fuse[final_mask]
+        red = pixels[:, 0]
+        green = pixels[:, 1]
+        blue = pixels[:, 2]
+        valid_count = np.count_nonzero((red >= 60/255) & (red > green) & (red > blue))
+        fitness = fitness_from_counts(np.array([valid_count]), np.array([final_mask.sum()]))[0]
+
+    if fitness_only and not save_path:
+        return FusionResult(fitness, chromosome=chromosome)
+
+    result = FusionResult(fitness, img_fuse.astype(np.float32), final_mask, chromosome)
+    if save_path:
+        result.save_png(save_path)
+
+    return result
+
+
+if __name__ == '__main__':
+    # Test
+    chrom = np.array([1, 0, 1, 1, 0, 0, 0])
+    f, img = objective_function_smooth(chrom, 'Images/Prueba', 'C0683d')
+    print(f'Fitness: {f}')
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Decoded layer cache for a single patient.
+
+`PatientLayers` reads the 7 masks ({prefix}_N1_mask.bmp ... {prefix}_N7_mask.bmp)
+of a patient and computes their red masks only once. The objective functions
+accept it in place of `image_folder`/`prefix`, so an exhaustive sweep touches
+the disk exactly once per file.
+
+Layers are kept as decoded (BGR uint8); the RGB [0,1] float32 version used by
+the float engine is built the first time it is requested.
+
+Patients have 7 layers by default; scanners with more layers (N1..N{n}, the
+last one being the reference) are read with n_layers=n.
+"""
+
+import os
+import numpy as np
+import cv2
+
+import profiling
+
+N_LAYERS = 7
+
+# Integer equivalents of the float thresholds of red_detection for uint8 values:
+# k/255 > 0.96  <=>  k >= 245   and   k/255 < 0.05  <=>  k <= 12
+RED_EQ_MIN = 245
+BACKGROUND_MAX = 12
+
+
+def red_detection(img, threshold=0.96):
+    """
+    Detects red areas in an RGB image [0,1].
+    Replicating redDetection.m
+    """
+    red_channel = img[:, :, 0]
+    blue_channel = img[:, :, 2]  # OpenCV is BGR, so blue is 2
+
+    # Equalize histogram in red
+    red_uint8 = (red_channel * 255).astype(np.uint8)
+    red_eq = cv2.equalizeHist(red_uint8) / 255.0
+
+    red_areas = red_eq > threshold
+
+    # Remove black background
+    background_mask = (red_channel < 0.05) & (blue_channel < 0.05)
+    red_areas[background_mask] = False
+
+    return red_areas.astype(bool)
+
+
+def red_detection_uint8(img):
+    """
+    Same result as red_detection, computed on a BGR uint8 image with integer
+    comparisons (threshold 0.96 and background 0.05 mapped to exact levels).
+    """
+    red_channel = np.ascontiguousarray(img[:, :, 2])
+    blue_channel = img[:, :, 0]
+
+    # Equalize histogram in red
+    red_areas = cv2.equalizeHist(red_channel) >= RED_EQ_MIN
+
+    # Remove black background
+    background_mask = (red_channel <= BACKGROUND_MAX) & (blue_channel <= BACKGROUND_MAX)
+    red_areas[background_mask] = False
+
+    return red_areas
+
+
+def signature_dtype(n_layers):
+    # Smallest unsigned type with one bit per layer
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if n_layers <= np.iinfo(dtype).bits:
+            return dtype
+    raise ValueError(f'Demasiadas capas para una firma: {n_layers}')
+
+
+def to_float_rgb(img):
+    # BGR uint8 -> RGB float32 in [0,1]
+    return cv2.cvtColor(img.astype(np.float32) / 255.0, cv2.COLOR_BGR2RGB)
+
+
+def read_layer(filepath):
+    # Reads a BMP layer as RGB float32 in [0,1]
+    return to_float_rgb(cv2.imread(filepath))
+
+
+class PatientLayers:
+    """
+    Decoded layers, red masks and reference image (last layer, N7) of one patient.
+
+    With preload=True (default) the 7 layers are decoded and their masks computed
+    on construction. With preload=False each layer is decoded the first time it
+    is requested and kept afterwards. Missing layer files are stored as None.
+    n_layers: number of layers of the scanner (7 for the current images)
+    """
+
+    n_layers = N_LAYERS
+
+    def __init__(self, image_folder, prefix, preload=True, n_layers=N_LAYERS):
+        self.image_folder = image_folder
+        self.prefix = prefix
+        self.n_layers = n_layers
+
+        base_path = self.layer_path(n_layers - 1)
+        if not os.path.exists(base_path):
+            raise FileNotFoundError(f'Imagen base N{n_layers} no encontrada: {base_path}')
+
+        self._init_cache()
+
+        if preload:
+            for i in range(n_layers):
+                self._load(i)
+
+    def _init_cache(self):
+        self._raw = [None] * self.n_layers
+        self._images = [None] * self.n_layers
+        self._masks = [None] * self.n_layers
+        self._loaded = [False] * self.n_layers
+        self._image_stack = None
+        self._raw_stack = None
+        self._mask_stack = None
+
+    def layer_path(self, i):
+        return os.path.join(self.image_folder, f'{self.prefix}_N{i+1}_mask.bmp')
+
+    def _load(self, i):
+        if self._loaded[i]:
+            return
+        filepath = self.layer_path(i)
+        if os.path.exists(filepath):
+            with profiling.span('imread'):
+                raw = cv2.imread(filepath)
+            self._raw[i] = raw
+            with profiling.span('red_detection'):
+                self._masks[i] = red_detection_uint8(raw)
+        self._loaded[i] = True
+
+    def has_layer(self, i):
+        self._load(i)
+        return self._raw[i] is not None
+
+    def raw(self, i):
+        """Returns layer N{i+1} as decoded (BGR uint8), or None if its file is missing."""
+        self._load(i)
+        return self._raw[i]
+
+    def image(self, i):
+        """Returns layer N{i+1} as RGB float32 [0,1], or None if its file is missing."""
+        self._load(i)
+        if self._images[i] is None and self._raw[i] is not None:
+            with profiling.span('to_float'):
+                self._images[i] = to_float_rgb(self._raw[i])
+        return self._images[i]
+
+    def mask(self, i):
+        """Returns the red mask of layer N{i+1}, or None if its file is missing."""
+        self._load(i)
+        return self._masks[i]
+
+    @property
+    def img_ref(self):
+        # The last layer (N7) is also the reference background
+        return self.image(self.n_layers - 1)
+
+    @property
+    def shape(self):
+        return self.raw(self.n_layers - 1).shape[:2]
+
+    def image_stack(self, layers=None):
+        """
+        Returns the layers stacked as (k,H,W,3) float32; missing layers are zeros.
+        `layers` lists the layer indices to stack (all of them by default, cached).
+        """
+        if self._all_layers(layers):
+            if self._image_stack is None:
+                self._image_stack = self._stack(range(self.n_layers), self.image, (3,), np.float32)
+            return self._image_stack
+        return self._stack(layers, self.image, (3,), np.float32)
+
+    def raw_stack(self, layers=None):
+        """
+        Returns the layers stacked as (k,H,W,3) BGR uint8; missing layers are zeros.
+        `layers` lists the layer indices to stack (all of them by default, cached).
+        """
+        if self._all_layers(layers):
+            if self._raw_stack is None:
+                self._raw_stack = self._stack(range(self.n_layers), self.raw, (3,), np.uint8)
+            return self._raw_stack
+        return self._stack(layers, self.raw, (3,), np.uint8)
+
+    def mask_stack(self, layers=None):
+        """
+        Returns the red masks stacked as (k,H,W) bool; missing layers are all False.
+        `layers` lists the layer indices to stack (all of them by default, cached).
+        """
+        if self._all_layers(layers):
+            if self._mask_stack is None:
+                self._mask_stack = self._stack(range(self.n_layers), self.mask, (), bool)
+            return self._mask_stack
+        return self._stack(layers, self.mask, (), bool)
+
+    def signature_map(self, layers=None):
+        """
+        Returns the (H,W) layer signature of every pixel (uint8 up to 8 layers): bit i is set if
+        layer N{i+1} detects red there. `layers` restricts it to those layers.
+        """
+        if layers is None:
+            layers = range(self.n_layers)
+        layers = list(layers)
+        dtype = signature_dtype(self.n_layers)
+        signature = np.zeros(self.shape, dtype=dtype)
+        for i, mask in zip(layers, self.mask_stack(layers)):
+            signature |= mask.astype(dtype) << dtype(i)
+        return signature
+
+    def _all_layers(self, layers):
+        # The cached stacks hold every layer in order N1..Nn
+        return layers is None or list(layers) == list(range(self.n_layers))
+
+    def _stack(self, layers, getter, channels, dtype):
+        layers = list(layers)
+        stack = np.zeros((len(layers),) + tuple(self.shape) + channels, dtype=dtype)
+        for k, i in enumerate(layers):
+            if self.has_layer(i):
+                stack[k] = getter(i)
+        return stack
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Training/validation split of the patients.
+
+find_general_vector.py searches the general vector on the 35 training
+patients and the drivers (main.py, apply_reference_vector.py and the
+compare_fusion_* scripts) evaluate it on the other 15. All of them take the
+split from here, so they always agree.
+
+Other splits (k-fold, repeated random splits) are evaluated by
+cross_validation.py.
+"""
+
+import random
+
+from dataset_catalog import get_all_prefixes
+
+TRAIN_SIZE = 35
+SPLIT_SEED = 42
+
+
+def split_patients(image_folder):
+    """
+    Returns (train_prefixes, val_prefixes): the patients of image_folder
+    shuffled with seed 42, the first 35 for training and the rest for validation.
+    With fewer than 35 patients all of them are used for training.
+
+    The global random module is seeded, as the scripts always did: the local
+    searches run afterwards draw their neighbor order from it.
+    """
+    all_prefixes = get_all_prefixes(image_folder)
+    train_size = min(TRAIN_SIZE, len(all_prefixes))
+
+    random.seed(SPLIT_SEED)
+    random.shuffle(all_prefixes)
+    return all_prefixes[:train_size], all_prefixes[train_size:]
+
+
+def get_validation_patients(image_folder):
+    """Returns the 15 validation patients (all of them if there are fewer than 35)."""
+    train_prefixes, val_prefixes = split_patients(image_folder)
+    if not val_prefixes:
+        print("Warning: Less than 35 patients found. Using all available as validation.")
+        return train_prefixes
+    return val_prefixes
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Lightweight stage profiling for the search scripts.
+
+Code is instrumented with timing spans and counters:
+
+    with profiling.span('fusion'):
+        ...
+    profiling.count('evaluations')
+
+Both do nothing until `enable()` is called (the --profile flag of the entry
+points), so the instrumentation can stay in the hot paths. The report has, for
+each span, the number of calls, the total time and percentiles, plus the
+counters and the evaluations per second of the run; `write_report` saves it as
+JSON.
+
+Work done in worker processes is collected by running it through
+`profiled_call` and merging the returned snapshot with `merge`.
+"""
+
+import json
+import time
+import contextlib
+from collections import defaultdict
+
+import numpy as np
+
+_enabled = False
+_start_time = None
+_spans = defaultdict(list)
+_counters = defaultdict(int)
+
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _spans[self.name].append(time.perf_counter() - self.start)
+        return False
+
+
+def enable():
+    """Starts recording spans and counters (and resets previous data)."""
+    global _enabled, _start_time
+    reset()
+    _enabled = True
+    _start_time = time.perf_counter()
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    _spans.clear()
+    _counters.clear()
+
+
+def span(name):
+    """Context manager timing a stage; a no-op while profiling is disabled."""
+    return _Span(name) if _enabled else _NULL_SPAN
+
+
+def count(name, n=1):
+    """Adds n to a counter while profiling is enabled."""
+    if _enabled:
+        _counters[name] += n
+
+
+def snapshot():
+    """Raw data recorded so far, to send it from a worker process to the parent."""
+    return {'spans': {name: list(values) for name, values in _spans.items()},
+            'counters': dict(_counters)}
+
+
+def merge(data):
+    """Adds a snapshot (e.g. from a worker process) to the data of this process."""
+    for name, values in data['spans'].items():
+        _spans[name].extend(values)
+    for name, value in data['counters'].items():
+        _counters[name] += value
+
+
+def profiled_call(func, *args, **kwargs):
+    """
+    Runs func with profiling enabled and returns (result, snapshot).
+    Used as the task of worker processes when --profile is given.
+    """
+    enable()
+    result = func(*args, **kwargs)
+    return result, snapshot()
+
+
+def report():
+    """Per-span totals and percentiles, counters and evaluations per second."""
+    wall = time.perf_counter() - _start_time if _start_time is not None else 0.0
+    spans = {}
+    for name, values in sorted(_spans.items()):
+        values = np.asarray(values)
+        spans[name] = {
+            'calls': int(values.size),
+            'total_s': float(values.sum()),
+            'mean_s': float(values.mean()),
+            'p50_s': float(np.percentile(values, 50)),
+            'p90_s': float(np.percentile(values, 90)),
+            'p99_s': float(np.percentile(values, 99)),
+            'max_s': float(values.max()),
+        }
+    evaluations = _counters.get('evaluations', 0)
+    return {
+        'wall_time_s': wall,
+        'evaluations': evaluations,
+        'evaluations_per_s': evaluations / wall if wall > 0 else None,
+        'counters': dict(sorted(_counters.items())),
+        'spans': spans,
+    }
+
+
+def write_report(path):
+    """Saves the report as JSON."""
+    with open(path, 'w') as f:
+        json.dump(report(), f, indent=2)
+    print(f'Profile saved: {path}')
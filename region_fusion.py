@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+"""
+Region fusion pipeline of multipleImageProcessing.m.
+
+For every patient of an image folder:
+ 1. Each layer (N1..N7) is segmented with the HSV criterion of redDetection.m
+    and summarized (number of regions, areas and circularities, as in
+    generarResumenRegiones.m), all the layers of the patient measured at once
+    by region_stats.py.
+ 2. The regions of each layer not covered by previous layers are labeled; a
+    region is dropped if its centroid is closer than MIN_DIST to a larger
+    region kept before. Kept regions are painted over the fused image with a
+    soft transition (TRANSITION_WIDTH pixels) where they touch regions of
+    previous layers. The labels are filtered by size as in
+    filtrarEtiquetasPorTamanio.m (region_stats.size_filter).
+ 3. The best layer vector is found by evaluating every average fusion that
+    includes N1 (searchBestLayerFusion_full.m), and the weighted smooth fusion
+    of that vector is saved (objective_function_smooth.py).
+
+The MATLAB version compares the centroids of all pairs of regions and runs
+imdilate/bwdist on full-image masks for each region. Here close centroids are
+found with a KD-tree, the distance transform is computed once per layer on the
+bounding box of its kept regions and dilations only on the bounding box of
+each region, with the same result.
+
+Results (same names and formats as the MATLAB script; out_dir defaults to
+resultados_fusion_py, resultados_fusion keeps the results of the MATLAB script):
+ - out_dir/resultados_{tag}.csv: best vector and score of each patient
+ - out_dir/resumen_por_capa_{tag}.csv: region summary of each layer
+ - out_dir/{prefix}/: segmentation images and {prefix}_fusionPonderada.png
+
+Usage:
+    python3 region_fusion.py --image_folder Images/EIM_B1
+    python3 region_fusion.py --image_folder Images/EIM_B1 --prefixes C0683d C0683i --workers 4
+"""
+
+import os
+import time
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import cv2
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+from patient_layers import PatientLayers, N_LAYERS
+from batch_evaluation import all_chromosomes
+from objective_function_smooth import SmoothLayers
+from region_stats import region_stats, label_regions, size_filter, format_region_summary
+from dataset_catalog import scan_folder
+import profiling
+
+# Parameters of multipleImageProcessing.m
+MIN_DIST = 30
+TRANSITION_WIDTH = 5
+
+# Weighted smooth fusion of the best vector
+FUSION_WEIGHTS = (15, 10, 7)
+FUSION_SIGMA = 4
+
+# Neighborhood of strel('disk', 3)
+DISK3 = np.array([[0, 0, 1, 1, 1, 0, 0],
+                  [0, 1, 1, 1, 1, 1, 0],
+                  [1, 1, 1, 1, 1, 1, 1],
+                  [1, 1, 1, 1, 1, 1, 1],
+                  [1, 1, 1, 1, 1, 1, 1],
+                  [0, 1, 1, 1, 1, 1, 0],
+                  [0, 0, 1, 1, 1, 0, 0]], dtype=np.uint8)
+
+# Label colors of mostrarResultados.m (RGB), one per layer
+LAYER_COLORS = [(1.00, 0.00, 0.00), (0.00, 1.00, 0.00), (0.00, 0.00, 1.00), (1.00, 0.50, 0.00),
+                (0.50, 0.00, 0.50), (0.00, 0.75, 0.75), (0.75, 0.75, 0.00)]
+
+# Region kept in the fused image. bbox is (col, row, width, height) and centroid
+# (x, y), both in 0-based pixel coordinates
+Label = namedtuple('Label', ['bbox', 'centroid', 'layer', 'area'])
+
+
+def suppress_close_regions(centroids, areas, min_dist=MIN_DIST):
+    """
+    Greedy suppression: regions are visited by decreasing area and kept unless
+    a kept region has its centroid closer than min_dist. Returns a bool mask.
+    """
+    n = len(areas)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+
+    # Close pairs, from the KD-tree of the centroids
+    pairs = cKDTree(centroids).query_pairs(min_dist, output_type='ndarray')
+    if len(pairs):
+        distance = np.linalg.norm(centroids[pairs[:, 0]] - centroids[pairs[:, 1]], axis=1)
+        pairs = pairs[distance < min_dist]
+    neighbors = [[] for _ in range(n)]
+    for a, b in pairs:
+        neighbors[a].append(b)
+        neighbors[b].append(a)
+
+    for idx in np.argsort(-areas, kind='stable'):
+        if not any(keep[j] for j in neighbors[idx]):
+            keep[idx] = True
+    return keep
+
+
+def _box(bbox, margin, shape):
+    # Slices of a (col, row, width, height) box grown by margin, clipped to the image
+    col, row, width, height = bbox
+    return (slice(max(row - margin, 0), min(row + height + margin, shape[0])),
+            slice(max(col - margin, 0), min(col + width + margin, shape[1])))
+
+
+def fuse_regions(images, masks, base):
+    """
+    Fusion loop of multipleImageProcessing.m.
+
+    images: RGB [0,1] float64 layers in order (None for missing files)
+    masks: red masks (red_detection_hsv) of the layers (None for missing files)
+    base: background image (N1)
+    Returns (fusion_color, mask_combined, labels).
+    """
+    shape = base.shape[:2]
+    fusion_color = np.zeros(base.shape)
+    occupied = np.zeros(shape, dtype=bool)
+    mask_combined = np.zeros(shape, dtype=bool)
+    labels = []
+
+    for layer, (img, mask) in enumerate(zip(images, masks), 1):
+        if img is None:
+            continue
+
+        with profiling.span('regions/fusion'):
+            new_pixels = mask & ~occupied
+            region_labels, areas, bboxes, centroids = label_regions(new_pixels)
+            kept = np.flatnonzero(suppress_close_regions(centroids, areas))
+            if len(kept) == 0:
+                continue
+
+            # Distance to the border of each kept region, once for the layer.
+            # The kept regions are separate components, so the nearest pixel
+            # outside a region is never in another one
+            kept_mask = np.isin(region_labels, kept + 1)
+            top = bboxes[kept, 1].min()
+            left = bboxes[kept, 0].min()
+            bottom = (bboxes[kept, 1] + bboxes[kept, 3]).max()
+            right = (bboxes[kept, 0] + bboxes[kept, 2]).max()
+            window = _box((left, top, right - left, bottom - top), 1, shape)
+            distance = np.zeros(shape, dtype=np.float32)
+            distance[window] = ndimage.distance_transform_edt(kept_mask[window])
+
+            for idx in kept:
+                box = _box(bboxes[idx], 0, shape)
+                region = region_labels[box] == idx + 1
+                mask_combined[box] |= region
+
+                # Soft transition where the region touches the previous ones
+                # (imdilate of the occupied pixels, on the box grown by the disk)
+                grown = _box(bboxes[idx], 3, shape)
+                contact = cv2.dilate(occupied[grown].astype(np.uint8), DISK3).astype(bool)
+                contact = contact[box[0].start - grown[0].start:box[0].stop - grown[0].start,
+                                  box[1].start - grown[1].start:box[1].stop - grown[1].start]
+                d = distance[box]
+                ring = region & (d > 0) & (d <= TRANSITION_WIDTH)
+                transition = ring & contact
+                w = (d / np.float32(TRANSITION_WIDTH)).astype(np.float64)[:, :, np.newaxis]
+
+                canal = fusion_color[box]
+                origen = img[box]
+                fondo = base[box]
+                solid = region & ~transition
+                canal[solid] = origen[solid]
+                canal[transition] = (w * origen + (1 - w) * fondo)[transition]
+
+                occupied[box] |= region
+                labels.append(Label(tuple(int(v) for v in bboxes[idx]), tuple(centroids[idx]), layer,
+                                    int(areas[idx])))
+
+    return fusion_color, mask_combined, labels
+
+
+def filter_labels_by_size(labels):
+    """filtrarEtiquetasPorTamanio.m on the labels of the fused image (see region_stats.size_filter)."""
+    if not labels:
+        return []
+    show = size_filter(np.array([label.area for label in labels]), np.array([label.bbox for label in labels]))
+    return [label for label, visible in zip(labels, show) if visible]
+
+
+def search_best_layer_fusion(images):
+    """
+    searchBestLayerFusion_full.m: evaluates the average fusion of every layer
+    vector that includes N1. Returns (best_vector, best_score).
+    """
+    n_layers = len(images)
+    present = np.array([img is not None for img in images])
+    chromosomes = all_chromosomes(n_layers)
+    chromosomes = chromosomes[chromosomes[:, 0] == 1]
+    count = (chromosomes * present).sum(axis=1)
+
+    # Red channel sums of every fusion, adding the layers in order as
+    # fuseSelectedLayers. The vectors are built one layer at a time (without
+    # and with it, all_chromosomes order), so vectors sharing their first
+    # layers share those partial sums
+    shape = next(img for img in images if img is not None).shape[:2]
+    red = np.zeros((1,) + shape) if images[0] is None else images[0][np.newaxis, :, :, 0].copy()
+    for img in images[1:]:
+        with_layer = red if img is None else red + img[:, :, 0]
+        red = np.stack([red, with_layer], axis=1).reshape((-1,) + shape)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        red /= count[:, np.newaxis, np.newaxis]
+
+    scores = fusion_scores(red, chromosomes.sum(axis=1))
+    scores[count == 0] = np.nan
+    best = int(np.nanargmax(scores))
+    return chromosomes[best], scores[best]
+
+
+def fusion_scores(red, n_layers):
+    """
+    computeFitness_Var3 of searchBestLayerFusion_full.m for a stack of red
+    channels: entropy + 2 * contrast - 0.01 * noise - 0.3 * layers^1.2.
+    """
+    n = len(red)
+    flat = red.reshape(n, -1)
+
+    # Entropy of mat2gray(red) as uint8 (all the histograms in one bincount)
+    low = flat.min(axis=1, keepdims=True)
+    high = flat.max(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = 1 / (high - low)
+        gray = np.clip(flat * delta + (-low * delta), 0, 1)
+    gray[~np.isfinite(gray)] = 0
+    levels = np.floor(gray * 255 + 0.5).astype(np.int64)
+    histograms = np.bincount((levels + 256 * np.arange(n)[:, np.newaxis]).ravel(),
+                             minlength=256 * n).reshape(n, 256)
+    p = histograms / flat.shape[1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = -np.where(p > 0, p * np.log2(p), 0).sum(axis=1)
+
+    # Contrast
+    contrast = flat.std(axis=1, ddof=1)
+
+    # Scattered noise: regions of fewer than 5 pixels above 0.1
+    noise = np.zeros(n)
+    for k in range(n):
+        _, _, stats, _ = cv2.connectedComponentsWithStats((red[k] > 0.1).astype(np.uint8), connectivity=8)
+        areas = stats[1:, cv2.CC_STAT_AREA]
+        noise[k] = areas[areas < 5].sum()
+
+    return entropy + 2.0 * contrast - 0.01 * noise - 0.3 * np.asarray(n_layers) ** 1.2
+
+
+def _to_bgr_uint8(img):
+    return (cv2.cvtColor(img.astype(np.float32), cv2.COLOR_RGB2BGR) * 255).astype(np.uint8)
+
+
+def _layer_color(layer):
+    r, g, b = LAYER_COLORS[(layer - 1) % len(LAYER_COLORS)]
+    return (int(b * 255), int(g * 255), int(r * 255))
+
+
+def _draw_label_names(img, labels):
+    for label in labels:
+        x, y = label.centroid
+        cv2.putText(img, f'N{label.layer}', (int(round(x)), int(round(y))), cv2.FONT_HERSHEY_SIMPLEX, 0.4,
+                    _layer_color(label.layer), 1, cv2.LINE_AA)
+
+
+def save_segmentation_images(img_combined, labels, mask_combined, out_dir):
+    """
+    Images of mostrarResultados.m: fused image, fused image with a heat map of
+    its red channel and the label boxes, and the mask of detected zones.
+    """
+    cv2.imwrite(os.path.join(out_dir, 'fusionada_segmentacion_sin_etiquetas.png'), _to_bgr_uint8(img_combined))
+
+    # Heat map (jet) of the red channel at 25% over the image
+    red = img_combined[:, :, 0]
+    span = red.max() - red.min()
+    heat = np.zeros(red.shape, dtype=np.uint8) if span == 0 else ((red - red.min()) / span * 255).astype(np.uint8)
+    overlay = cv2.addWeighted(_to_bgr_uint8(img_combined), 0.75, cv2.applyColorMap(heat, cv2.COLORMAP_JET), 0.25, 0)
+    for label in labels:
+        col, row, width, height = label.bbox
+        cv2.rectangle(overlay, (col, row), (col + width - 1, row + height - 1), _layer_color(label.layer), 1)
+    _draw_label_names(overlay, labels)
+    cv2.imwrite(os.path.join(out_dir, 'fusionada_segmentacion_overlay.png'), overlay)
+
+    binary = cv2.cvtColor(mask_combined.astype(np.uint8) * 255, cv2.COLOR_GRAY2BGR)
+    _draw_label_names(binary, labels)
+    cv2.imwrite(os.path.join(out_dir, 'segmentacionBin.png'), binary)
+
+
+def process_patient(image_folder, prefix, out_base):
+    """
+    Runs the pipeline on one patient and writes its images to out_base/prefix.
+    Returns (result_row, summary_rows) for the two CSV files.
+    """
+    out_dir = os.path.join(out_base, prefix)
+    os.makedirs(out_dir, exist_ok=True)
+
+    patient = PatientLayers(image_folder, prefix, preload=False)
+    # Same values as im2double on the RGB layers
+    images = [patient.raw(i)[:, :, ::-1] / 255.0 if patient.has_layer(i) else None for i in range(N_LAYERS)]
+    if images[0] is None:
+        raise FileNotFoundError(f'Imagen base N1 no encontrada: {patient.layer_path(0)}')
+    base = images[0]
+
+    # Summaries of every existing layer, all the layers labeled at once
+    present = [layer for layer, img in enumerate(images) if img is not None]
+    with profiling.span('regions/segmentation'):
+        stats = region_stats([images[layer] for layer in present])
+    masks = [None] * len(images)
+    for k, layer in enumerate(present):
+        masks[layer] = stats.masks[k]
+
+    fusion_color, mask_combined, labels = fuse_regions(images, masks, base)
+    labels = filter_labels_by_size(labels)
+
+    # Fused regions over the base image
+    final_mask = np.any(fusion_color > 0, axis=2)
+    img_combined = base.copy()
+    img_combined[final_mask] = fusion_color[final_mask]
+
+    with profiling.span('regions/write'):
+        save_segmentation_images(img_combined, labels, mask_combined, out_dir)
+
+    with profiling.span('regions/search'):
+        best_vector, best_score = search_best_layer_fusion(images)
+
+    with profiling.span('regions/weighted_fusion'):
+        img_fusion = SmoothLayers(patient, *FUSION_WEIGHTS, sigma_smooth=FUSION_SIGMA).fuse(best_vector)
+    vector_text = '  '.join(str(v) for v in best_vector)
+    img_fusion = _to_bgr_uint8(img_fusion)
+    text = f"Vector optimo: [{' '.join(str(v) for v in best_vector)}]"
+    (text_width, text_height), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.4, 1)
+    y = img_fusion.shape[0] - 10
+    cv2.rectangle(img_fusion, (10, y - text_height - 2), (10 + text_width, y + baseline), (0, 0, 0), -1)
+    cv2.putText(img_fusion, text, (10, y), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1, cv2.LINE_AA)
+    out_fusion = os.path.join(out_dir, f'{prefix}_fusionPonderada.png')
+    cv2.imwrite(out_fusion, img_fusion)
+
+    summary_rows = [(prefix, os.path.basename(patient.layer_path(layer)),
+                     format_region_summary(layer + 1, *stats.summary(k)))
+                    for k, layer in enumerate(present)]
+    return (prefix, f'{best_score:.4f}', vector_text, out_fusion), summary_rows
+
+
+def _process_patient_safe(image_folder, prefix, out_base):
+    # A failing patient is reported and skipped, as the MATLAB try/catch
+    try:
+        return process_patient(image_folder, prefix, out_base)
+    except Exception as e:
+        print(f'ERROR procesando {prefix}:\n   {e}')
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Region fusion pipeline (multipleImageProcessing.m) for a folder of patients')
+    parser.add_argument('--image_folder', type=str, required=True,
+                        help='Folder with the patient layers (e.g., Images/EIM_B1)')
+    parser.add_argument('--prefixes', type=str, nargs='*', default=None,
+                        help='Patients to process (all the patients of the folder by default)')
+    parser.add_argument('--tag', type=str, default=None,
+                        help='Suffix of the CSV files (name of the folder by default)')
+    parser.add_argument('--out_dir', type=str, default='resultados_fusion_py', help='Output directory')
+    parser.add_argument('--workers', type=int, default=1, help='Number of patients processed in parallel')
+    parser.add_argument('--profile', action='store_true', help='Save a PROFILE_*.json report of the run in out_dir')
+    args = parser.parse_args()
+
+    if args.profile:
+        profiling.enable()
+
+    prefixes = args.prefixes or sorted(scan_folder(args.image_folder)[0])
+    tag = args.tag or os.path.basename(os.path.normpath(args.image_folder))
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    start_time = time.time()
+    n = len(prefixes)
+    task_args = ([args.image_folder] * n, prefixes, [args.out_dir] * n)
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            if args.profile:
+                func = [_process_patient_safe] * n
+                outputs = []
+                for output, worker_profile in executor.map(profiling.profiled_call, func, *task_args):
+                    profiling.merge(worker_profile)
+                    outputs.append(output)
+            else:
+                outputs = list(executor.map(_process_patient_safe, *task_args))
+    else:
+        outputs = [_process_patient_safe(*task) for task in zip(*task_args)]
+
+    csv_file = os.path.join(args.out_dir, f'resultados_{tag}.csv')
+    csv_summary = os.path.join(args.out_dir, f'resumen_por_capa_{tag}.csv')
+    with open(csv_file, 'w', newline='') as f_results, open(csv_summary, 'w', newline='') as f_summary:
+        f_results.write('Prefix,Score,Vector,ImagenFusionada\n')
+        f_summary.write('Prefix,Archivo,Resumen\n')
+        for output in outputs:
+            if output is None:
+                continue
+            (prefix, score, vector, out_fusion), summary_rows = output
+            f_results.write(f'{prefix},{score},"{vector}",{out_fusion}\n')
+            for row in summary_rows:
+                f_summary.write('{},{},"{}"\n'.format(*row))
+
+    print(f'\nResumen por capa guardado en {csv_summary}')
+    print(f'\n=== PROCESO COMPLETO ===\nCSV generado en {csv_file}')
+    print(f'{n} patients processed in {time.time() - start_time:.2f} seconds')
+
+    if args.profile:
+        timestamp = time.strftime('%Y%m%d_%H%M%S')
+        profiling.write_report(os.path.join(args.out_dir, f'PROFILE_REGION_FUSION_{timestamp}.json'))
+
+
+if __name__ == '__main__':
+    main()
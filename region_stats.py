@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+Region statistics of the layers of a cohort (generarResumenRegiones.m and
+filtrarEtiquetasPorTamanio.m).
+
+The MATLAB functions label one layer at a time and measure its regions one by
+one (regionprops, one mask per label box). Here the red masks of many layers
+(every layer of a batch of patients) are placed side by side on one canvas,
+separated by a background column, and:
+ - the canvas is labeled once; with the column-major scan of bwconncomp the
+   labels of each layer are consecutive and in the MATLAB order, and the
+   labeling gives the area, box and centroid of every region
+ - the outer boundaries of all the regions come from one findContours call and
+   their perimeters (regionprops 'Perimeter') from bincount reductions over
+   all the boundary steps at once
+ - the circularity is 4*pi*area/perimeter^2
+
+The size filter of filtrarEtiquetasPorTamanio.m (size_filter) marks, among
+the regions of each layer, those that stay visible.
+
+Results (streamed as each batch finishes; out_dir defaults to
+resultados_fusion_py, resultados_fusion keeps the results of the MATLAB script):
+ - out_dir/regiones_{tag}.csv: one row per region (REGION_COLUMNS)
+ - out_dir/resumen_por_capa_{tag}.csv: summary of each layer, in the format of
+   multipleImageProcessing.m
+ - with --parquet, the regions table as Parquet (needs pyarrow)
+
+Usage:
+    python3 region_stats.py --image_folders Images/EIM_B1 --tag EIM_B1
+    python3 region_stats.py --image_folders Images/EIM_B* --tag cohorte --workers 4 --parquet regiones.parquet
+"""
+
+import os
+import csv
+import math
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import cv2
+
+from objective_function_smooth import rgb_to_hsv
+from dataset_catalog import scan_folder
+import profiling
+
+# Parameters of multipleImageProcessing.m
+LABEL_MIN_AREA = 400
+MIN_REGION_AREA = 10
+
+# Radius of strel('disk', 2) of filtrarEtiquetasPorTamanio.m
+DISK2_RADIUS = 2
+
+# Patients labeled on the same canvas
+BATCH_PATIENTS = 16
+
+REGION_COLUMNS = ('folder', 'prefix', 'file', 'layer', 'region', 'area', 'perimeter', 'circularity',
+                  'bbox_col', 'bbox_row', 'bbox_width', 'bbox_height', 'centroid_x', 'centroid_y', 'visible')
+
+
+def red_detection_hsv(img):
+    """
+    Red/brownish areas of an RGB [0,1] float64 layer, replicating redDetection.m
+    (hue <= 0.13, red dominant, regions of at least MIN_REGION_AREA pixels).
+    """
+    h, s, v = rgb_to_hsv(img)
+    red = img[:, :, 0]
+    green = img[:, :, 1]
+    blue = img[:, :, 2]
+
+    red_areas = (h >= 0.00) & (h <= 0.13) & (s >= 0.2) & (v >= 0.15)
+    red_areas &= (red > green + 0.03) & (red > blue + 0.03)
+
+    # Remove black background
+    red_areas &= ~((red < 0.05) & (blue < 0.05) & (green < 0.05))
+
+    # bwareaopen(red_areas, 10)
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(red_areas.astype(np.uint8), connectivity=8)
+    large = stats[:, cv2.CC_STAT_AREA] >= MIN_REGION_AREA
+    large[0] = False
+    return large[labels]
+
+
+def label_regions(mask):
+    """
+    8-connected regions of a mask, numbered 1..n in the order of bwconncomp
+    (column-major scan). Returns (labels, areas, bboxes, centroids) with
+    bboxes as (col, row, width, height) rows and centroids as (x, y) rows.
+    """
+    # Labeling the transposed mask scans the columns first
+    n, labels_t, stats, centroids = cv2.connectedComponentsWithStats(np.ascontiguousarray(mask.T, dtype=np.uint8),
+                                                                     connectivity=8)
+    stats = stats[1:]
+    centroids = centroids[1:]
+
+    # OpenCV labels 2x2 blocks (and large images by stripes), which does not
+    # always number the regions in scan order: renumber them by their first pixel
+    flat = labels_t.ravel()
+    scanned = flat[np.flatnonzero(flat)]
+    _, first = np.unique(scanned, return_index=True)
+    if np.any(np.diff(first) < 0):
+        order = np.argsort(first)
+        renumber = np.zeros(n, dtype=labels_t.dtype)
+        renumber[order + 1] = np.arange(1, n)
+        labels_t = renumber[labels_t]
+        stats = stats[order]
+        centroids = centroids[order]
+
+    labels = labels_t.T
+    areas = stats[:, cv2.CC_STAT_AREA]
+    bboxes = stats[:, [cv2.CC_STAT_TOP, cv2.CC_STAT_LEFT, cv2.CC_STAT_HEIGHT, cv2.CC_STAT_WIDTH]]
+    return labels, areas, bboxes, centroids[:, ::-1]
+
+
+def contour_perimeters(contours):
+    """
+    Perimeter of each closed 8-connected boundary ((k,1,2) points, as given by
+    findContours), as regionprops 'Perimeter': straight and diagonal steps
+    minus a correction per corner. All the boundaries are measured at once.
+    """
+    n = len(contours)
+    if n == 0:
+        return np.zeros(0)
+    lengths = np.array([len(contour) for contour in contours])
+    points = np.concatenate([contour[:, 0, :] for contour in contours]).astype(np.int64)
+    ids = np.repeat(np.arange(n), lengths)
+
+    # Next point of each boundary point, the last one closing the boundary
+    starts = np.cumsum(lengths) - lengths
+    following = np.arange(len(points)) + 1
+    following[starts + lengths - 1] = starts
+
+    delta = (points[following] - points) ** 2
+    is_corner = np.any(delta[following] != delta, axis=1)
+    is_even = np.any(delta == 0, axis=1)
+    n_even = np.bincount(ids, is_even, minlength=n)
+    n_odd = np.bincount(ids, ~is_even, minlength=n)
+    n_corner = np.bincount(ids, is_corner, minlength=n)
+    perimeters = n_even * 0.980 + n_odd * 1.406 - n_corner * 0.091
+    perimeters[lengths < 2] = 0.0
+    return perimeters
+
+
+def region_perimeters(mask, labels, n):
+    """Perimeter of the outer boundary of the regions 1..n of labels."""
+    perimeters = np.zeros(n + 1)
+    contours, hierarchy = cv2.findContours(mask.astype(np.uint8), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_NONE)
+    if hierarchy is None:
+        return perimeters[1:]
+
+    # Top-level contours are outer boundaries (the others are holes)
+    outer = [contour for contour, (_, _, _, parent) in zip(contours, hierarchy[0]) if parent == -1]
+    first = np.array([contour[0, 0] for contour in outer])
+    perimeters[labels[first[:, 1], first[:, 0]]] = contour_perimeters(outer)
+    return perimeters[1:]
+
+
+def size_filter(areas, bboxes, area_threshold=LABEL_MIN_AREA):
+    """
+    filtrarEtiquetasPorTamanio.m: of two regions whose boxes touch (the box of
+    the first dilated with strel('disk', 2)), the smaller one is hidden if it
+    is below area_threshold. bboxes as (col, row, width, height) rows, in the
+    order of the MATLAB labels. Returns the bool mask of visible regions.
+    """
+    n = len(areas)
+    show = np.ones(n, dtype=bool)
+    if n == 0:
+        return show
+    boxes = np.asarray(bboxes)
+    left, top = boxes[:, 0], boxes[:, 1]
+    right, bottom = left + boxes[:, 2] - 1, top + boxes[:, 3] - 1
+
+    # Boxes touch after the dilation if their gap (dx, dy) is inside the disk
+    dx = np.maximum(0, np.maximum(left[np.newaxis] - right[:, np.newaxis], left[:, np.newaxis] - right[np.newaxis]))
+    dy = np.maximum(0, np.maximum(top[np.newaxis] - bottom[:, np.newaxis], top[:, np.newaxis] - bottom[np.newaxis]))
+    touching = dx ** 2 + dy ** 2 <= DISK2_RADIUS ** 2
+
+    for i in range(n):
+        if not show[i]:
+            continue
+        area_i = areas[i]
+        for j in np.flatnonzero(touching[i]):
+            if i == j or not show[j]:
+                continue
+            area_j = areas[j]
+            if area_i < area_threshold and area_j > area_i:
+                show[i] = False
+            elif area_j < area_threshold and area_i > area_j:
+                show[j] = False
+    return show
+
+
+class RegionStats:
+    """
+    Regions of a list of layer masks, measured together (mask_region_stats).
+
+    Arrays with one entry per region, the regions of each layer consecutive
+    and in bwconncomp order:
+     - layer: index of the mask of the region in the input list
+     - region: number of the region in its layer (1..n)
+     - area, perimeter, circularity
+     - bboxes (col, row, width, height) and centroids (x, y), in the
+       coordinates of its layer
+     - visible: kept by the size filter among the regions of its layer
+    masks: the input masks, in the same order.
+    """
+
+    def __init__(self, masks, layer, region, area, perimeter, bboxes, centroids, visible):
+        self.masks = masks
+        self.layer = layer
+        self.region = region
+        self.area = area
+        self.perimeter = perimeter
+        with np.errstate(divide='ignore'):
+            self.circularity = 4 * math.pi * (area / perimeter ** 2)
+        self.bboxes = bboxes
+        self.centroids = centroids
+        self.visible = visible
+        self.starts = np.searchsorted(layer, np.arange(len(masks) + 1))
+
+    def __len__(self):
+        return len(self.area)
+
+    def regions_of(self, k):
+        """Slice of the regions of the k-th mask."""
+        return slice(self.starts[k], self.starts[k + 1])
+
+    def summary(self, k):
+        """
+        (number of regions, areas, circularities) of the k-th mask, sorted by
+        decreasing area, as in generarResumenRegiones.m.
+        """
+        regions = self.regions_of(k)
+        areas = self.area[regions]
+        order = np.argsort(-areas, kind='stable')
+        return len(areas), areas[order], self.circularity[regions][order]
+
+
+def mask_region_stats(masks):
+    """RegionStats of a list of 2-D bool masks (any sizes), labeled on a single canvas."""
+    height = max((mask.shape[0] for mask in masks), default=0)
+    widths = np.array([mask.shape[1] for mask in masks], dtype=np.int64)
+    # One background column after each mask keeps the regions of different masks apart
+    offsets = np.concatenate([[0], np.cumsum(widths + 1)])
+    canvas = np.zeros((height, offsets[-1]), dtype=bool)
+    for mask, offset in zip(masks, offsets):
+        canvas[:mask.shape[0], offset:offset + mask.shape[1]] = mask
+
+    with profiling.span('region_stats/label'):
+        labels, areas, bboxes, centroids = label_regions(canvas)
+    with profiling.span('region_stats/perimeter'):
+        perimeters = region_perimeters(canvas, labels, len(areas))
+
+    # Layer of each region and coordinates inside it. The centroids are
+    # computed from the integer sums of the local coordinates, so they do not
+    # depend on the position of the layer in the canvas
+    layer = np.searchsorted(offsets, bboxes[:, 0], side='right') - 1
+    starts = np.searchsorted(layer, np.arange(len(masks) + 1))
+    region = np.arange(len(areas)) - starts[layer] + 1
+    bboxes = bboxes.copy()
+    bboxes[:, 0] -= offsets[layer]
+    rows, cols = np.nonzero(canvas)
+    ids = labels[rows, cols]
+    n = len(areas) + 1
+    col_sums = np.bincount(ids, cols, minlength=n)[1:] - offsets[layer] * areas
+    row_sums = np.bincount(ids, rows, minlength=n)[1:]
+    centroids = np.column_stack([col_sums / areas, row_sums / areas])
+
+    with profiling.span('region_stats/size_filter'):
+        visible = np.ones(len(areas), dtype=bool)
+        for k in range(len(masks)):
+            regions = slice(starts[k], starts[k + 1])
+            visible[regions] = size_filter(areas[regions], bboxes[regions])
+
+    profiling.count('regions', len(areas))
+    return RegionStats(masks, layer, region, areas, perimeters, bboxes, centroids, visible)
+
+
+def region_stats(images):
+    """RegionStats of the red masks (red_detection_hsv) of a list of RGB [0,1] float64 layers."""
+    with profiling.span('region_stats/segmentation'):
+        masks = [red_detection_hsv(img) for img in images]
+    return mask_region_stats(masks)
+
+
+def _num2str(values):
+    # num2str of an integer row vector: right-aligned columns two spaces wider than the largest
+    if len(values) == 0:
+        return ''
+    width = len(str(max(values))) + 2
+    return ''.join(f'{v:{width}d}' for v in values).strip()
+
+
+def format_region_summary(layer, n_regions, areas, circularity):
+    """Summary of a layer as written to resumen_por_capa_*.csv."""
+    circ = ''.join(f'{c:.2f} ' for c in circularity).strip().replace('inf', 'Inf')
+    return f'N{layer} ({n_regions} regs): A=[{_num2str(areas)}] C=[{circ}]'
+
+
+def batch_rows(patients):
+    """
+    Reads and measures the layers of a batch of patients, given as
+    (folder, prefix, layer numbers) tuples. Returns (region_rows, summary_rows)
+    in REGION_COLUMNS and (Prefix, Archivo, Resumen) formats.
+    Runs in the worker processes when --workers > 1.
+    """
+    keys = []
+    images = []
+    with profiling.span('imread'):
+        for folder, prefix, layers in patients:
+            for layer in layers:
+                name = f'{prefix}_N{layer}_mask.bmp'
+                raw = cv2.imread(os.path.join(folder, name))
+                if raw is None:
+                    continue
+                keys.append((os.path.basename(os.path.normpath(folder)), prefix, name, layer))
+                # Same values as im2double on the RGB image
+                images.append(raw[:, :, ::-1] / 255.0)
+
+    stats = region_stats(images)
+    region_rows = []
+    summary_rows = []
+    for k, (folder, prefix, name, layer) in enumerate(keys):
+        summary_rows.append((prefix, name, format_region_summary(layer, *stats.summary(k))))
+        for r in range(*stats.regions_of(k).indices(len(stats))):
+            region_rows.append((folder, prefix, name, layer, int(stats.region[r]), int(stats.area[r]),
+                                float(stats.perimeter[r]), float(stats.circularity[r]),
+                                *(int(v) for v in stats.bboxes[r]),
+                                *(float(v) for v in stats.centroids[r]), int(stats.visible[r])))
+    return region_rows, summary_rows
+
+
+def cohort_batches(image_folders, batch_patients=BATCH_PATIENTS):
+    """
+    Patients of the image folders (each folder in order, its prefixes sorted)
+    as batches of (folder, prefix, layer numbers) tuples.
+    """
+    patients = []
+    for folder in image_folders:
+        layers = scan_folder(folder)[0]
+        patients += [(folder, prefix, layers[prefix]) for prefix in sorted(layers)]
+    return [patients[k:k + batch_patients] for k in range(0, len(patients), batch_patients)]
+
+
+def cohort_rows(batches, workers=1, profile=False):
+    """
+    Yields the batch_rows of each batch, in order, as soon as it is ready.
+    With workers > 1 the batches are split among worker processes; with
+    profile=True their profiling data is merged into this process.
+    """
+    if workers <= 1:
+        for batch in batches:
+            yield batch_rows(batch)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if profile:
+            for rows, worker_profile in executor.map(profiling.profiled_call, [batch_rows] * len(batches), batches):
+                profiling.merge(worker_profile)
+                yield rows
+        else:
+            yield from executor.map(batch_rows, batches)
+
+
+def export_parquet(csv_path, parquet_path):
+    """Writes the regions CSV table as Parquet (needs pyarrow)."""
+    try:
+        import pyarrow.csv as pa_csv
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('La exportacion a Parquet requiere pyarrow (pip install pyarrow)')
+    convert = pa_csv.ConvertOptions(column_types={'folder': 'string', 'prefix': 'string', 'file': 'string'})
+    pq.write_table(pa_csv.read_csv(csv_path, convert_options=convert), parquet_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Region statistics of every layer of a cohort')
+    parser.add_argument('--image_folders', type=str, nargs='+', required=True,
+                        help='Folders with the patient layers (e.g., Images/EIM_B1 Images/EIM_B2)')
+    parser.add_argument('--tag', type=str, default=None,
+                        help='Suffix of the CSV files (name of the first folder by default)')
+    parser.add_argument('--out_dir', type=str, default='resultados_fusion_py', help='Output directory')
+    parser.add_argument('--batch_patients', type=int, default=BATCH_PATIENTS,
+                        help='Patients labeled together on one canvas')
+    parser.add_argument('--workers', type=int, default=1, help='Number of batches processed in parallel')
+    parser.add_argument('--parquet', type=str, default=None, help='Also export the regions table to this Parquet file')
+    parser.add_argument('--profile', action='store_true', help='Save a PROFILE_*.json report of the run in out_dir')
+    args = parser.parse_args()
+
+    if args.profile:
+        profiling.enable()
+
+    tag = args.tag or os.path.basename(os.path.normpath(args.image_folders[0]))
+    os.makedirs(args.out_dir, exist_ok=True)
+    regions_path = os.path.join(args.out_dir, f'regiones_{tag}.csv')
+    summary_path = os.path.join(args.out_dir, f'resumen_por_capa_{tag}.csv')
+
+    start_time = time.time()
+    batches = cohort_batches(args.image_folders, args.batch_patients)
+    n_layers = n_regions = 0
+    with open(regions_path, 'w', newline='') as f_regions, open(summary_path, 'w', newline='') as f_summary:
+        regions_writer = csv.writer(f_regions)
+        regions_writer.writerow(REGION_COLUMNS)
+        f_summary.write('Prefix,Archivo,Resumen\n')
+        for region_rows, summary_rows in cohort_rows(batches, args.workers, args.profile):
+            regions_writer.writerows(region_rows)
+            for row in summary_rows:
+                f_summary.write('{},{},"{}"\n'.format(*row))
+            f_regions.flush()
+            f_summary.flush()
+            n_layers += len(summary_rows)
+            n_regions += len(region_rows)
+
+    print(f'{n_regions} regions of {n_layers} layers measured in {time.time() - start_time:.2f} seconds')
+    print(f'Regiones guardadas en {regions_path}')
+    print(f'Resumen por capa guardado en {summary_path}')
+
+    if args.parquet:
+        export_parquet(regions_path, args.parquet)
+        print(f'Parquet: {args.parquet}')
+
+    if args.profile:
+        timestamp = time.strftime('%Y%m%d_%H%M%S')
+        profiling.write_report(os.path.join(args.out_dir, f'PROFILE_REGION_STATS_{timestamp}.json'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Long-format table of fitness results.
+
+Each row is one (run, patient, chromosome, fusion method) evaluation:
+
+    run_id, patient, chromosome, method, fitness, valid_count, total_detected
+
+`chromosome` is the bit mask of the selected layers (bit i = layer N{i+1}, so
+[1, 0, 1, 0, 0, 0, 0] is 5; 7 bits, or the n_layers of the run metadata for
+cohorts with more layers). Rows are appended to a CSV file by
+`ResultsWriter` as each patient finishes; the metadata of every run (training
+and validation patients, ...) is appended to a JSON lines file next to it
+(results.csv -> results.runs.jsonl).
+
+`ResultsTable` loads one run and answers the usual questions (top-k
+chromosomes of a patient, average over the cohort). The SUMMARY_AVERAGES and
+DETAILS text reports of find_general_vector.py are generated from it.
+
+Parquet export needs pyarrow (optional).
+
+Usage:
+    python3 results_store.py top --results results_data_analysis/fitness_results.csv --patient C0683d --k 5
+    python3 results_store.py average --results results_data_analysis/fitness_results.csv --k 10
+    python3 results_store.py report --results results_data_analysis/fitness_results.csv --out_dir results_data_analysis
+    python3 results_store.py export --results results_data_analysis/fitness_results.csv --parquet results.parquet
+"""
+
+import os
+import csv
+import json
+import argparse
+import numpy as np
+
+from patient_layers import N_LAYERS
+
+COLUMNS = ('run_id', 'patient', 'chromosome', 'method', 'fitness', 'valid_count', 'total_detected')
+
+
+def chromosome_mask(chromosome):
+    """Bit mask of a chromosome, bit i set if layer N{i+1} is selected."""
+    return int(sum(int(bit) << i for i, bit in enumerate(chromosome)))
+
+
+def mask_chromosome(mask, n_layers=N_LAYERS):
+    """Inverse of chromosome_mask: int array of n_layers elements."""
+    return np.array([(int(mask) >> i) & 1 for i in range(n_layers)], dtype=int)
+
+
+def runs_path(results_path):
+    # results.csv -> results.runs.jsonl
+    return os.path.splitext(results_path)[0] + '.runs.jsonl'
+
+
+def read_runs(results_path):
+    """Metadata of the runs stored in a results file: {run_id: dict}."""
+    runs = {}
+    path = runs_path(results_path)
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    run = json.loads(line)
+                    runs[run['run_id']] = run
+    return runs
+
+
+class ResultsWriter:
+    """
+    Append-only writer of result rows. Each call to write_rows is flushed to
+    disk, so the rows of the finished patients survive an interrupted run.
+
+    path: CSV file (created with a header if it does not exist)
+    run_id: identifier of this run (e.g. its timestamp)
+    metadata: saved in the runs file of `path`
+    """
+
+    def __init__(self, path, run_id, **metadata):
+        self.path = path
+        self.run_id = str(run_id)
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow(COLUMNS)
+            self.file.flush()
+        if self.run_id not in read_runs(path):
+            with open(runs_path(path), 'a') as f:
+                f.write(json.dumps({'run_id': self.run_id, **metadata}) + '\n')
+
+    def write_rows(self, patient, method, chromosomes, fitness, valid_count, total_detected):
+        """Appends the results of one patient and method (one row per chromosome)."""
+        for chrom, fit, valid, total in zip(chromosomes, fitness, valid_count, total_detected):
+            # repr keeps every digit, the reports read back the same floats
+            self.writer.writerow([self.run_id, patient, chromosome_mask(chrom), method,
+                                  repr(float(fit)), int(valid), int(total)])
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class ResultsTable:
+    """
+    Rows of one run of a results file, as columns.
+    Patients and chromosomes keep the order in which they were written; a row
+    written again by a resumed run replaces the previous one. The chromosomes
+    have the n_layers of the run metadata (7 if not given).
+    """
+
+    def __init__(self, rows, run_id=None, metadata=None):
+        rows = list({(row['patient'], row['chromosome'], row['method']): row for row in rows}.values())
+        self.run_id = run_id
+        self.metadata = metadata or {}
+        self.n_layers = self.metadata.get('n_layers', N_LAYERS)
+        self.patient = [row['patient'] for row in rows]
+        self.chromosome = np.array([int(row['chromosome']) for row in rows], dtype=int)
+        self.method = [row['method'] for row in rows]
+        self.fitness = np.array([float(row['fitness']) for row in rows], dtype=np.float64)
+        self.valid_count = np.array([int(row['valid_count']) for row in rows], dtype=np.int64)
+        self.total_detected = np.array([int(row['total_detected']) for row in rows], dtype=np.int64)
+
+    @classmethod
+    def load(cls, path, run_id=None):
+        """Loads the rows of run_id (the last run of the file by default)."""
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f))
+        if run_id is None:
+            if not rows:
+                raise ValueError(f'No hay resultados en {path}')
+            run_id = rows[-1]['run_id']
+        rows = [row for row in rows if row['run_id'] == str(run_id)]
+        if not rows:
+            raise ValueError(f'Run {run_id} no encontrado en {path}')
+        return cls(rows, str(run_id), read_runs(path).get(str(run_id)))
+
+    def __len__(self):
+        return len(self.patient)
+
+    def _select(self, method, patient=None):
+        method_rows = np.array([m == method for m in self.method], dtype=bool)
+        if patient is not None:
+            method_rows &= np.array([p == patient for p in self.patient], dtype=bool)
+        return np.flatnonzero(method_rows)
+
+    def methods(self):
+        return list(dict.fromkeys(self.method))
+
+    def patients(self, method='average'):
+        return list(dict.fromkeys(self.patient[k] for k in self._select(method)))
+
+    def chromosomes(self, method='average'):
+        """Chromosome masks in the order they were written."""
+        return list(dict.fromkeys(int(self.chromosome[k]) for k in self._select(method)))
+
+    def fitness_matrix(self, method='average'):
+        """
+        Returns (patients, chromosome masks, matrix) with the fitness of each
+        patient (rows) and chromosome (columns).
+        """
+        patients = self.patients(method)
+        masks = self.chromosomes(method)
+        row_of = {p: r for r, p in enumerate(patients)}
+        col_of = {c: k for k, c in enumerate(masks)}
+        matrix = np.full((len(patients), len(masks)), np.nan)
+        for k in self._select(method):
+            matrix[row_of[self.patient[k]], col_of[int(self.chromosome[k])]] = self.fitness[k]
+        return patients, masks, matrix
+
+    def counts(self, patient, chromosomes, method='average'):
+        """
+        (valid_count, total_detected) arrays of a patient for the given
+        chromosomes, or None if any of them is missing.
+        """
+        rows = {int(self.chromosome[k]): k for k in self._select(method, patient)}
+        masks = [chromosome_mask(chrom) for chrom in chromosomes]
+        if any(mask not in rows for mask in masks):
+            return None
+        index = [rows[mask] for mask in masks]
+        return self.valid_count[index], self.total_detected[index]
+
+    def top_k(self, patient, k=10, method='average'):
+        """Best k (chromosome mask, fitness) of one patient."""
+        rows = self._select(method, patient)
+        order = sorted(rows, key=lambda r: -self.fitness[r])[:k]
+        return [(int(self.chromosome[r]), float(self.fitness[r])) for r in order]
+
+    def cohort_average(self, method='average'):
+        """
+        (chromosome mask, average fitness, fitness per patient) of every
+        chromosome, best average first (ties keep the written order).
+        """
+        patients, masks, matrix = self.fitness_matrix(method)
+        entries = []
+        for k, mask in enumerate(masks):
+            fitnesses = [float(f) for f in matrix[:, k] if not np.isnan(f)]
+            if fitnesses:
+                entries.append((mask, sum(fitnesses) / len(fitnesses), fitnesses))
+        entries.sort(key=lambda x: -x[1])
+        return entries
+
+    def summary_report(self, method='average'):
+        """Text of SUMMARY_AVERAGES (same layout as find_general_vector.py)."""
+        patients = self.patients(method)
+        training = self.metadata.get('training', patients)
+        lines = [f'Summary of all {2 ** self.n_layers - 1} combinations ordered by average fitness (best to worst) '
+                 f'over {len(training)} patients:\n\n',
+                 f'Training Patients: {training}\n',
+                 f'Validation Patients: {self.metadata.get("validation", [])}\n\n']
+        for i, (mask, avg_f, _) in enumerate(self.cohort_average(method), 1):
+            lines.append(f'{i}. Average Fitness: {avg_f:.6f}, Chromosome: {mask_chromosome(mask, self.n_layers).tolist()}\n')
+        return ''.join(lines)
+
+    def details_reports(self, method='average'):
+        """Text of the DETAILS file of each patient: {patient: text}."""
+        entries = self.cohort_average(method)
+        reports = {}
+        for idx, prefix in enumerate(self.patients(method)):
+            valid_entries = [entry for entry in entries if idx < len(entry[2])]
+            sorted_for_prefix = sorted(valid_entries, key=lambda x: -x[2][idx])
+            lines = [f'Details for patient {prefix}, combinations ordered by fitness (best to worst):\n\n']
+            for i, (mask, avg_f, fitnesses) in enumerate(sorted_for_prefix, 1):
+                lines.append(f'{i}. Fitness: {fitnesses[idx]:.6f}, Average: {avg_f:.6f}, '
+                             f'Chromosome: {mask_chromosome(mask, self.n_layers).tolist()}\n')
+            reports[prefix] = ''.join(lines)
+        return reports
+
+    def text_reports(self, out_dir, method='average'):
+        """
+        SUMMARY_AVERAGES and DETAILS file names and texts of the run:
+        {path: text}, named as find_general_vector.py does (run_id = timestamp).
+        """
+        training = self.metadata.get('training', self.patients(method))
+        reports = {os.path.join(out_dir, f'SUMMARY_AVERAGES_{len(training)}patients_{self.run_id}.txt'):
+                   self.summary_report(method)}
+        for prefix, text in self.details_reports(method).items():
+            reports[os.path.join(out_dir, f'DETAILS_{prefix}_{self.run_id}.txt')] = text
+        return reports
+
+
+def export_parquet(results_path, parquet_path):
+    """Writes the whole CSV results file as Parquet (needs pyarrow)."""
+    try:
+        import pyarrow.csv as pa_csv
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('La exportacion a Parquet requiere pyarrow (pip install pyarrow)')
+    convert = pa_csv.ConvertOptions(column_types={'run_id': 'string', 'patient': 'string', 'method': 'string'})
+    pq.write_table(pa_csv.read_csv(results_path, convert_options=convert), parquet_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query a fitness results table')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_common(sub):
+        sub.add_argument('--results', type=str, default='results_data_analysis/fitness_results.csv',
+                         help='CSV results file')
+        sub.add_argument('--run_id', type=str, default=None, help='Run to read (last run by default)')
+        sub.add_argument('--method', type=str, default='average', help='Fusion method')
+
+    top_parser = subparsers.add_parser('top', help='Best chromosomes of one patient')
+    add_common(top_parser)
+    top_parser.add_argument('--patient', type=str, required=True, help='Patient prefix')
+    top_parser.add_argument('--k', type=int, default=10, help='Number of chromosomes')
+
+    average_parser = subparsers.add_parser('average', help='Best chromosomes by average over the cohort')
+    add_common(average_parser)
+    average_parser.add_argument('--k', type=int, default=10, help='Number of chromosomes')
+
+    report_parser = subparsers.add_parser('report', help='Write the SUMMARY_AVERAGES and DETAILS text reports')
+    add_common(report_parser)
+    report_parser.add_argument('--out_dir', type=str, default='results_data_analysis', help='Output directory')
+
+    export_parser = subparsers.add_parser('export', help='Export the results file as Parquet')
+    export_parser.add_argument('--results', type=str, default='results_data_analysis/fitness_results.csv',
+                               help='CSV results file')
+    export_parser.add_argument('--parquet', type=str, required=True, help='Output Parquet file')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_parquet(args.results, args.parquet)
+        print(f'Parquet saved: {args.parquet}')
+        return
+
+    table = ResultsTable.load(args.results, args.run_id)
+    print(f'Run {table.run_id}: {len(table)} rows')
+    if args.command == 'top':
+        for i, (mask, fitness) in enumerate(table.top_k(args.patient, args.k, args.method), 1):
+            print(f'{i}. Fitness: {fitness:.6f}, Chromosome: {mask_chromosome(mask, table.n_layers).tolist()}')
+    elif args.command == 'average':
+        for i, (mask, avg_f, _) in enumerate(table.cohort_average(args.method)[:args.k], 1):
+            print(f'{i}. Average Fitness: {avg_f:.6f}, Chromosome: {mask_chromosome(mask, table.n_layers).tolist()}')
+    else:
+        os.makedirs(args.out_dir, exist_ok=True)
+        for path, text in table.text_reports(args.out_dir, args.method).items():
+            with open(path, 'w') as f:
+                f.write(text)
+        print(f'Reports saved in {args.out_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+import numpy as np
+
+from region_fusion import label_regions
+
+
+def test_label_regions_follows_column_major_scan():
+    # (3,0) comes first in the column-major scan of bwconncomp, although
+    # OpenCV reaches (0,1) first when labeling the transposed mask by blocks
+    mask = np.zeros((5, 5), dtype=bool)
+    mask[3, 0] = True
+    mask[0, 1] = True
+    labels, areas, bboxes, centroids = label_regions(mask)
+    assert labels[3, 0] == 1
+    assert labels[0, 1] == 2
+    np.testing.assert_array_equal(bboxes, [[0, 3, 1, 1], [1, 0, 1, 1]])
+    np.testing.assert_array_equal(centroids, [[0, 3], [1, 0]])
+    np.testing.assert_array_equal(areas, [1, 1])
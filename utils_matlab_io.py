@@ -11,11 +11,14 @@ import numpy as np
 from scipy.io import savemat, loadmat
 from typing import Any
 
+import profiling
+
 
 def save_chromosome_mat(chromosome: np.ndarray, path: str) -> None:
     # Save chromosome as variable 'chromosome' in a .mat file
     chromosome = np.asarray(chromosome).astype(np.uint8).reshape((1, -1))
-    savemat(path, {'chromosome': chromosome})
+    with profiling.span('write/mat'):
+        savemat(path, {'chromosome': chromosome})
 
 
 def load_chromosome_mat(path: str) -> Any: